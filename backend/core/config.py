@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Optional
 from pydantic_settings import BaseSettings
 from pydantic import field_validator
 
@@ -7,15 +7,103 @@ class Settings(BaseSettings):
     API_PREFIX: str = "/api"
     DEBUG: bool = False
 
+    # 日志：json（每行一个 JSON 对象，带 job_id）或 text（本地开发）
+    LOG_LEVEL: str = "INFO"
+    LOG_FORMAT: str = "json"
+    # 独立 worker 进程的 /metrics 端口，0 表示不暴露
+    WORKER_METRICS_PORT: int = 9101
+
     DATABASE_URL: str
+    # 异步引擎地址；为空时由 DATABASE_URL 推导（postgresql → asyncpg，sqlite → aiosqlite）
+    ASYNC_DATABASE_URL: str = ""
+    # 连接池（同步与异步引擎各自一个池；SQLite 只使用 pre-ping 与 recycle）
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 20
+    DB_POOL_TIMEOUT: float = 30.0
+    DB_POOL_PRE_PING: bool = True
+    DB_POOL_RECYCLE: int = 1800
+    # 单条语句的超时（毫秒，仅 PostgreSQL），0 表示不限制
+    DB_STATEMENT_TIMEOUT_MS: int = 0
 
     ALLOWED_ORIGINS: str = ""
 
     OPENAI_API_KEY: str 
 
+    # 推理服务（llm_servers）地址，多个地址用逗号分隔，按轮询方式负载均衡
+    LLM_SERVICE_URLS: str = "http://localhost:8001/api/qwen3/generate"
+    LLM_CONNECT_TIMEOUT: float = 5.0
+    LLM_READ_TIMEOUT: float = 900.0
+    LLM_MAX_RETRIES: int = 3
+    LLM_RETRY_BACKOFF: float = 0.5
+    LLM_MAX_CONNECTIONS: int = 20
+    # 让推理服务按任务的 JSON schema 约束解码，输出一次就能解析
+    LLM_CONSTRAINED_DECODING: bool = True
+
+    # 故事生成任务队列：memory（进程内 asyncio 队列）或 database（story_job 表，支持多进程 worker）
+    JOB_QUEUE_BACKEND: str = "memory"
+    JOB_RUN_WORKERS: bool = True
+    JOB_CONCURRENCY: int = 4
+    JOB_VISIBILITY_TIMEOUT: float = 1800.0
+    JOB_MAX_ATTEMPTS: int = 3
+    JOB_POLL_INTERVAL: float = 1.0
+    # 任务优先级，数值大的先执行：懒生成只写根节点，玩家很快就能开始，排在完整故事之前；
+    # 预生成库存的任务排在所有玩家任务之后，只使用空闲的推理能力
+    JOB_PRIORITY_FULL: int = 0
+    JOB_PRIORITY_LAZY: int = 10
+    JOB_PRIORITY_POOL: int = -10
+    # 任务状态推送：memory（单进程）或 postgres（LISTEN/NOTIFY，多进程）
+    JOB_EVENTS_BACKEND: str = "memory"
+
+    # 流式生成时，已解析的故事节点写入数据库的最小间隔（秒）
+    STORY_STREAM_FLUSH_INTERVAL: float = 0.5
+    # 流式生成在请求中直接执行，不经过任务队列；每个进程同时进行的流式生成数，超出时返回 503
+    STORY_STREAM_MAX_CONCURRENCY: int = 4
+
+    # 回答被截断或某个分支无效时，保留完整的部分，只重新生成缺失的分支；
+    # 缺失分支超过 STORY_REPAIR_MAX_BRANCHES 个时整体重新生成更划算
+    STORY_REPAIR_ENABLED: bool = True
+    STORY_REPAIR_MAX_BRANCHES: int = 8
+    # 完整故事的层数（含根节点），与提示中的 3-4 层一致；决定修复分支还能写几层
+    STORY_MAX_DEPTH: int = 4
+
+    # 主题级缓存：相同主题（规范化后）+ 提示版本 + 模型最多保留多少个不同故事，达到后直接复用
+    THEME_CACHE_ENABLED: bool = True
+    THEME_CACHE_STORIES_PER_THEME: int = 3
+    STORY_PROMPT_VERSION: str = "1"
+    LLM_MODEL_ID: str = "Qwen3"
+
+    # 热门主题的预生成库存：库存低于 LOW 时补充到 HIGH；有超过 POOL_MAX_PENDING_JOBS 个玩家任务排队时暂停
+    POOL_ENABLED: bool = False
+    POOL_THEMES: str = ""
+    POOL_LOW_WATERMARK: int = 2
+    POOL_HIGH_WATERMARK: int = 5
+    POOL_CONCURRENCY: int = 1
+    POOL_MAX_PENDING_JOBS: int = 0
+    POOL_CHECK_INTERVAL: float = 10.0
+    # 某主题的预生成任务失败后，暂停补充该主题的秒数
+    POOL_FAILURE_BACKOFF: float = 60.0
+
+    # 懒生成模式：最大深度（含根节点），以及每生成一个节点后预取的选项数（0 表示不预取）
+    LAZY_MAX_DEPTH: int = 4
+    LAZY_PREFETCH_OPTIONS: int = 0
+    LAZY_PREFETCH_CONCURRENCY: int = 2
+
+    # /stories/{id}/complete 的序列化结果缓存
+    STORY_CACHE_MAX_BYTES: int = 64 * 1024 * 1024
+    REDIS_URL: Optional[str] = None
+    STORY_CACHE_REDIS_TTL: int = 86400
+
     @field_validator("ALLOWED_ORIGINS")
     def parse_allowed_origins(cls, v: str) -> List[str]:
         return v.split(",") if v else []
+
+    @field_validator("POOL_THEMES")
+    def parse_pool_themes(cls, v: str) -> List[str]:
+        return [theme.strip() for theme in v.split(",") if theme.strip()]
+
+    @field_validator("LLM_SERVICE_URLS")
+    def parse_llm_service_urls(cls, v: str) -> List[str]:
+        return [url.strip().rstrip("/") for url in v.split(",") if url.strip()]
     
     class Config:
         env_file = ".env"
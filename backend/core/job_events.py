@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import queue
+import select
+import threading
+from collections import defaultdict
+from typing import Dict, Optional, Set
+
+from core.config import settings
+
+logger = logging.getLogger(__name__)
+
+PG_CHANNEL = "story_job_events"
+
+
+class JobEventBus:
+    """
+    In-process pub/sub for job status changes.
+
+    Messages only carry the job_id; subscribers re-read the job once per
+    change instead of polling. ``publish`` is safe to call from any thread.
+    """
+
+    def __init__(self) -> None:
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = defaultdict(set)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+
+    async def stop(self) -> None:
+        self._loop = None
+
+    def subscribe(self, job_id: str) -> asyncio.Queue:
+        events: asyncio.Queue = asyncio.Queue()
+        self._subscribers[job_id].add(events)
+        return events
+
+    def unsubscribe(self, job_id: str, events: asyncio.Queue) -> None:
+        subscribers = self._subscribers.get(job_id)
+        if subscribers is None:
+            return
+        subscribers.discard(events)
+        if not subscribers:
+            del self._subscribers[job_id]
+
+    def _dispatch(self, job_id: str) -> None:
+        for events in self._subscribers.get(job_id, ()):
+            events.put_nowait(job_id)
+
+    def dispatch(self, job_id: str) -> None:
+        """Deliver to subscribers in this process."""
+        if self._loop is None:
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._dispatch, job_id)
+        except RuntimeError:
+            # 事件循环已关闭
+            pass
+
+    def publish(self, job_id: str) -> None:
+        self.dispatch(job_id)
+
+
+class PostgresJobEventBus(JobEventBus):
+    """
+    Relays job events between processes with Postgres LISTEN/NOTIFY.
+
+    A background thread owns one autocommit connection: it sends queued
+    NOTIFYs and hands every received notification (including our own) to
+    the local subscribers.
+    """
+
+    def __init__(self, database_url: str) -> None:
+        super().__init__()
+        self.database_url = database_url
+        self._outbox: "queue.Queue[str]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+
+    async def start(self) -> None:
+        await super().start()
+        self._running = True
+        self._thread = threading.Thread(target=self._listen, name="job-events-listener", daemon=True)
+        self._thread.start()
+
+    async def stop(self) -> None:
+        self._running = False
+        if self._thread is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self._thread.join, 5)
+            self._thread = None
+        await super().stop()
+
+    def publish(self, job_id: str) -> None:
+        self._outbox.put(job_id)
+
+    def _listen(self) -> None:
+        import psycopg2
+
+        while self._running:
+            try:
+                conn = psycopg2.connect(self.database_url)
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute(f"LISTEN {PG_CHANNEL}")
+                    while self._running:
+                        while not self._outbox.empty():
+                            cursor.execute("SELECT pg_notify(%s, %s)", (PG_CHANNEL, self._outbox.get_nowait()))
+                        if select.select([conn], [], [], 0.2)[0]:
+                            conn.poll()
+                            while conn.notifies:
+                                self.dispatch(conn.notifies.pop(0).payload)
+                conn.close()
+            except Exception as e:
+                logger.error(f"Job event listener error: {str(e)}")
+                threading.Event().wait(1)
+
+
+def _create_job_event_bus() -> JobEventBus:
+    if settings.JOB_EVENTS_BACKEND == "postgres":
+        from sqlalchemy.engine import make_url
+
+        url = make_url(settings.DATABASE_URL).set(drivername="postgresql")
+        return PostgresJobEventBus(url.render_as_string(hide_password=False))
+    if settings.JOB_EVENTS_BACKEND == "memory":
+        return JobEventBus()
+    raise ValueError(f"Unknown JOB_EVENTS_BACKEND: {settings.JOB_EVENTS_BACKEND}")
+
+
+job_event_bus: JobEventBus = _create_job_event_bus()
+
+
+def get_job_event_bus() -> JobEventBus:
+    return job_event_bus
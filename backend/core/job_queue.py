@@ -0,0 +1,382 @@
+import asyncio
+import itertools
+import logging
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import func, or_, update
+from sqlalchemy.orm import Session
+
+from core.config import settings
+from core.story_generator import StoryGenerator
+from core.job_events import get_job_event_bus
+from core.log_context import bind_job_id
+from core.metrics import JOB_DURATION, JOB_QUEUE_WAIT, JOBS_IN_FLIGHT, seconds_since
+from core.story_cache import get_story_cache
+from core.story_expander import get_node_expander
+from core.theme_cache import sync_followers, theme_cache_key
+from db.database import SessionLocal
+from models.job import StoryJob
+from models.story import StoryEdge, StoryNode
+
+logger = logging.getLogger(__name__)
+
+
+def job_lock_deadline() -> datetime:
+    return datetime.now() + timedelta(seconds=settings.JOB_VISIBILITY_TIMEOUT)
+
+
+def claim_job(db: Session, job_id: str) -> bool:
+    """Atomically move a pending job to processing; False if another worker got it first."""
+    result = db.execute(
+        update(StoryJob)
+        .where(StoryJob.job_id == job_id, StoryJob.status == "pending", StoryJob.coalesced_into.is_(None))
+        .values(
+            status="processing",
+            attempts=func.coalesce(StoryJob.attempts, 0) + 1,
+            locked_until=job_lock_deadline(),
+        )
+    )
+    db.commit()
+    if result.rowcount != 1:
+        return False
+    get_job_event_bus().publish(job_id)
+    return True
+
+
+def claim_next_job(db: Session) -> Optional[str]:
+    """Claim the highest-priority pending job, skipping rows locked by other workers."""
+    job_id = db.query(StoryJob.job_id).filter(
+        StoryJob.status == "pending", StoryJob.coalesced_into.is_(None)
+    ).order_by(
+        StoryJob.priority.desc(), StoryJob.id
+    ).with_for_update(skip_locked=True).limit(1).scalar()
+
+    if job_id is None:
+        db.rollback()
+        return None
+    return job_id if claim_job(db, job_id) else None
+
+
+def extend_job_lock(db: Session, job_id: str) -> None:
+    db.execute(
+        update(StoryJob)
+        .where(StoryJob.job_id == job_id, StoryJob.status == "processing")
+        .values(locked_until=job_lock_deadline())
+    )
+    db.commit()
+
+
+def requeue_stale_jobs(db: Session) -> List[Tuple[str, int]]:
+    """
+    Return processing jobs whose visibility timeout expired (their worker died)
+    to pending, or fail them once they used up JOB_MAX_ATTEMPTS.
+    """
+    now = datetime.now()
+    stale = db.query(StoryJob).filter(
+        StoryJob.status == "processing",
+        or_(StoryJob.locked_until < now, StoryJob.locked_until.is_(None)),
+    ).with_for_update(skip_locked=True).all()
+
+    requeued = []
+    for job in stale:
+        job.locked_until = None
+        if (job.attempts or 0) >= settings.JOB_MAX_ATTEMPTS:
+            job.status = "failed"
+            job.completed_at = now
+            job.error = "Job timed out"
+        else:
+            job.status = "pending"
+            requeued.append((job.job_id, job.priority or 0))
+    db.commit()
+
+    for job in stale:
+        get_job_event_bus().publish(job.job_id)
+        if job.status == "failed":
+            sync_followers(db, job)
+
+    if stale:
+        logger.warning(f"Requeued {len(requeued)} stale jobs, failed {len(stale) - len(requeued)}")
+    return requeued
+
+
+def pending_jobs(db: Session) -> List[Tuple[str, int]]:
+    return [
+        (job_id, priority or 0) for job_id, priority in db.query(StoryJob.job_id, StoryJob.priority).filter(
+            StoryJob.status == "pending", StoryJob.coalesced_into.is_(None)
+        ).order_by(StoryJob.priority.desc(), StoryJob.id)
+    ]
+
+
+def _run_sync(func, *args):
+    db = SessionLocal()
+    try:
+        return func(db, *args)
+    finally:
+        db.close()
+
+
+def _lazy_root_options(db: Session, story_id: int) -> Optional[Tuple[int, int]]:
+    """``(root id, number of options)`` of a story, or None if it has no root yet."""
+    root_id = db.query(StoryNode.id).filter(StoryNode.story_id == story_id, StoryNode.is_root == True).scalar()
+    if root_id is None:
+        return None
+    return root_id, db.query(func.count(StoryEdge.position)).filter(StoryEdge.parent_id == root_id).scalar()
+
+
+async def prefetch_lazy_root(story_id: int) -> None:
+    """Start generating the first choices of a new lazy story before the player picks one."""
+    if settings.LAZY_PREFETCH_OPTIONS <= 0:
+        return
+
+    root = await run_in_threadpool(_run_sync, _lazy_root_options, story_id)
+    if root is not None:
+        root_id, option_count = root
+        get_node_expander().schedule_prefetch(story_id, root_id, range(option_count))
+
+
+async def run_story_job(job_id: str) -> None:
+    """Generate the story for an already claimed job and record the outcome."""
+    with bind_job_id(job_id), JOBS_IN_FLIGHT.track_inprogress():
+        await _run_story_job(job_id)
+
+
+async def _run_story_job(job_id: str) -> None:
+    db = SessionLocal()
+
+    try:
+        job = await run_in_threadpool(db.query(StoryJob).filter(StoryJob.job_id == job_id).first)
+
+        if not job:
+            return
+
+        # 提交后属性会过期，先记下指标需要的字段
+        mode, purpose, created_at = job.mode or "full", job.purpose or "player", job.created_at
+        queue_wait = seconds_since(created_at)
+        if queue_wait is not None and (job.attempts or 0) <= 1:
+            JOB_QUEUE_WAIT.labels(mode, purpose).observe(queue_wait)
+        logger.info("Story job started", extra={"theme": job.theme, "mode": mode, "purpose": purpose})
+
+        def on_story_created(story) -> None:
+            # 根节点已可读，提前公开 story_id，前端可以先开始游戏
+            job.story_id = story.id
+            db.commit()
+            get_job_event_bus().publish(job_id)
+            sync_followers(db, job)
+
+        try:
+            if job.mode == "lazy":
+                story = await StoryGenerator.agenerate_lazy_story(db, job.session_id, job.theme)
+                await prefetch_lazy_root(story.id)
+            else:
+                story = await StoryGenerator.agenerate_story(db, job.session_id, job.theme, on_story_created)
+
+            if job.purpose == "pool":
+                # 预生成的故事进入库存，等待玩家领取
+                story.theme_key = theme_cache_key(job.theme)
+                story.is_pooled = True
+            else:
+                # 完整生成的故事进入主题缓存，供相同主题的后续请求复用
+                story.theme_key = job.theme_key
+            job.story_id = story.id
+            job.status = "completed"
+            job.completed_at = datetime.now()
+            job.locked_until = None
+            status, story_id = "completed", story.id
+            await run_in_threadpool(db.commit)
+            if purpose == "pool":
+                # 库存中的故事领取时才按玩家序列化，不占用任何进程的缓存
+                get_story_cache().invalidate(story_id)
+        except Exception as e:
+            await run_in_threadpool(db.rollback)
+            job.story_id = None
+            job.status = "failed"
+            job.completed_at = datetime.now()
+            job.locked_until = None
+            job.error = str(e)
+            await run_in_threadpool(db.commit)
+            status, story_id = "failed", None
+            logger.error(f"Story job failed: {str(e)}")
+
+        duration = seconds_since(created_at)
+        if duration is not None:
+            JOB_DURATION.labels(mode, purpose, status).observe(duration)
+        logger.info("Story job finished", extra={"status": status, "story_id": story_id, "seconds": duration})
+
+        get_job_event_bus().publish(job_id)
+        await run_in_threadpool(sync_followers, db, job)
+    finally:
+        await run_in_threadpool(db.close)
+
+
+class JobQueue(ABC):
+    """
+    Runs story jobs on a fixed number of asyncio workers.
+
+    Subclasses decide where the next job comes from; jobs with a higher
+    ``priority`` (see ``job_priority``) run first. While a job runs its
+    lock is extended periodically; if the process dies the lock expires and
+    the reaper returns the job to pending.
+    """
+
+    def __init__(self, concurrency: int) -> None:
+        self.concurrency = concurrency
+        self._tasks: List[asyncio.Task] = []
+        self._stopping = False
+
+    async def start(self) -> None:
+        self._stopping = False
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.concurrency)]
+        self._tasks.append(asyncio.create_task(self._reaper()))
+        logger.info(f"{type(self).__name__} started with {self.concurrency} workers")
+
+    async def stop(self) -> None:
+        self._stopping = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    @abstractmethod
+    def enqueue(self, job_id: str, priority: int = 0) -> None:
+        """Notify the queue about a new pending job. Safe to call from any thread."""
+
+    @abstractmethod
+    async def _next_job(self) -> str:
+        """Wait for a pending job and claim it."""
+
+    def _on_requeued(self, jobs: List[Tuple[str, int]]) -> None:
+        pass
+
+    async def _worker(self, index: int) -> None:
+        while not self._stopping:
+            try:
+                job_id = await self._next_job()
+                await self._process(job_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Job worker {index} error: {str(e)}")
+                await asyncio.sleep(settings.JOB_POLL_INTERVAL)
+
+    async def _process(self, job_id: str) -> None:
+        heartbeat = asyncio.create_task(self._heartbeat(job_id))
+        try:
+            await run_story_job(job_id)
+        finally:
+            heartbeat.cancel()
+
+    async def _heartbeat(self, job_id: str) -> None:
+        interval = settings.JOB_VISIBILITY_TIMEOUT / 3
+        while True:
+            await asyncio.sleep(interval)
+            await run_in_threadpool(_run_sync, extend_job_lock, job_id)
+
+    async def _reaper(self) -> None:
+        interval = max(settings.JOB_VISIBILITY_TIMEOUT / 2, settings.JOB_POLL_INTERVAL)
+        while True:
+            try:
+                requeued = await run_in_threadpool(_run_sync, requeue_stale_jobs)
+                self._on_requeued(requeued)
+            except Exception as e:
+                logger.error(f"Failed to requeue stale jobs: {str(e)}")
+            await asyncio.sleep(interval)
+
+
+class InProcessJobQueue(JobQueue):
+    """Priority queue held in this process. Pending jobs are reloaded from the database on start."""
+
+    def __init__(self, concurrency: int) -> None:
+        super().__init__(concurrency)
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._counter = itertools.count()
+
+    async def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.PriorityQueue()
+        for job_id, priority in await run_in_threadpool(_run_sync, pending_jobs):
+            self._put(job_id, priority)
+        await super().start()
+
+    def _put(self, job_id: str, priority: int) -> None:
+        self._queue.put_nowait((-priority, next(self._counter), job_id))
+
+    def enqueue(self, job_id: str, priority: int = 0) -> None:
+        self._loop.call_soon_threadsafe(self._put, job_id, priority)
+
+    def _on_requeued(self, jobs: List[Tuple[str, int]]) -> None:
+        for job_id, priority in jobs:
+            self.enqueue(job_id, priority)
+
+    async def _next_job(self) -> str:
+        while True:
+            _, _, job_id = await self._queue.get()
+            if await run_in_threadpool(_run_sync, claim_job, job_id):
+                return job_id
+
+
+class DatabaseJobQueue(JobQueue):
+    """
+    Uses the story_job table itself as the queue, so several API or worker
+    processes can share it (SELECT ... FOR UPDATE SKIP LOCKED on Postgres).
+    """
+
+    def __init__(self, concurrency: int, poll_interval: float) -> None:
+        super().__init__(concurrency)
+        self.poll_interval = poll_interval
+        self._wakeup: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        await super().start()
+
+    def enqueue(self, job_id: str, priority: int = 0) -> None:
+        # 任务已写入数据库，这里只需唤醒本进程中空闲的 worker
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _next_job(self) -> str:
+        while True:
+            job_id = await run_in_threadpool(_run_sync, claim_next_job)
+            if job_id:
+                return job_id
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+
+class _NoWorkerJobQueue(JobQueue):
+    """API-only replicas: jobs are left in the database for separate worker processes."""
+
+    async def start(self) -> None:
+        pass
+
+    def enqueue(self, job_id: str, priority: int = 0) -> None:
+        pass
+
+    async def _next_job(self) -> str:
+        raise RuntimeError("API-only replicas do not run jobs")
+
+
+def _create_job_queue() -> JobQueue:
+    if not settings.JOB_RUN_WORKERS:
+        return _NoWorkerJobQueue(0)
+    if settings.JOB_QUEUE_BACKEND == "database":
+        return DatabaseJobQueue(settings.JOB_CONCURRENCY, settings.JOB_POLL_INTERVAL)
+    if settings.JOB_QUEUE_BACKEND == "memory":
+        return InProcessJobQueue(settings.JOB_CONCURRENCY)
+    raise ValueError(f"Unknown JOB_QUEUE_BACKEND: {settings.JOB_QUEUE_BACKEND}")
+
+
+job_queue: JobQueue = _create_job_queue()
+
+
+def get_job_queue() -> JobQueue:
+    return job_queue
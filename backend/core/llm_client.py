@@ -0,0 +1,188 @@
+import asyncio
+import itertools
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+import httpx
+
+from core.config import settings
+from core.log_context import job_id_headers
+from core.metrics import LLM_REQUEST_DURATION
+
+# 可重试的连接类错误；读超时不重试，避免重复触发一次长时间的生成
+RETRYABLE_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError)
+
+
+class LLMServiceError(Exception):
+    pass
+
+
+class LLMServiceClient:
+    """
+    Shared, pooled HTTP client for the llm_servers inference endpoints.
+
+    Requests are spread round-robin over ``endpoints``. 5xx responses and
+    connection errors are retried on the next endpoint with exponential
+    backoff, up to ``max_retries`` times.
+    """
+
+    def __init__(
+        self,
+        endpoints: List[str],
+        connect_timeout: float,
+        read_timeout: float,
+        max_retries: int,
+        retry_backoff: float,
+        max_connections: int,
+    ) -> None:
+        if not endpoints:
+            raise ValueError("At least one LLM service endpoint is required")
+        self.endpoints = endpoints
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self._timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self._limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+        )
+        self._next_endpoint = itertools.count()
+        self._client: Optional[httpx.Client] = None
+        self._async_client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def client(self) -> httpx.Client:
+        if self._client is None:
+            self._client = httpx.Client(timeout=self._timeout, limits=self._limits)
+        return self._client
+
+    @property
+    def async_client(self) -> httpx.AsyncClient:
+        if self._async_client is None:
+            self._async_client = httpx.AsyncClient(timeout=self._timeout, limits=self._limits)
+        return self._async_client
+
+    def _endpoint(self, path: str = "") -> str:
+        base = self.endpoints[next(self._next_endpoint) % len(self.endpoints)]
+        return f"{base}{path}"
+
+    def _backoff(self, attempt: int) -> float:
+        return self.retry_backoff * (2 ** attempt)
+
+    def _timer(self, payload: Dict[str, Any]):
+        return LLM_REQUEST_DURATION.labels(payload.get("task", "story")).time()
+
+    def post(self, payload: Dict[str, Any], path: str = "") -> Dict[str, Any]:
+        with self._timer(payload):
+            return self._post(payload, path)
+
+    def _post(self, payload: Dict[str, Any], path: str) -> Dict[str, Any]:
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            try:
+                response = self.client.post(self._endpoint(path), json=payload, headers=job_id_headers())
+            except RETRYABLE_ERRORS as e:
+                if last_attempt:
+                    raise LLMServiceError(f"Error calling LLM service: {str(e)}")
+            else:
+                if response.status_code == 200:
+                    return response.json()
+                if response.status_code < 500 or last_attempt:
+                    raise LLMServiceError(f"Error calling LLM service: {response.status_code}")
+            time.sleep(self._backoff(attempt))
+
+    async def apost(self, payload: Dict[str, Any], path: str = "") -> Dict[str, Any]:
+        with self._timer(payload):
+            return await self._apost(payload, path)
+
+    async def _apost(self, payload: Dict[str, Any], path: str) -> Dict[str, Any]:
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            try:
+                response = await self.async_client.post(self._endpoint(path), json=payload, headers=job_id_headers())
+            except RETRYABLE_ERRORS as e:
+                if last_attempt:
+                    raise LLMServiceError(f"Error calling LLM service: {str(e)}")
+            else:
+                if response.status_code == 200:
+                    return response.json()
+                if response.status_code < 500 or last_attempt:
+                    raise LLMServiceError(f"Error calling LLM service: {response.status_code}")
+            await asyncio.sleep(self._backoff(attempt))
+
+    @contextmanager
+    def stream(self, payload: Dict[str, Any], path: str = "/stream") -> Iterator[httpx.Response]:
+        """Open a streaming response; only establishing the connection is retried."""
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            try:
+                request = self.client.build_request(
+                    "POST", self._endpoint(path), json=payload, headers=job_id_headers()
+                )
+                response = self.client.send(request, stream=True)
+            except RETRYABLE_ERRORS as e:
+                if last_attempt:
+                    raise LLMServiceError(f"Error calling LLM service: {str(e)}")
+            else:
+                if response.status_code == 200:
+                    try:
+                        with self._timer(payload):
+                            yield response
+                    finally:
+                        response.close()
+                    return
+                response.close()
+                if response.status_code < 500 or last_attempt:
+                    raise LLMServiceError(f"Error calling LLM service: {response.status_code}")
+            time.sleep(self._backoff(attempt))
+
+    @asynccontextmanager
+    async def astream(self, payload: Dict[str, Any], path: str = "/stream") -> AsyncIterator[httpx.Response]:
+        """Async variant of ``stream``."""
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            try:
+                request = self.async_client.build_request(
+                    "POST", self._endpoint(path), json=payload, headers=job_id_headers()
+                )
+                response = await self.async_client.send(request, stream=True)
+            except RETRYABLE_ERRORS as e:
+                if last_attempt:
+                    raise LLMServiceError(f"Error calling LLM service: {str(e)}")
+            else:
+                if response.status_code == 200:
+                    try:
+                        with self._timer(payload):
+                            yield response
+                    finally:
+                        await response.aclose()
+                    return
+                await response.aclose()
+                if response.status_code < 500 or last_attempt:
+                    raise LLMServiceError(f"Error calling LLM service: {response.status_code}")
+            await asyncio.sleep(self._backoff(attempt))
+
+    def close(self) -> None:
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    async def aclose(self) -> None:
+        self.close()
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+
+
+llm_client = LLMServiceClient(
+    endpoints=settings.LLM_SERVICE_URLS,
+    connect_timeout=settings.LLM_CONNECT_TIMEOUT,
+    read_timeout=settings.LLM_READ_TIMEOUT,
+    max_retries=settings.LLM_MAX_RETRIES,
+    retry_backoff=settings.LLM_RETRY_BACKOFF,
+    max_connections=settings.LLM_MAX_CONNECTIONS,
+)
+
+
+def get_llm_client() -> LLMServiceClient:
+    return llm_client
@@ -0,0 +1,71 @@
+import json
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Iterator, Optional
+
+# 当前正在处理的故事任务；asyncio 任务与 run_in_threadpool 的线程都会继承
+job_id_var: ContextVar[Optional[str]] = ContextVar("job_id", default=None)
+
+# 推理服务通过此请求头拿到同一个 job_id，两端日志可以对应起来
+JOB_ID_HEADER = "X-Job-ID"
+
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "job_id"}
+
+
+@contextmanager
+def bind_job_id(job_id: Optional[str]) -> Iterator[None]:
+    token = job_id_var.set(job_id)
+    try:
+        yield
+    finally:
+        job_id_var.reset(token)
+
+
+def job_id_headers() -> dict:
+    job_id = job_id_var.get()
+    return {JOB_ID_HEADER: job_id} if job_id else {}
+
+
+class JobIdFilter(logging.Filter):
+    """Adds the current ``job_id`` to every record."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.job_id = job_id_var.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; fields passed with ``extra=`` are kept as keys."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "job_id": getattr(record, "job_id", None),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                payload[key] = value
+        if record.exc_info:
+            payload["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+def configure_logging(level: str = "INFO", fmt: str = "json") -> None:
+    """Install the root handler: ``json`` for log shipping, ``text`` for local development."""
+    handler = logging.StreamHandler()
+    handler.addFilter(JobIdFilter())
+    if fmt == "json":
+        handler.setFormatter(JsonFormatter())
+    elif fmt == "text":
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s [job=%(job_id)s] %(message)s"))
+    else:
+        raise ValueError(f"Unknown LOG_FORMAT: {fmt}")
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
@@ -0,0 +1,85 @@
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Iterator, Optional
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# 秒级的阶段耗时；故事生成本身可能持续数分钟
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+JOB_BUCKETS = (0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600, 900, 1800)
+
+JOB_QUEUE_WAIT = Histogram(
+    "story_job_queue_wait_seconds",
+    "Time a story job spent pending before a worker claimed it",
+    ["mode", "purpose"],
+    buckets=JOB_BUCKETS,
+)
+JOB_DURATION = Histogram(
+    "story_job_duration_seconds",
+    "End-to-end latency of a story job, from creation to completion or failure",
+    ["mode", "purpose", "status"],
+    buckets=JOB_BUCKETS,
+)
+JOBS_IN_FLIGHT = Gauge(
+    "story_jobs_in_flight",
+    "Story jobs currently being generated by this process",
+)
+LLM_REQUEST_DURATION = Histogram(
+    "story_llm_request_seconds",
+    "Round trip of one call to the inference service, including retries",
+    ["task"],
+    buckets=JOB_BUCKETS,
+)
+PARSE_DURATION = Histogram(
+    "story_parse_seconds",
+    "Time spent parsing the model answer of one job",
+    ["mode"],
+    buckets=STAGE_BUCKETS,
+)
+PERSIST_DURATION = Histogram(
+    "story_persist_seconds",
+    "Time spent writing the generated story of one job to the database",
+    ["mode"],
+    buckets=STAGE_BUCKETS,
+)
+STORY_REPAIRS = Counter(
+    "story_repairs_total",
+    "Truncated or malformed story answers, by whether regenerating their broken branches succeeded",
+    ["result"],
+)
+REPAIR_BRANCHES = Histogram(
+    "story_repair_branches",
+    "Branches regenerated to repair one story answer",
+    buckets=(0, 1, 2, 3, 4, 6, 8, 12, 16),
+)
+POOL_CLAIMS = Counter(
+    "story_pool_claims_total",
+    "Story requests for a pooled theme, by whether the inventory had a story ready",
+    ["result"],
+)
+
+
+def seconds_since(started_at: Optional[datetime]) -> Optional[float]:
+    """Seconds between a ``server_default=func.now()`` timestamp and now."""
+    if started_at is None:
+        return None
+    if started_at.tzinfo is None:
+        # SQLite 的 CURRENT_TIMESTAMP 是不带时区的 UTC 时间
+        started_at = started_at.replace(tzinfo=timezone.utc)
+    return max((datetime.now(timezone.utc) - started_at).total_seconds(), 0.0)
+
+
+class StageTimer:
+    """Accumulates the time of a stage that runs in several separate pieces, e.g. incremental parsing."""
+
+    def __init__(self) -> None:
+        self.seconds = 0.0
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds += time.perf_counter() - started
@@ -19,6 +19,23 @@ class StoryLLMResponse(BaseModel):
     rootNode: StoryNodeLLM = Field(description="the root node of the story")
 
 
+class StoryOptionStubLLM(BaseModel):
+    text: str = Field(description="the text of the option shown to the user")
+
+
+class StoryNodeStubLLM(BaseModel):
+    """A node whose options are not written yet (lazy mode)."""
+    content: str = Field(description="the main content of the story node")
+    isEnding: bool = Field(description="whether this node is an ending node")
+    isWinningEnding: bool = Field(description="whether this node is a winning endin node")
+    options: Optional[List[StoryOptionStubLLM]] = Field(default=None, description="the options for this node")
+
+
+class LazyStoryLLMResponse(BaseModel):
+    title: str = Field(description="the title of the story")
+    rootNode: StoryNodeStubLLM = Field(description="the root node of the story")
+
+
 class StoryLLMRequest(BaseModel):
     thinking_content: str
     answer: str
\ No newline at end of file
@@ -0,0 +1,6 @@
+from typing import Optional
+
+
+def format_sse(data: str, event: Optional[str] = None) -> str:
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {data}\n\n"
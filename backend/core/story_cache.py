@@ -0,0 +1,229 @@
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+import orjson
+from fastapi.concurrency import run_in_threadpool
+
+from core.config import settings
+from models.story import Story
+from schemas.story import CompleteStoryNodeResponse, CompleteStoryResponse
+
+logger = logging.getLogger(__name__)
+
+
+def build_complete_story_response(
+    story: Story, nodes: Iterable[Dict[str, Any]], is_complete: bool = True
+) -> CompleteStoryResponse:
+    """
+    Build the /complete payload model from node rows (dicts with the
+    story_nodes columns and their options). The read and write paths use
+    serialize_complete_story; this stays as the reference for its output.
+    """
+    node_dict = {}
+    root_id = None
+    for node in nodes:
+        node_dict[node["id"]] = CompleteStoryNodeResponse(
+            id=node["id"],
+            content=node["content"],
+            is_ending=node["is_ending"],
+            is_winning_ending=node["is_winning_ending"],
+            options=node["options"] or []
+        )
+        if node["is_root"]:
+            root_id = node["id"]
+
+    if root_id is None:
+        raise ValueError("Story root node not found")
+
+    return CompleteStoryResponse(
+        id=story.id,
+        title=story.title,
+        session_id=story.session_id,
+        created_at=story.created_at,
+        root_node=node_dict[root_id],
+        all_nodes=node_dict,
+        is_complete=is_complete,
+        mode=story.mode or "full"
+    )
+
+
+# 与 pydantic 的 model_dump_json 输出一致：整数键转为字符串，UTC 时间以 Z 结尾
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_UTC_Z
+
+
+def dump_json(data: Any) -> bytes:
+    return orjson.dumps(data, option=ORJSON_OPTIONS)
+
+
+def node_payload(node: Dict[str, Any]) -> Dict[str, Any]:
+    """A node row as a CompleteStoryNodeResponse dict, fields in schema order."""
+    return {
+        "content": node["content"],
+        "is_ending": node["is_ending"],
+        "is_winning_ending": node["is_winning_ending"],
+        "id": node["id"],
+        # 选项已是 {"text", "node_id"} 的顺序
+        "options": node["options"] or [],
+    }
+
+
+def serialize_complete_story(story: Story, nodes: Iterable[Dict[str, Any]], is_complete: bool = True) -> bytes:
+    """
+    The same bytes as ``build_complete_story_response(...).model_dump_json()``
+    without building a model per node. tests/test_story_serialization.py
+    keeps the two in step.
+    """
+    node_dict = {}
+    root = None
+    for node in nodes:
+        payload = node_payload(node)
+        node_dict[node["id"]] = payload
+        if node["is_root"]:
+            root = payload
+
+    if root is None:
+        raise ValueError("Story root node not found")
+
+    return dump_json({
+        "title": story.title,
+        "session_id": story.session_id,
+        "id": story.id,
+        "created_at": story.created_at,
+        "root_node": root,
+        "all_nodes": node_dict,
+        "is_complete": is_complete,
+        "mode": story.mode or "full",
+    })
+
+
+def make_etag(payload: bytes) -> str:
+    return '"' + hashlib.sha256(payload).hexdigest()[:32] + '"'
+
+
+class _RedisLayer:
+    """Optional shared layer in front of the database, used when REDIS_URL is set."""
+
+    def __init__(self, url: str, ttl: int) -> None:
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(story_id: int) -> str:
+        return f"story:complete:{story_id}"
+
+    def get(self, story_id: int) -> Optional[bytes]:
+        return self.client.get(self._key(story_id))
+
+    def set(self, story_id: int, payload: bytes) -> None:
+        self.client.set(self._key(story_id), payload, ex=self.ttl)
+
+    def delete(self, story_id: int) -> None:
+        self.client.delete(self._key(story_id))
+
+
+class StoryCache:
+    """
+    Serialized CompleteStoryResponse bytes keyed by story id.
+
+    An in-process LRU bounded by total payload size sits in front of an
+    optional Redis layer. Lookups that miss both fall back to the
+    ``stories.tree_json`` column.
+    """
+
+    def __init__(self, max_bytes: int, redis_url: Optional[str] = None, redis_ttl: int = 86400) -> None:
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[int, Tuple[bytes, str]]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._redis: Optional[_RedisLayer] = None
+        if redis_url:
+            try:
+                self._redis = _RedisLayer(redis_url, redis_ttl)
+            except ImportError:
+                logger.warning("REDIS_URL is set but the redis package is not installed; using the local cache only")
+
+    def _put_local(self, story_id: int, entry: Tuple[bytes, str]) -> None:
+        with self._lock:
+            old = self._entries.pop(story_id, None)
+            if old is not None:
+                self._size -= len(old[0])
+            if len(entry[0]) > self.max_bytes:
+                return
+            self._entries[story_id] = entry
+            self._size += len(entry[0])
+            while self._size > self.max_bytes:
+                _, (payload, _) = self._entries.popitem(last=False)
+                self._size -= len(payload)
+
+    def get(self, story_id: int) -> Optional[Tuple[bytes, str]]:
+        """Return ``(payload, etag)`` or None."""
+        with self._lock:
+            entry = self._entries.get(story_id)
+            if entry is not None:
+                self._entries.move_to_end(story_id)
+                return entry
+
+        if self._redis is not None:
+            try:
+                payload = self._redis.get(story_id)
+            except Exception as e:
+                logger.warning(f"Redis story cache get failed: {str(e)}")
+                payload = None
+            if payload is not None:
+                entry = (payload, make_etag(payload))
+                self._put_local(story_id, entry)
+                return entry
+        return None
+
+    def set(self, story_id: int, payload: bytes) -> Tuple[bytes, str]:
+        entry = (payload, make_etag(payload))
+        self._put_local(story_id, entry)
+        if self._redis is not None:
+            try:
+                self._redis.set(story_id, payload)
+            except Exception as e:
+                logger.warning(f"Redis story cache set failed: {str(e)}")
+        return entry
+
+    async def aget(self, story_id: int) -> Optional[Tuple[bytes, str]]:
+        """``get`` for async routes: only a Redis lookup is moved to the threadpool."""
+        with self._lock:
+            entry = self._entries.get(story_id)
+            if entry is not None:
+                self._entries.move_to_end(story_id)
+                return entry
+        if self._redis is None:
+            return None
+        return await run_in_threadpool(self.get, story_id)
+
+    async def aset(self, story_id: int, payload: bytes) -> Tuple[bytes, str]:
+        if self._redis is None:
+            return self.set(story_id, payload)
+        return await run_in_threadpool(self.set, story_id, payload)
+
+    def invalidate(self, story_id: int) -> None:
+        with self._lock:
+            old = self._entries.pop(story_id, None)
+            if old is not None:
+                self._size -= len(old[0])
+        if self._redis is not None:
+            try:
+                self._redis.delete(story_id)
+            except Exception as e:
+                logger.warning(f"Redis story cache delete failed: {str(e)}")
+
+
+story_cache = StoryCache(
+    max_bytes=settings.STORY_CACHE_MAX_BYTES,
+    redis_url=settings.REDIS_URL,
+    redis_ttl=settings.STORY_CACHE_REDIS_TTL,
+)
+
+
+def get_story_cache() -> StoryCache:
+    return story_cache
@@ -0,0 +1,202 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+
+from core.config import settings
+from core.metrics import PERSIST_DURATION
+from core.models import StoryNodeStubLLM
+from core.story_cache import get_story_cache
+from core.story_generator import StoryGenerator
+from core.story_graph import edge_rows, insert_edges, load_node_options, path_to_node
+from db.database import SessionLocal
+from models.story import Story, StoryEdge, StoryNode
+from schemas.story import CompleteStoryNodeResponse
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ExpandContext:
+    """What the ``node`` prompt needs to write the child behind one option."""
+
+    title: str
+    path: List[Tuple[str, str]]
+    choice: str
+    depth: int
+
+
+def _node_response(node: StoryNode, options: List[dict]) -> CompleteStoryNodeResponse:
+    return CompleteStoryNodeResponse(
+        id=node.id,
+        content=node.content,
+        is_ending=node.is_ending,
+        is_winning_ending=node.is_winning_ending,
+        options=options,
+    )
+
+
+def _load_node_response(db: Session, node_id: int) -> CompleteStoryNodeResponse:
+    node = db.query(StoryNode).filter(StoryNode.id == node_id).first()
+    return _node_response(node, load_node_options(db, node_id))
+
+
+def load_expand_context(db: Session, story_id: int, node_id: int, option_index: int):
+    """
+    Return the existing child if the option was already expanded, otherwise
+    the ExpandContext for generating it.
+    """
+    story = db.query(Story).filter(Story.id == story_id).first()
+    if not story:
+        raise LookupError("Story not found")
+    if story.mode != "lazy":
+        raise ValueError("Only lazy stories can be expanded")
+
+    node = db.query(StoryNode).filter(StoryNode.id == node_id, StoryNode.story_id == story_id).first()
+    if node is None:
+        raise LookupError("Story node not found")
+    edge = None if node.is_ending else db.query(StoryEdge).filter(
+        StoryEdge.parent_id == node_id, StoryEdge.position == option_index
+    ).first()
+    if edge is None:
+        raise ValueError("Invalid option index")
+
+    if edge.child_id is not None:
+        return _load_node_response(db, edge.child_id)
+
+    path = path_to_node(db, node_id)
+    path[-1] = (path[-1][0], edge.text)
+    return ExpandContext(title=story.title, path=path, choice=edge.text, depth=len(path) + 1)
+
+
+def save_expanded_node(
+    db: Session, story_id: int, node_id: int, option_index: int, generated: StoryNodeStubLLM
+) -> CompleteStoryNodeResponse:
+    """Insert the generated child and link it, unless another writer linked one first."""
+    child = StoryNode(
+        story_id=story_id,
+        content=generated.content,
+        is_root=False,
+        is_ending=generated.isEnding,
+        is_winning_ending=generated.isWinningEnding,
+    )
+    db.add(child)
+    db.flush()
+
+    # 只有选项仍未链接时才写入；被其他写入者抢先时放弃本次生成的节点
+    linked = db.execute(
+        update(StoryEdge)
+        .where(
+            StoryEdge.parent_id == node_id,
+            StoryEdge.position == option_index,
+            StoryEdge.child_id.is_(None),
+        )
+        .values(child_id=child.id)
+    ).rowcount
+    if linked != 1:
+        db.rollback()
+        child_id = db.query(StoryEdge.child_id).filter(
+            StoryEdge.parent_id == node_id, StoryEdge.position == option_index
+        ).scalar()
+        return _load_node_response(db, child_id)
+
+    options = StoryGenerator._stub_options(generated)
+    insert_edges(db, edge_rows(story_id, child.id, options))
+    db.commit()
+
+    get_story_cache().invalidate(story_id)
+    return _node_response(child, options)
+
+
+def _run_sync(func, *args):
+    db = SessionLocal()
+    try:
+        return func(db, *args)
+    finally:
+        db.close()
+
+
+class NodeExpander:
+    """
+    Generates the children of lazy stories on demand.
+
+    Concurrent requests for the same option share one generation, and the
+    edge is only linked if it is still empty so replicas don't link two
+    different children. Optionally the options of each new
+    node are generated ahead of time in the background.
+    """
+
+    def __init__(self, prefetch_options: int, prefetch_concurrency: int) -> None:
+        self.prefetch_options = prefetch_options
+        self.prefetch_concurrency = prefetch_concurrency
+        self._inflight: Dict[Tuple[int, int], asyncio.Future] = {}
+        self._prefetch_tasks: Set[asyncio.Task] = set()
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    async def expand(
+        self, story_id: int, node_id: int, option_index: int, prefetch: Optional[bool] = None
+    ) -> CompleteStoryNodeResponse:
+        key = (node_id, option_index)
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._expand(story_id, node_id, option_index))
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+
+        # shield：一个请求断开不会取消其他请求共享的生成
+        child = await asyncio.shield(future)
+
+        if prefetch is None:
+            prefetch = self.prefetch_options > 0
+        if prefetch:
+            self.schedule_prefetch(story_id, child.id, [
+                index for index, option in enumerate(child.options) if option.node_id is None
+            ])
+        return child
+
+    async def _expand(self, story_id: int, node_id: int, option_index: int) -> CompleteStoryNodeResponse:
+        context = await run_in_threadpool(_run_sync, load_expand_context, story_id, node_id, option_index)
+        if isinstance(context, CompleteStoryNodeResponse):
+            return context
+
+        generated = await StoryGenerator.agenerate_node(
+            context.title, context.path, context.choice, context.depth, settings.LAZY_MAX_DEPTH
+        )
+        with PERSIST_DURATION.labels("node").time():
+            return await run_in_threadpool(_run_sync, save_expanded_node, story_id, node_id, option_index, generated)
+
+    def schedule_prefetch(self, story_id: int, node_id: int, option_indexes: Iterable[int]) -> None:
+        """Expand the first ``prefetch_options`` (all if 0) of ``option_indexes`` in the background."""
+        for option_index in list(option_indexes)[:self.prefetch_options or None]:
+            task = asyncio.create_task(self._prefetch(story_id, node_id, option_index))
+            self._prefetch_tasks.add(task)
+            task.add_done_callback(self._prefetch_tasks.discard)
+
+    async def _prefetch(self, story_id: int, node_id: int, option_index: int) -> None:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.prefetch_concurrency)
+        async with self._semaphore:
+            try:
+                await self.expand(story_id, node_id, option_index, prefetch=False)
+            except Exception as e:
+                logger.warning(f"Failed to prefetch option {option_index} of node {node_id}: {str(e)}")
+
+    async def stop(self) -> None:
+        tasks = list(self._prefetch_tasks) + list(self._inflight.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+node_expander = NodeExpander(
+    prefetch_options=settings.LAZY_PREFETCH_OPTIONS,
+    prefetch_concurrency=settings.LAZY_PREFETCH_CONCURRENCY,
+)
+
+
+def get_node_expander() -> NodeExpander:
+    return node_expander
@@ -1,26 +1,57 @@
+from sqlalchemy import func, insert, select, text
 from sqlalchemy.orm import Session
+from fastapi.concurrency import run_in_threadpool
 from langchain_core.language_models import LLM
-from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.outputs import GenerationChunk
 from langchain_core.runnables import RunnablePassthrough
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import PydanticOutputParser
 from core.prompts import STORY_PROMPT
 from models.story import Story, StoryNode
-from core.models import StoryNodeLLM, StoryLLMResponse, StoryLLMRequest
-from typing import Any, Dict, List, Optional
+from core.models import StoryNodeLLM, StoryLLMResponse, StoryLLMRequest, LazyStoryLLMResponse, StoryNodeStubLLM
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple, Union
+import asyncio
+import logging
 import requests
 import json
 
+from core.config import settings
+from core.llm_client import get_llm_client, LLMServiceError
+from core.metrics import PARSE_DURATION, PERSIST_DURATION, REPAIR_BRANCHES, STORY_REPAIRS, StageTimer
+from core.story_cache import get_story_cache, serialize_complete_story
+from core.story_graph import edge_rows, insert_edges
+from core.story_stream import BranchHole, StoryTreeStreamWriter
+
 from dotenv import load_dotenv
 load_dotenv()
 
+logger = logging.getLogger(__name__)
 
-# 定义服务A的URL
-SERVICE_A_URL = "http://localhost:8001/api/qwen3/generate"
 
-class RemoteLLM(LLM):
+def _read_sse_line(line: str, event: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+    """Return the current event name and the text piece carried by ``line``, if any."""
+    if not line:
+        return None, None
+    if line.startswith("event:"):
+        return line[len("event:"):].strip(), None
+    if line.startswith("data:"):
+        data = json.loads(line[len("data:"):])
+        if event == "error":
+            raise LLMServiceError(f"Error calling LLM service: {data.get('detail')}")
+        if event is None:
+            return event, data["text"]
+    return event, None
+
+
+def _llm_payload(prompt: str, task: Optional[str] = None) -> Dict[str, Any]:
+    payload: Dict[str, Any] = {"prompt": prompt, "constrained": settings.LLM_CONSTRAINED_DECODING}
+    if task is not None:
+        payload["task"] = task
+    return payload
 
-    service_url: str
+
+class RemoteLLM(LLM):
 
     def _llm_type(self) -> str:
         return "remote_llm"
@@ -32,27 +63,60 @@ class RemoteLLM(LLM):
         run_manager: Optional[CallbackManagerForLLMRun] = None,
         **kwargs: Any,
     ) -> str:
-        try:
-            messages = {"prompt": prompt}
+        data = get_llm_client().post(_llm_payload(prompt))
+        return StoryLLMRequest(**data).model_dump_json()
 
-            response = requests.post(self.service_url, json=messages)
-            # print(f"LLM---1{ StoryLLMRequest(**response.json())}")
-            if response.status_code == 200:
-                response = StoryLLMRequest(**response.json(), esure_ascii=False)
+    async def _acall(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        data = await get_llm_client().apost(_llm_payload(prompt))
+        return StoryLLMRequest(**data).model_dump_json()
+
+    def _stream(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[GenerationChunk]:
+        with get_llm_client().stream(_llm_payload(prompt)) as response:
+            event = None
+            for line in response.iter_lines():
+                event, text = _read_sse_line(line, event)
+                if text is not None:
+                    chunk = GenerationChunk(text=text)
+                    if run_manager:
+                        run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+                    yield chunk
+
+    async def _astream(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[GenerationChunk]:
+        async with get_llm_client().astream(_llm_payload(prompt)) as response:
+            event = None
+            async for line in response.aiter_lines():
+                event, text = _read_sse_line(line, event)
+                if text is not None:
+                    chunk = GenerationChunk(text=text)
+                    if run_manager:
+                        await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+                    yield chunk
 
-                return response.model_dump_json()
-            else:
-                raise Exception(f"Error calling LLM service: {response.status_code}")
-        except Exception as e:
-            raise Exception(f"Error calling LLM service: {str(e)}")
-        
 class CustomLLM:
     def __init__(self, service_url):
         self.service_url = service_url
 
     def __call__(self, prompt: str) -> str:
         response = requests.post(self.service_url, json={"prompt": prompt})
-        print(f"LLM---2{response.json()}")
+        logger.debug("LLM service response", extra={"status_code": response.status_code})
         if response.status_code == 200:
             return response.json()
         else:
@@ -68,13 +132,10 @@ class StoryGenerator:
     def _get_llm(cls) -> RemoteLLM:
         # 初始化自定义LLM
         
-        return RemoteLLM(service_url=SERVICE_A_URL)
+        return RemoteLLM()
     
     @classmethod
-    def generate_story(cls, db: Session, session_id: str, theme: str = "fantasy") -> Story:
-        llm = cls._get_llm()
-        story_parser = PydanticOutputParser(pydantic_object=StoryLLMResponse)
-        resquest_parser = PydanticOutputParser(pydantic_object=StoryLLMRequest)
+    def _build_prompt(cls, theme: str) -> ChatPromptTemplate:
         # prompt = ChatPromptTemplate.from_messages([
         #     (
         #         "system",
@@ -86,13 +147,20 @@ class StoryGenerator:
         #     )
         # ]).partial(from_instructions=story_parser.get_format_instructions())
         # prompt = f"Generate a story with the theme: {theme}"
-        prompt = ChatPromptTemplate.from_messages([
+        return ChatPromptTemplate.from_messages([
             (
                 "human",
                 f"Generate a story with the theme: {theme}"
             )
         ])
-        print("LLM")
+
+    @classmethod
+    def generate_story(cls, db: Session, session_id: str, theme: str = "fantasy") -> Story:
+        llm = cls._get_llm()
+        story_parser = PydanticOutputParser(pydantic_object=StoryLLMResponse)
+        resquest_parser = PydanticOutputParser(pydantic_object=StoryLLMRequest)
+        prompt = cls._build_prompt(theme)
+        logger.info("Generating story", extra={"theme": theme})
         chain = (
             {"theme": RunnablePassthrough(),
              "format_instructions": lambda _: story_parser.get_format_instructions()
@@ -106,52 +174,345 @@ class StoryGenerator:
         if hasattr(raw_response, "answer"):
             response_text = raw_response.answer
 
-        story_structure = story_parser.parse(response_text)
-        print(story_parser)
+        return cls.save_story_text(db, session_id, response_text)
+
+    @classmethod
+    async def agenerate_story(
+        cls,
+        db: Session,
+        session_id: str,
+        theme: str = "fantasy",
+        on_story_created: Optional[Callable[[Story], None]] = None,
+    ) -> Story:
+        """
+        Stream the answer from the LLM service and persist story nodes while it
+        arrives. ``on_story_created`` runs (in a worker thread) once the story
+        row and its root node are committed, before the rest is generated.
+        """
+        llm = cls._get_llm()
+        prompt_value = cls._build_prompt(theme).invoke({})
+        writer = cls.stream_writer(db, session_id, on_story_created)
+        # 解析与写库穿插在流式生成中，分别累计后在结束时记录一次
+        parse_timer, persist_timer = StageTimer(), StageTimer()
+
+        try:
+            try:
+                async for piece in llm.astream(prompt_value):
+                    with parse_timer.time():
+                        writer.feed(piece)
+                    if writer.should_flush():
+                        with persist_timer.time():
+                            await run_in_threadpool(writer.flush)
+            except ValueError as e:
+                # 格式错误或某个分支校验失败：停止读取，保留已解析的部分交给修复阶段
+                if not settings.STORY_REPAIR_ENABLED:
+                    raise
+                logger.warning(f"Story answer is malformed, repairing: {str(e)}")
+
+            if writer.complete or not settings.STORY_REPAIR_ENABLED:
+                with persist_timer.time():
+                    story = await run_in_threadpool(writer.finish)
+            else:
+                story = await cls.arepair_story(writer)
+        except BaseException:
+            await run_in_threadpool(writer.abort)
+            raise
+
+        PARSE_DURATION.labels("full").observe(parse_timer.seconds)
+        PERSIST_DURATION.labels("full").observe(persist_timer.seconds)
+        return story
+
+    @classmethod
+    def stream_writer(
+        cls, db: Session, session_id: str, on_story_created: Optional[Callable[[Story], None]] = None
+    ) -> StoryTreeStreamWriter:
+        return StoryTreeStreamWriter(
+            db, session_id,
+            flush_interval=settings.STORY_STREAM_FLUSH_INTERVAL,
+            on_story_created=on_story_created,
+        )
+
+    @classmethod
+    def stream_story_text(cls, theme: str = "fantasy") -> Iterator[str]:
+        """Yield the raw model answer piece by piece as the LLM service produces it."""
+        llm = cls._get_llm()
+        prompt_value = cls._build_prompt(theme).invoke({})
+        for piece in llm.stream(prompt_value):
+            yield piece
+
+    @classmethod
+    async def _acomplete(cls, prompt: str, task: str) -> str:
+        """Call the LLM service for one of its non-default tasks and return the answer text."""
+        data = await get_llm_client().apost(_llm_payload(prompt, task))
+        return StoryLLMRequest(**data).answer
+
+    @classmethod
+    async def agenerate_lazy_story(cls, db: Session, session_id: str, theme: str = "fantasy") -> Story:
+        """Generate only the root node and its option texts; children are written by expand_node."""
+        answer = await cls._acomplete(f"Generate a story with the theme: {theme}", "lazy_story")
+        with PARSE_DURATION.labels("lazy").time():
+            story_structure = PydanticOutputParser(pydantic_object=LazyStoryLLMResponse).parse(answer)
+
+        with PERSIST_DURATION.labels("lazy").time():
+            return await run_in_threadpool(cls.save_lazy_story, db, session_id, story_structure)
 
-        story_db = Story(title=story_structure.title, session_id=session_id)
+    @classmethod
+    def save_lazy_story(cls, db: Session, session_id: str, story_structure: LazyStoryLLMResponse) -> Story:
+        story_db = Story(title=story_structure.title, session_id=session_id, mode="lazy")
         db.add(story_db)
         db.flush()
 
-        root_node_data = story_structure.rootNode
-        if isinstance(root_node_data, dict):
-            root_node_data = StoryNodeLLM.model_validate(root_node_data)
-
-        cls._process_story_node(db, story_db.id, root_node_data, is_root=True)
+        root = story_structure.rootNode
+        root_db = StoryNode(
+            story_id=story_db.id,
+            content=root.content,
+            is_root=True,
+            is_ending=root.isEnding,
+            is_winning_ending=root.isWinningEnding,
+        )
+        db.add(root_db)
+        db.flush()
 
+        insert_edges(db, edge_rows(story_db.id, root_db.id, cls._stub_options(root)))
         db.commit()
         return story_db
-    
 
     @classmethod
-    def _process_story_node(cls, db: Session, story_id: int, node_data: StoryNodeLLM, is_root: bool = False) -> StoryNode:
-        node = StoryNode(
-            story_id=story_id,
-            content=node_data.content if hasattr(node_data, "content") else node_data["content"],
-            is_root=is_root,
-            is_ending=node_data.isEnding if hasattr(node_data, "isEnding") else node_data["isEnding"],
-            is_winning_ending=node_data.isWinningEnding if hasattr(node_data, "isWinningEnding") else node_data["isWinningEnding"],
-            options=[]
+    def _stub_options(cls, node: StoryNodeStubLLM) -> List[Dict[str, Any]]:
+        # node_id 为空表示该分支尚未生成
+        if node.isEnding or not node.options:
+            return []
+        return [{"text": option.text, "node_id": None} for option in node.options]
+
+    @classmethod
+    def _story_so_far(cls, title: str, path: List[Tuple[str, str]]) -> List[str]:
+        lines = [f"Story title: {title}", "", "Story so far:"]
+        for index, (content, chosen) in enumerate(path, start=1):
+            lines.append(f"{index}. {content}")
+            lines.append(f"   The player chose: {chosen}")
+        lines.append("")
+        return lines
+
+    @classmethod
+    def build_node_prompt(cls, title: str, path: List[Tuple[str, str]], choice: str, depth: int, max_depth: int) -> str:
+        """User message for the ``node`` task: the scenes so far and the choice made at each of them."""
+        lines = cls._story_so_far(title, path)
+        lines.append(f"Write scene {depth}, which follows the choice: {choice}")
+        if depth >= max_depth:
+            lines.append("No more choices are allowed: this scene must be an ending.")
+        return "\n".join(lines)
+
+    @classmethod
+    def build_branch_prompt(cls, title: str, path: List[Tuple[str, str]], choice: str, depth: int, max_depth: int) -> str:
+        """User message for the ``branch`` task: like ``node``, but the whole subtree behind the choice."""
+        lines = cls._story_so_far(title, path)
+        lines.append(f"Write the rest of this branch, starting with scene {depth}, which follows the choice: {choice}")
+        if depth >= max_depth:
+            lines.append("No more choices are allowed: this scene must be an ending.")
+        else:
+            lines.append(f"The branch may be at most {max_depth - depth + 1} scenes deep, including scene {depth}.")
+        return "\n".join(lines)
+
+    @classmethod
+    async def agenerate_node(
+        cls, title: str, path: List[Tuple[str, str]], choice: str, depth: int, max_depth: int
+    ) -> StoryNodeStubLLM:
+        answer = await cls._acomplete(cls.build_node_prompt(title, path, choice, depth, max_depth), "node")
+        with PARSE_DURATION.labels("node").time():
+            node = PydanticOutputParser(pydantic_object=StoryNodeStubLLM).parse(answer)
+        if depth >= max_depth and not node.isEnding:
+            node.isEnding = True
+            node.options = None
+        return node
+
+    @classmethod
+    def _parse_branch(cls, answer: str, depth: int) -> StoryNodeLLM:
+        with PARSE_DURATION.labels("branch").time():
+            node = PydanticOutputParser(pydantic_object=StoryNodeLLM).parse(answer)
+        if depth >= settings.STORY_MAX_DEPTH and not node.isEnding:
+            node.isEnding = True
+            node.options = None
+        return node
+
+    @classmethod
+    def generate_branch(cls, title: str, hole: BranchHole) -> StoryNodeLLM:
+        prompt = cls.build_branch_prompt(title, hole.path, hole.choice, hole.depth, settings.STORY_MAX_DEPTH)
+        data = get_llm_client().post(_llm_payload(prompt, "branch"))
+        return cls._parse_branch(StoryLLMRequest(**data).answer, hole.depth)
+
+    @classmethod
+    async def agenerate_branch(cls, title: str, hole: BranchHole) -> StoryNodeLLM:
+        prompt = cls.build_branch_prompt(title, hole.path, hole.choice, hole.depth, settings.STORY_MAX_DEPTH)
+        return cls._parse_branch(await cls._acomplete(prompt, "branch"), hole.depth)
+
+    @classmethod
+    def _check_holes(cls, holes: List[BranchHole]) -> None:
+        REPAIR_BRANCHES.observe(len(holes))
+        if len(holes) > settings.STORY_REPAIR_MAX_BRANCHES:
+            raise ValueError(f"Story answer has {len(holes)} broken branches, too many to repair")
+        logger.info(
+            "Repairing story",
+            extra={"branches": len(holes), "depths": [hole.depth for hole in holes]},
         )
-        db.add(node)
-        db.flush()
 
-        if not node.is_ending and (hasattr(node_data, "options") and node_data.options):
-            options_list = []
-            for option_data in node_data.options:
-                next_node = option_data.nextNode
+    @classmethod
+    def _attach_branches(
+        cls, writer: StoryTreeStreamWriter, holes: List[BranchHole], branches: List[StoryNodeLLM]
+    ) -> Story:
+        with PERSIST_DURATION.labels("branch").time():
+            for hole, branch in zip(holes, branches):
+                writer.attach(hole, cls._flatten_story_tree(branch))
+            return writer.finish()
+
+    @classmethod
+    async def arepair_story(cls, writer: StoryTreeStreamWriter) -> Story:
+        """
+        Finish a story whose answer was cut off or broke a branch: keep every
+        node written so far and regenerate only the missing branches, each
+        from its path through the story.
+        """
+        try:
+            holes = await run_in_threadpool(writer.holes)
+            cls._check_holes(holes)
+            branches = await asyncio.gather(*(cls.agenerate_branch(writer.title, hole) for hole in holes))
+            story = await run_in_threadpool(cls._attach_branches, writer, holes, branches)
+        except Exception:
+            STORY_REPAIRS.labels("failed").inc()
+            raise
+        STORY_REPAIRS.labels("repaired").inc()
+        return story
 
-                if isinstance(next_node, dict):
-                    next_node = StoryNodeLLM.model_validate(next_node)
+    @classmethod
+    def repair_story(cls, writer: StoryTreeStreamWriter) -> Story:
+        """``arepair_story`` outside the event loop; the branches are generated one after another."""
+        try:
+            # 逐节点校验能读到结尾（例如只是 JSON 后面多了文字）时没有需要重写的分支
+            holes = [] if writer.complete else writer.holes()
+            cls._check_holes(holes)
+            branches = [cls.generate_branch(writer.title, hole) for hole in holes]
+            story = cls._attach_branches(writer, holes, branches)
+        except Exception:
+            STORY_REPAIRS.labels("failed").inc()
+            raise
+        STORY_REPAIRS.labels("repaired").inc()
+        return story
 
-                child_node = cls._process_story_node(db, story_id, next_node, False)
+    @classmethod
+    def repair_story_text(cls, db: Session, session_id: str, response_text: str) -> Story:
+        """``arepair_story`` for a complete answer that failed to parse."""
+        writer = cls.stream_writer(db, session_id)
+        try:
+            try:
+                writer.feed(response_text)
+            except ValueError:
+                pass
+            return cls.repair_story(writer)
+        except BaseException:
+            writer.abort()
+            raise
 
-                options_list.append({
-                    "text": option_data.text,
-                    "node_id": child_node.id
-                })
+    @classmethod
+    def save_story_text(cls, db: Session, session_id: str, response_text: str) -> Story:
+        story_parser = PydanticOutputParser(pydantic_object=StoryLLMResponse)
+        try:
+            with PARSE_DURATION.labels("full").time():
+                story_structure = story_parser.parse(response_text)
+                # 解析器会补全被截断的 JSON，嵌套节点要在写库前逐个校验
+                node_rows = cls._flatten_story_tree(story_structure.rootNode)
+        except ValueError as e:
+            if not settings.STORY_REPAIR_ENABLED:
+                raise
+            logger.warning(f"Story answer is malformed, repairing: {str(e)}")
+            return cls.repair_story_text(db, session_id, response_text)
 
-            node.options = options_list
+        with PERSIST_DURATION.labels("full").time():
+            return cls._save_story_structure(db, session_id, story_structure.title, node_rows)
 
+    @classmethod
+    def _save_story_structure(
+        cls, db: Session, session_id: str, title: str, node_rows: List[Dict[str, Any]]
+    ) -> Story:
+        story_db = Story(title=title, session_id=session_id)
+        db.add(story_db)
         db.flush()
-        return node
\ No newline at end of file
+
+        cls._persist_story_tree(db, story_db.id, node_rows)
+
+        # 故事生成后不再变化，提交时一并保存序列化好的完整故事
+        payload = serialize_complete_story(story_db, node_rows)
+        story_db.tree_json = payload.decode("utf-8")
+
+        db.commit()
+        get_story_cache().set(story_db.id, payload)
+        return story_db
+    
+
+    @classmethod
+    def _reserve_node_ids(cls, db: Session, count: int) -> List[int]:
+        """Reserve a block of story_nodes ids in one round trip."""
+        if db.get_bind().dialect.name == "postgresql":
+            return list(db.execute(
+                text("SELECT nextval(pg_get_serial_sequence('story_nodes', 'id')) FROM generate_series(1, :n)"),
+                {"n": count}
+            ).scalars())
+
+        # SQLite 没有序列；本事务已写入 stories 表并持有写锁，max(id) 不会被并发修改
+        start = db.execute(select(func.coalesce(func.max(StoryNode.id), 0))).scalar() + 1
+        return list(range(start, start + count))
+
+    @classmethod
+    def _flatten_story_tree(cls, root_node_data: Union[StoryNodeLLM, Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Walk the LLM tree iteratively in pre-order, validating every node.
+        Children are referenced by their position in the returned list until
+        real ids are assigned.
+        """
+        rows = []
+        stack = [(root_node_data, None, None)]
+        while stack:
+            node_data, parent_index, option_text = stack.pop()
+            if isinstance(node_data, dict):
+                node_data = StoryNodeLLM.model_validate(node_data)
+
+            index = len(rows)
+            rows.append({
+                "content": node_data.content,
+                "is_root": parent_index is None,
+                "is_ending": node_data.isEnding,
+                "is_winning_ending": node_data.isWinningEnding,
+                "options": [],
+            })
+            if parent_index is not None:
+                rows[parent_index]["options"].append({"text": option_text, "node_id": index})
+
+            if not node_data.isEnding:
+                # 截断后被补全的 JSON 会留下没有选项的非结局节点
+                if not node_data.options:
+                    raise ValueError("Story node is not an ending but has no options")
+                # 逆序入栈，出栈时保持选项的原始顺序
+                for option_data in reversed(node_data.options):
+                    stack.append((option_data.nextNode, index, option_data.text))
+        return rows
+
+    @classmethod
+    def _persist_story_tree(cls, db: Session, story_id: int, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Insert every node and then every edge of the flattened tree, one
+        executemany each; returns the node rows (with their options) in
+        pre-order.
+        """
+        node_ids = cls._reserve_node_ids(db, len(rows))
+
+        edges = []
+        for row, node_id in zip(rows, node_ids):
+            row["id"] = node_id
+            row["story_id"] = story_id
+            for option in row["options"]:
+                option["node_id"] = node_ids[option["node_id"]]
+            edges.extend(edge_rows(story_id, node_id, row["options"]))
+
+        db.execute(insert(StoryNode), [
+            {key: value for key, value in row.items() if key != "options"} for row in rows
+        ])
+        insert_edges(db, edges)
+        return rows
@@ -0,0 +1,152 @@
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import insert, literal, select
+from sqlalchemy.orm import Session, aliased
+
+from models.story import StoryEdge, StoryNode
+
+
+def edge_rows(story_id: int, parent_id: int, options: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """story_edges rows for a node's ``[{"text", "node_id"}]`` options, in order."""
+    return [
+        {
+            "story_id": story_id,
+            "parent_id": parent_id,
+            "position": position,
+            "child_id": option["node_id"],
+            "text": option["text"],
+        }
+        for position, option in enumerate(options)
+    ]
+
+
+def insert_edges(db: Session, rows: List[Dict[str, Any]]) -> None:
+    if rows:
+        db.execute(insert(StoryEdge), rows)
+
+
+def load_options(db: Session, *criteria) -> Dict[int, List[Dict[str, Any]]]:
+    """Options of the parents matching ``criteria``, as ``{parent_id: [{"text", "node_id"}]}``."""
+    options: Dict[int, List[Dict[str, Any]]] = defaultdict(list)
+    for parent_id, text, child_id in db.query(
+        StoryEdge.parent_id, StoryEdge.text, StoryEdge.child_id
+    ).filter(*criteria).order_by(StoryEdge.parent_id, StoryEdge.position):
+        options[parent_id].append({"text": text, "node_id": child_id})
+    return options
+
+
+def load_node_options(db: Session, node_id: int) -> List[Dict[str, Any]]:
+    return load_options(db, StoryEdge.parent_id == node_id).get(node_id, [])
+
+
+def _with_options(nodes, options: Dict[int, List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    rows = []
+    for node in nodes:
+        row = node._asdict()
+        row["options"] = options.get(node.id, [])
+        rows.append(row)
+    return rows
+
+
+def load_story_nodes(db: Session, story_id: int) -> List[Dict[str, Any]]:
+    """Node rows of a story with their options attached, in id order."""
+    options = load_options(db, StoryEdge.story_id == story_id)
+    nodes = db.query(
+        StoryNode.id, StoryNode.content, StoryNode.is_root, StoryNode.is_ending, StoryNode.is_winning_ending
+    ).filter(StoryNode.story_id == story_id).order_by(StoryNode.id)
+
+    return _with_options(nodes, options)
+
+
+def load_subtree(db: Session, story_id: int, node_id: int, depth: int) -> List[Dict[str, Any]]:
+    """
+    ``node_id`` and its descendants down to ``depth`` levels below it, with
+    their options, in breadth-first order. Empty if the node is not part of
+    the story.
+    """
+    edge = aliased(StoryEdge)
+    subtree = select(
+        StoryNode.id.label("node_id"), literal(0).label("depth")
+    ).where(StoryNode.id == node_id, StoryNode.story_id == story_id).cte("subtree", recursive=True)
+    subtree = subtree.union_all(
+        select(edge.child_id, subtree.c.depth + 1)
+        .where(edge.parent_id == subtree.c.node_id, edge.child_id.isnot(None), subtree.c.depth < depth)
+    )
+
+    nodes = db.execute(
+        select(
+            StoryNode.id, StoryNode.content, StoryNode.is_root, StoryNode.is_ending, StoryNode.is_winning_ending
+        ).join(subtree, StoryNode.id == subtree.c.node_id).order_by(subtree.c.depth, StoryNode.id)
+    ).all()
+    if not nodes:
+        return []
+
+    options = load_options(db, StoryEdge.parent_id.in_([node.id for node in nodes]))
+    return _with_options(nodes, options)
+
+
+def load_outline(db: Session, story_id: int) -> Tuple[List[Tuple[int, int, Optional[int]]], Dict[int, bool]]:
+    """
+    The structure of a story without any text: ``(parent_id, position,
+    child_id)`` for every edge, and ``{node_id: is_winning_ending}`` for
+    every ending.
+    """
+    edges = [
+        (parent_id, position, child_id) for parent_id, position, child_id in db.query(
+            StoryEdge.parent_id, StoryEdge.position, StoryEdge.child_id
+        ).filter(StoryEdge.story_id == story_id).order_by(StoryEdge.parent_id, StoryEdge.position)
+    ]
+    endings = {
+        node_id: bool(is_winning_ending) for node_id, is_winning_ending in db.query(
+            StoryNode.id, StoryNode.is_winning_ending
+        ).filter(StoryNode.story_id == story_id, StoryNode.is_ending == True)
+    }
+    return edges, endings
+
+
+def path_to_node(db: Session, node_id: int) -> List[Tuple[str, Optional[str]]]:
+    """
+    ``(content, chosen option text)`` of every node from the root down to
+    ``node_id``, found with a recursive CTE walking the edges upwards. The
+    last entry is ``node_id`` itself with no choice.
+    """
+    edge = aliased(StoryEdge)
+    ancestors = select(
+        StoryEdge.parent_id.label("node_id"), StoryEdge.text.label("choice"), literal(1).label("depth")
+    ).where(StoryEdge.child_id == node_id).cte("ancestors", recursive=True)
+    ancestors = ancestors.union_all(
+        select(edge.parent_id, edge.text, ancestors.c.depth + 1).where(edge.child_id == ancestors.c.node_id)
+    )
+
+    path = [
+        (content, choice) for content, choice in db.execute(
+            select(StoryNode.content, ancestors.c.choice)
+            .join(ancestors, StoryNode.id == ancestors.c.node_id)
+            .order_by(ancestors.c.depth.desc())
+        )
+    ]
+    content = db.query(StoryNode.content).filter(StoryNode.id == node_id).scalar()
+    path.append((content, None))
+    return path
+
+
+def winning_endings(db: Session, story_id: int) -> List[Tuple[int, int]]:
+    """``(node_id, depth)`` of every winning ending reachable from the root, shallowest first."""
+    edge = aliased(StoryEdge)
+    reachable = select(
+        StoryNode.id.label("node_id"), literal(0).label("depth")
+    ).where(StoryNode.story_id == story_id, StoryNode.is_root == True).cte("reachable", recursive=True)
+    reachable = reachable.union_all(
+        select(edge.child_id, reachable.c.depth + 1)
+        .where(edge.parent_id == reachable.c.node_id, edge.child_id.isnot(None))
+    )
+
+    return [
+        (node_id, depth) for node_id, depth in db.execute(
+            select(StoryNode.id, reachable.c.depth)
+            .join(reachable, StoryNode.id == reachable.c.node_id)
+            .where(StoryNode.is_winning_ending == True)
+            .order_by(reachable.c.depth, StoryNode.id)
+        )
+    ]
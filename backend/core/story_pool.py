@@ -0,0 +1,231 @@
+import asyncio
+import logging
+import threading
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import func, update
+from sqlalchemy.orm import Session
+
+from core.config import settings
+from core.job_queue import get_job_queue
+from core.metrics import POOL_CLAIMS
+from core.story_cache import serialize_complete_story
+from core.story_graph import load_story_nodes
+from core.theme_cache import job_priority, normalize_theme, theme_cache_key
+from db.database import SessionLocal
+from models.job import StoryJob
+from models.story import Story
+
+logger = logging.getLogger(__name__)
+
+POOL_SESSION_ID = "story-pool"
+
+
+def claim_pooled_story(db: Session, theme_key: str, session_id: str) -> Optional[int]:
+    """
+    Take one ready story of ``theme_key`` out of the inventory for ``session_id``.
+    The update is left uncommitted so it lands together with the caller's job row.
+    The stored ``tree_json`` is serialized again for the new owner.
+    """
+    for _ in range(3):
+        story_id = db.query(Story.id).filter(
+            Story.theme_key == theme_key, Story.is_pooled == True
+        ).order_by(Story.id).with_for_update(skip_locked=True).limit(1).scalar()
+        if story_id is None:
+            return None
+
+        result = db.execute(
+            update(Story)
+            .where(Story.id == story_id, Story.is_pooled == True)
+            .values(is_pooled=False, session_id=session_id)
+        )
+        if result.rowcount == 1:
+            # 生成时序列化的响应里是库存的 session_id
+            story = db.query(Story).filter(Story.id == story_id).populate_existing().one()
+            payload = serialize_complete_story(story, load_story_nodes(db, story_id))
+            story.tree_json = payload.decode("utf-8")
+            return story_id
+        # SQLite 没有行锁，被其他请求抢先领取时重试
+        db.rollback()
+    return None
+
+
+class StoryPool:
+    """
+    Keeps an inventory of finished stories for a fixed set of popular themes.
+
+    The filler enqueues low-priority ``purpose="pool"`` jobs, so pool stories
+    are only generated when the workers have nothing better to do. A theme
+    that drops below ``low`` is refilled up to ``high``. Nothing is enqueued
+    while more than ``max_pending`` player jobs are waiting, and a theme whose
+    pool job just failed is left alone for ``failure_backoff`` seconds.
+    """
+
+    def __init__(
+        self,
+        themes: List[str],
+        low: int,
+        high: int,
+        concurrency: int,
+        max_pending: int,
+        interval: float,
+        failure_backoff: float,
+    ) -> None:
+        self.themes = {normalize_theme(theme): theme for theme in themes}
+        self.low = low
+        self.high = max(high, low)
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self.interval = interval
+        self.failure_backoff = failure_backoff
+        self._filling: Dict[str, bool] = defaultdict(bool)
+        self._hits: Dict[str, int] = defaultdict(int)
+        self._misses: Dict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def covers(self, theme: str) -> bool:
+        return normalize_theme(theme) in self.themes
+
+    def record(self, theme: str, hit: bool) -> None:
+        with self._lock:
+            counter = self._hits if hit else self._misses
+            counter[normalize_theme(theme)] += 1
+        POOL_CLAIMS.labels("hit" if hit else "miss").inc()
+
+    async def start(self) -> None:
+        if self.themes:
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"Story pool filler started for {len(self.themes)} themes")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await run_in_threadpool(self._fill_with_session)
+            except Exception as e:
+                logger.error(f"Story pool filler error: {str(e)}")
+            await asyncio.sleep(self.interval)
+
+    def _fill_with_session(self) -> List[str]:
+        db = SessionLocal()
+        try:
+            return self.fill(db)
+        finally:
+            db.close()
+
+    def _ready(self, db: Session) -> Dict[str, int]:
+        """Pooled stories waiting for a player, per normalized theme."""
+        keys = {theme_cache_key(theme): name for name, theme in self.themes.items()}
+        ready: Dict[str, int] = defaultdict(int)
+        for theme_key, count in db.query(Story.theme_key, func.count(Story.id)).filter(
+            Story.is_pooled == True, Story.theme_key.in_(keys)
+        ).group_by(Story.theme_key):
+            ready[keys[theme_key]] += count
+        return ready
+
+    def _in_flight(self, db: Session) -> Dict[str, int]:
+        """Pending and processing pool jobs, per normalized theme."""
+        in_flight: Dict[str, int] = defaultdict(int)
+        for theme, count in db.query(StoryJob.theme, func.count(StoryJob.id)).filter(
+            StoryJob.purpose == "pool", StoryJob.status.in_(("pending", "processing"))
+        ).group_by(StoryJob.theme):
+            in_flight[normalize_theme(theme)] += count
+        return in_flight
+
+    def fill(self, db: Session) -> List[str]:
+        """Enqueue pool jobs for themes below their watermark; returns the new job ids."""
+        backlog = db.query(func.count(StoryJob.id)).filter(
+            StoryJob.status == "pending",
+            func.coalesce(StoryJob.purpose, "player") != "pool",
+            StoryJob.coalesced_into.is_(None),
+        ).scalar()
+        if backlog > self.max_pending:
+            return []
+
+        in_flight = db.query(func.count(StoryJob.id)).filter(
+            StoryJob.purpose == "pool", StoryJob.status.in_(("pending", "processing"))
+        ).scalar()
+        budget = self.concurrency - in_flight
+
+        failed_since = datetime.now() - timedelta(seconds=self.failure_backoff)
+        failing = {normalize_theme(theme) for theme, in db.query(StoryJob.theme).filter(
+            StoryJob.purpose == "pool", StoryJob.status == "failed", StoryJob.completed_at >= failed_since
+        ).distinct()}
+
+        ready, in_flight_by_theme = self._ready(db), self._in_flight(db)
+        jobs = []
+        for name, theme in self.themes.items():
+            if name in failing:
+                continue
+            # 进行中的任务也计入水位，避免重复补充
+            level = ready[name] + in_flight_by_theme[name]
+            if level >= self.high:
+                self._filling[name] = False
+            elif level < self.low:
+                self._filling[name] = True
+            if not self._filling[name]:
+                continue
+
+            for _ in range(min(self.high - level, budget)):
+                jobs.append(StoryJob(
+                    job_id=str(uuid.uuid4()),
+                    session_id=POOL_SESSION_ID,
+                    theme=theme,
+                    purpose="pool",
+                    priority=job_priority(purpose="pool"),
+                    status="pending",
+                ))
+                budget -= 1
+
+        if jobs:
+            db.add_all(jobs)
+            db.commit()
+            for job in jobs:
+                get_job_queue().enqueue(job.job_id, job.priority)
+        return [job.job_id for job in jobs]
+
+    def stats(self, db: Session) -> dict:
+        ready, in_flight = self._ready(db), self._in_flight(db)
+        themes = {}
+        with self._lock:
+            for name in self.themes:
+                hits, misses = self._hits[name], self._misses[name]
+                themes[name] = {
+                    "ready": ready[name],
+                    "in_flight": in_flight[name],
+                    "hits": hits,
+                    "misses": misses,
+                    "hit_rate": hits / (hits + misses) if hits + misses else None,
+                }
+            hits, misses = sum(self._hits.values()), sum(self._misses.values())
+        return {
+            "themes": themes,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else None,
+        }
+
+
+story_pool = StoryPool(
+    themes=settings.POOL_THEMES if settings.POOL_ENABLED else [],
+    low=settings.POOL_LOW_WATERMARK,
+    high=settings.POOL_HIGH_WATERMARK,
+    concurrency=settings.POOL_CONCURRENCY,
+    max_pending=settings.POOL_MAX_PENDING_JOBS,
+    interval=settings.POOL_CHECK_INTERVAL,
+    failure_backoff=settings.POOL_FAILURE_BACKOFF,
+)
+
+
+def get_story_pool() -> StoryPool:
+    return story_pool
@@ -0,0 +1,528 @@
+import json
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+
+from core.models import StoryNodeLLM, StoryOptionLLM
+from core.story_cache import get_story_cache, serialize_complete_story
+from core.story_graph import edge_rows, insert_edges, load_story_nodes
+from models.story import Story, StoryEdge, StoryNode
+
+_WHITESPACE = " \t\r\n"
+_DECODER = json.JSONDecoder(strict=False)
+NODE_FIELDS = ("content", "isEnding", "isWinningEnding")
+
+Path = Tuple[Any, ...]
+
+
+class JsonEventParser:
+    """
+    Incremental JSON tokenizer that reports values as they complete instead of
+    building the document.
+
+    ``handler`` receives ``start_object(path)``, ``end_object(path)`` and
+    ``scalar(path, value)`` calls, where ``path`` is the tuple of keys and
+    array indexes leading to the value. Text before the first ``{`` (e.g. a
+    ```json fence) and after the top-level object is ignored. Only the token
+    currently being read is buffered.
+    """
+
+    def __init__(self, handler) -> None:
+        self.handler = handler
+        self.started = False
+        self.done = False
+        # 每层容器：[类型, 状态]；_path 与其一一对应，保存当前键或下标
+        self._stack: List[list] = []
+        self._path: list = []
+        self._token: Optional[str] = None
+        self._buf: List[str] = []
+        self._escaped = False
+        self._is_key = False
+
+    @property
+    def path(self) -> Path:
+        return tuple(self._path)
+
+    def feed(self, text: str) -> None:
+        i, n = 0, len(text)
+        while i < n and not self.done:
+            if self._token == "string":
+                i = self._read_string(text, i)
+                continue
+
+            ch = text[i]
+            if self._token is not None:
+                if ch.isalnum() or ch in "+-.":
+                    self._buf.append(ch)
+                    i += 1
+                    continue
+                self._end_primitive()
+
+            if not self.started:
+                if ch == "{":
+                    self.started = True
+                    self._start_value(ch)
+            elif ch not in _WHITESPACE:
+                self._consume(ch)
+            i += 1
+
+    def _read_string(self, text: str, i: int) -> int:
+        n = len(text)
+        while i < n:
+            if self._escaped:
+                self._buf.append(text[i])
+                self._escaped = False
+                i += 1
+                continue
+            quote = text.find('"', i)
+            backslash = text.find("\\", i, quote if quote >= 0 else n)
+            if backslash >= 0:
+                self._buf.append(text[i:backslash + 1])
+                self._escaped = True
+                i = backslash + 1
+            elif quote >= 0:
+                self._buf.append(text[i:quote])
+                self._end_string()
+                return quote + 1
+            else:
+                self._buf.append(text[i:])
+                return n
+        return n
+
+    def _end_string(self) -> None:
+        value = _DECODER.decode('"' + "".join(self._buf) + '"')
+        self._token, self._buf = None, []
+        if self._is_key:
+            self._is_key = False
+            self._path[-1] = value
+            self._stack[-1][1] = "colon"
+        else:
+            self._value_done(value, scalar=True)
+
+    def _end_primitive(self) -> None:
+        raw = "".join(self._buf)
+        self._token, self._buf = None, []
+        try:
+            value = _DECODER.decode(raw)
+        except ValueError:
+            raise ValueError(f"Invalid JSON value {raw!r} at {self.path}")
+        self._value_done(value, scalar=True)
+
+    def _start_value(self, ch: str) -> None:
+        if ch == "{":
+            self.handler.start_object(self.path)
+            self._stack.append(["object", "key_or_end"])
+            self._path.append(None)
+        elif ch == "[":
+            self._stack.append(["array", "value_or_end"])
+            self._path.append(0)
+        elif ch == '"':
+            self._token = "string"
+        elif ch == "-" or ch.isalnum():
+            self._token = "primitive"
+            self._buf.append(ch)
+        else:
+            raise ValueError(f"Unexpected {ch!r} in JSON at {self.path}")
+
+    def _value_done(self, value: Any, scalar: bool) -> None:
+        if scalar:
+            self.handler.scalar(self.path, value)
+        if self._stack:
+            self._stack[-1][1] = "comma_or_end"
+        else:
+            self.done = True
+
+    def _consume(self, ch: str) -> None:
+        if not self._stack:
+            raise ValueError(f"Unexpected {ch!r} after JSON document")
+        frame = self._stack[-1]
+        kind, state = frame
+
+        if state == "comma_or_end":
+            if ch == ",":
+                if kind == "object":
+                    frame[1] = "key"
+                else:
+                    self._path[-1] += 1
+                    frame[1] = "value"
+                return
+            if ch == ("}" if kind == "object" else "]"):
+                self._close()
+                return
+        elif state in ("key_or_end", "key"):
+            if ch == '"':
+                self._token = "string"
+                self._is_key = True
+                return
+            if ch == "}" and state == "key_or_end":
+                self._close()
+                return
+        elif state == "colon":
+            if ch == ":":
+                frame[1] = "value"
+                return
+        elif state in ("value", "value_or_end"):
+            if ch == "]" and state == "value_or_end":
+                self._close()
+                return
+            self._start_value(ch)
+            return
+        raise ValueError(f"Unexpected {ch!r} in JSON at {self.path}")
+
+    def _close(self) -> None:
+        kind, _ = self._stack.pop()
+        self._path.pop()
+        if kind == "object":
+            self.handler.end_object(self.path)
+        self._value_done(None, scalar=False)
+
+
+class _StreamOption:
+    __slots__ = ("text", "node")
+
+    def __init__(self) -> None:
+        self.text: Optional[str] = None
+        self.node: Optional["_StreamNode"] = None
+
+
+class _StreamNode:
+    __slots__ = (
+        "path", "parent", "fields", "content", "options", "is_ending", "ready", "queued", "dropped", "closed", "id"
+    )
+
+    def __init__(self, path: Path, parent: Optional["_StreamNode"]) -> None:
+        self.path = path
+        self.parent = parent
+        self.fields: Optional[dict] = {}
+        # 写入后 fields 被释放，内容留作修复分支时的上下文
+        self.content: Optional[str] = None
+        self.options: List[_StreamOption] = []
+        self.is_ending = False
+        self.ready = False
+        self.queued = False
+        self.dropped = False
+        # 对象已闭合且校验通过，整棵子树完整
+        self.closed = False
+        self.id: Optional[int] = None
+
+
+@dataclass
+class BranchHole:
+    """
+    A missing or broken branch: the child behind option ``position`` of
+    ``parent``. ``path`` holds the scenes above it with the choice made at
+    each one, the last being ``choice``; ``replace`` is a node already
+    written there that has to be replaced.
+    """
+
+    parent: _StreamNode
+    position: int
+    choice: str
+    path: List[Tuple[str, str]]
+    replace: Optional[_StreamNode] = None
+
+    @property
+    def depth(self) -> int:
+        return len(self.path) + 1
+
+
+class StoryTreeStreamWriter:
+    """
+    Persists a story while the model answer is still streaming in.
+
+    A node is inserted as soon as its content and ending flags are known and
+    its edge from the parent once it has an id and the option text, so the root and
+    the first choices become playable long before the last branch is
+    written. A node's fields are validated against StoryNodeLLM when they
+    are complete and its options when its object closes. The story stays
+    ``is_complete=False`` (and uncached) until ``finish``.
+
+    When the answer is truncated or malformed, ``holes`` lists the branches
+    that are missing below the nodes kept so far and ``attach`` writes
+    regenerated ones in their place, so the story can still be finished.
+    """
+
+    def __init__(
+        self,
+        db: Session,
+        session_id: str,
+        flush_interval: float = 0.5,
+        on_story_created: Optional[Callable[[Story], None]] = None,
+    ) -> None:
+        self.db = db
+        self.session_id = session_id
+        self.flush_interval = flush_interval
+        self.on_story_created = on_story_created
+        self.story: Optional[Story] = None
+        self.title: Optional[str] = None
+        self.root: Optional[_StreamNode] = None
+        self._parser = JsonEventParser(self)
+        self._nodes: List[_StreamNode] = []
+        self._pending: List[_StreamNode] = []
+        # 已写入但还没有写入父节点选项（边）的节点
+        self._unlinked: List[_StreamNode] = []
+        self._last_flush = time.monotonic()
+        self._salvaged = False
+
+    # JsonEventParser 回调
+
+    def _is_node_path(self, path: Path) -> bool:
+        if path == ("rootNode",):
+            return not self._nodes
+        return (
+            bool(self._nodes) and len(path) >= 3 and path[-1] == "nextNode"
+            and path[-3] == "options" and path[:-3] == self._nodes[-1].path
+        )
+
+    def start_object(self, path: Path) -> None:
+        if self._is_node_path(path):
+            parent = self._nodes[-1] if self._nodes else None
+            node = _StreamNode(path, parent)
+            if parent is None:
+                self.root = node
+            else:
+                parent.options[path[-2]].node = node
+            self._nodes.append(node)
+        elif self._nodes and len(path) >= 2 and path[-2] == "options" and path[:-2] == self._nodes[-1].path:
+            options = self._nodes[-1].options
+            if path[-1] != len(options):
+                raise ValueError("Story options must be objects")
+            options.append(_StreamOption())
+
+    def scalar(self, path: Path, value: Any) -> None:
+        if path == ("title",):
+            self.title = value
+        elif not self._nodes:
+            return
+        elif path[:-1] == self._nodes[-1].path and path[-1] in NODE_FIELDS:
+            node = self._nodes[-1]
+            node.fields[path[-1]] = value
+            if not node.ready and all(field in node.fields for field in NODE_FIELDS):
+                self._node_ready(node)
+        elif len(path) >= 3 and path[-1] == "text" and path[-3] == "options" and path[:-3] == self._nodes[-1].path:
+            node = self._nodes[-1]
+            node.options[path[-2]].text = value
+
+    def end_object(self, path: Path) -> None:
+        if not self._nodes or path != self._nodes[-1].path:
+            return
+        node = self._nodes.pop()
+        if not node.ready:
+            self._node_ready(node)
+        # 子节点在各自闭合时已校验，这里只校验本节点的选项
+        for option in node.options:
+            if option.node is None:
+                raise ValueError("Story option is missing its nextNode")
+            StoryOptionLLM.model_validate({"text": option.text, "nextNode": {}})
+        if not node.is_ending and not node.options:
+            # 与 _flatten_story_tree 一致；节点保持未闭合，holes 会把它整体替换
+            raise ValueError("Story node is not an ending but has no options")
+        node.closed = True
+
+    # 写入
+
+    def _node_ready(self, node: _StreamNode) -> None:
+        validated = StoryNodeLLM.model_validate(node.fields)
+        node.fields = {
+            "content": validated.content,
+            "isEnding": validated.isEnding,
+            "isWinningEnding": validated.isWinningEnding,
+        }
+        node.content = validated.content
+        node.is_ending = validated.isEnding
+        node.ready = True
+        if node.parent is None or node.parent.queued:
+            self._queue(node)
+
+    def _queue(self, node: _StreamNode) -> None:
+        """Queue ``node`` and any already-ready descendants in pre-order."""
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            parent = node.parent
+            if parent is not None and (parent.dropped or parent.is_ending):
+                # 与整体解析一致：结局节点的选项被忽略
+                node.dropped = True
+            else:
+                node.queued = True
+                self._pending.append(node)
+            for option in reversed(node.options):
+                if option.node is not None and option.node.ready:
+                    stack.append(option.node)
+
+    def feed(self, text: str) -> None:
+        self._parser.feed(text)
+
+    @property
+    def complete(self) -> bool:
+        return self._parser.done
+
+    def should_flush(self) -> bool:
+        return bool(self._pending or self._unlinked) and time.monotonic() - self._last_flush >= self.flush_interval
+
+    def flush(self) -> None:
+        """Write queued nodes and their edges in one transaction and commit."""
+        self._last_flush = time.monotonic()
+        created = False
+        if self.story is None:
+            if self.title is None or not self._pending:
+                return
+            self.story = Story(title=self.title, session_id=self.session_id, is_complete=False)
+            self.db.add(self.story)
+            self.db.flush()
+            created = True
+
+        if self._pending:
+            pending, self._pending = self._pending, []
+            node_ids = self.db.execute(
+                insert(StoryNode).returning(StoryNode.id, sort_by_parameter_order=True),
+                [
+                    {
+                        "story_id": self.story.id,
+                        "content": node.fields["content"],
+                        "is_root": node.parent is None,
+                        "is_ending": node.fields["isEnding"],
+                        "is_winning_ending": node.fields["isWinningEnding"],
+                    }
+                    for node in pending
+                ]
+            ).scalars().all()
+            for node, node_id in zip(pending, node_ids):
+                node.id = node_id
+                node.fields = None
+                if node.parent is not None:
+                    self._unlinked.append(node)
+
+        edges, unlinked = [], []
+        for node in self._unlinked:
+            position = node.path[-2]
+            text = node.parent.options[position].text
+            if text is None:
+                # 选项文本在 nextNode 之后才出现
+                unlinked.append(node)
+                continue
+            edges.append({
+                "story_id": self.story.id,
+                "parent_id": node.parent.id,
+                "position": position,
+                "child_id": node.id,
+                "text": text,
+            })
+        self._unlinked = unlinked
+        insert_edges(self.db, edges)
+
+        self.db.commit()
+        if created and self.on_story_created is not None:
+            self.on_story_created(self.story)
+
+    def holes(self) -> List[BranchHole]:
+        """
+        Write everything that is usable and list the branches still missing,
+        in pre-order. Complete subtrees are kept as they are; below a node
+        that was cut off, each option whose child never became valid is a
+        hole. A truncated trailing option without its text is dropped, and a
+        node left with no options at all is replaced as a whole.
+        """
+        if self.title is None or self.root is None or not self.root.ready:
+            raise ValueError("Story JSON was cut off before its title and root node")
+        self.flush()
+
+        holes = []
+        stack: List[Tuple[_StreamNode, List[Tuple[str, str]]]] = [(self.root, [])]
+        while stack:
+            node, path = stack.pop()
+            if node.closed or node.is_ending:
+                continue
+
+            options = list(node.options)
+            if options and not isinstance(options[-1].text, str) and options[-1].node is None:
+                options.pop()
+            if any(not isinstance(option.text, str) for option in options):
+                raise ValueError("Story option without text cannot be repaired")
+            if not options:
+                if node.parent is None:
+                    raise ValueError("Story root node was cut off before its options")
+                holes.append(BranchHole(node.parent, node.path[-2], path[-1][1], path, replace=node))
+                continue
+
+            children = []
+            for position, option in enumerate(options):
+                child_path = path + [(node.content, option.text)]
+                if option.node is None or not option.node.ready:
+                    holes.append(BranchHole(node, position, option.text, child_path))
+                else:
+                    children.append((option.node, child_path))
+            stack.extend(reversed(children))
+
+        self._salvaged = True
+        return holes
+
+    def attach(self, hole: BranchHole, rows: List[Dict[str, Any]]) -> None:
+        """
+        Insert a regenerated branch, given as pre-order node rows whose
+        options reference children by row index, and link it to the hole.
+        """
+        if hole.replace is not None and hole.replace.id is not None:
+            self.db.query(StoryEdge).filter(StoryEdge.child_id == hole.replace.id).delete(synchronize_session=False)
+            self.db.query(StoryNode).filter(StoryNode.id == hole.replace.id).delete(synchronize_session=False)
+
+        node_ids = self.db.execute(
+            insert(StoryNode).returning(StoryNode.id, sort_by_parameter_order=True),
+            [
+                {
+                    "story_id": self.story.id,
+                    "content": row["content"],
+                    "is_root": False,
+                    "is_ending": row["is_ending"],
+                    "is_winning_ending": row["is_winning_ending"],
+                }
+                for row in rows
+            ]
+        ).scalars().all()
+
+        edges = [{
+            "story_id": self.story.id,
+            "parent_id": hole.parent.id,
+            "position": hole.position,
+            "child_id": node_ids[0],
+            "text": hole.choice,
+        }]
+        for row, node_id in zip(rows, node_ids):
+            options = [{"text": option["text"], "node_id": node_ids[option["node_id"]]} for option in row["options"]]
+            edges.extend(edge_rows(self.story.id, node_id, options))
+        insert_edges(self.db, edges)
+
+    def finish(self) -> Story:
+        """
+        Flush the rest once the stream has ended and publish the completed
+        story; after ``holes`` the missing branches must have been attached.
+        """
+        if not self._parser.done and not self._salvaged:
+            raise ValueError("Story JSON ended before it was complete")
+        if self.title is None or self.root is None:
+            raise ValueError("Story JSON has no title or rootNode")
+        self.flush()
+
+        nodes = load_story_nodes(self.db, self.story.id)
+        payload = serialize_complete_story(self.story, nodes)
+        self.story.tree_json = payload.decode("utf-8")
+        self.story.is_complete = True
+        self.db.commit()
+        get_story_cache().set(self.story.id, payload)
+        return self.story
+
+    def abort(self) -> None:
+        """Remove whatever was written for a story whose generation failed."""
+        self.db.rollback()
+        if self.story is None:
+            return
+        story_id = self.story.id
+        self.db.query(StoryEdge).filter(StoryEdge.story_id == story_id).delete(synchronize_session=False)
+        self.db.query(StoryNode).filter(StoryNode.story_id == story_id).delete(synchronize_session=False)
+        self.db.query(Story).filter(Story.id == story_id).delete(synchronize_session=False)
+        self.db.commit()
+        get_story_cache().invalidate(story_id)
+        self.story = None
@@ -0,0 +1,153 @@
+import random
+import re
+import uuid
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from core.config import settings
+from core.job_events import get_job_event_bus
+from core.story_cache import get_story_cache
+from models.job import StoryJob
+from models.story import Story
+
+INFLIGHT_STATUSES = ("pending", "processing")
+FINAL_STATUSES = ("completed", "failed")
+
+
+def normalize_theme(theme: str) -> str:
+    """Case, surrounding punctuation and repeated whitespace don't make a different theme."""
+    theme = re.sub(r"\s+", " ", theme.strip().lower())
+    return theme.strip(" .,!?;:\"'")
+
+
+def theme_cache_key(theme: str) -> str:
+    return f"{settings.LLM_MODEL_ID}:{settings.STORY_PROMPT_VERSION}:{normalize_theme(theme)}"
+
+
+def job_priority(mode: str = "full", purpose: str = "player") -> int:
+    if purpose == "pool":
+        return settings.JOB_PRIORITY_POOL
+    return settings.JOB_PRIORITY_LAZY if mode == "lazy" else settings.JOB_PRIORITY_FULL
+
+
+def find_cached_story_id(db: Session, theme_key: str) -> Optional[int]:
+    """Pick one of the stories kept for ``theme_key`` once the configured number exists."""
+    per_theme = settings.THEME_CACHE_STORIES_PER_THEME
+    if per_theme <= 0:
+        return None
+    story_ids = db.query(Story.id).filter(
+        Story.theme_key == theme_key, Story.is_complete.isnot(False), Story.is_pooled.isnot(True)
+    ).order_by(Story.id).limit(per_theme).all()
+    if len(story_ids) < per_theme:
+        return None
+    return random.choice(story_ids)[0]
+
+
+def find_inflight_job(db: Session, theme_key: str) -> Optional[StoryJob]:
+    return db.query(StoryJob).filter(
+        StoryJob.theme_key == theme_key,
+        StoryJob.coalesced_into.is_(None),
+        StoryJob.status.in_(INFLIGHT_STATUSES),
+    ).first()
+
+
+def create_story_job(db: Session, session_id: str, theme: str, mode: str = "full") -> StoryJob:
+    """
+    Create the job for a create_story request.
+
+    For full stories a ready story from the pre-generated pool is claimed
+    first (whether or not the theme cache is enabled), then the theme cache
+    is consulted: a kept story is returned as an already completed job, and
+    a request for a theme that is being generated right now becomes a
+    follower of that job instead of a second generation. Only jobs that come
+    back ``pending`` without ``coalesced_into`` need to be enqueued.
+    """
+    from core.story_pool import claim_pooled_story, get_story_pool
+
+    theme_key = theme_cache_key(theme)
+    pool = get_story_pool()
+    if mode == "full" and pool.covers(theme):
+        story_id = claim_pooled_story(db, theme_key, session_id)
+        pool.record(theme, hit=story_id is not None)
+        if story_id is not None:
+            job = StoryJob(
+                job_id=str(uuid.uuid4()), session_id=session_id, theme=theme, mode=mode,
+                theme_key=theme_key, status="completed", story_id=story_id, completed_at=datetime.now()
+            )
+            db.add(job)
+            db.commit()
+            # 缓存里可能还有领取前的响应
+            get_story_cache().invalidate(story_id)
+            return job
+
+    if mode != "full" or not settings.THEME_CACHE_ENABLED:
+        job = StoryJob(
+            job_id=str(uuid.uuid4()), session_id=session_id, theme=theme, mode=mode,
+            priority=job_priority(mode), status="pending"
+        )
+        db.add(job)
+        db.commit()
+        return job
+
+    for _ in range(3):
+        job = StoryJob(
+            job_id=str(uuid.uuid4()), session_id=session_id, theme=theme, mode=mode,
+            theme_key=theme_key, priority=job_priority(mode)
+        )
+
+        story_id = find_cached_story_id(db, theme_key)
+        leader = find_inflight_job(db, theme_key) if story_id is None else None
+        if story_id is not None:
+            job.status = "completed"
+            job.story_id = story_id
+            job.completed_at = datetime.now()
+        elif leader is not None:
+            job.status = "pending"
+            job.story_id = leader.story_id
+            job.coalesced_into = leader.job_id
+        else:
+            job.status = "pending"
+
+        db.add(job)
+        try:
+            db.commit()
+        except IntegrityError:
+            # 另一个请求刚刚为同一主题创建了进行中的任务，重新查找并合并到它
+            db.rollback()
+            continue
+
+        if leader is not None:
+            # 领头任务可能在合并前刚好结束
+            db.refresh(leader)
+            if leader.status in FINAL_STATUSES:
+                sync_followers(db, leader)
+                db.refresh(job)
+        return job
+
+    raise RuntimeError("Could not create story job")
+
+
+def sync_followers(db: Session, job: StoryJob) -> None:
+    """Copy the leader's story (and final status) to the jobs coalesced into it, then notify them."""
+    values = {"story_id": job.story_id}
+    if job.status in FINAL_STATUSES:
+        values.update(status=job.status, error=job.error, completed_at=job.completed_at)
+
+    follower_ids = [job_id for job_id, in db.query(StoryJob.job_id).filter(
+        StoryJob.coalesced_into == job.job_id, StoryJob.status.in_(INFLIGHT_STATUSES)
+    )]
+    if not follower_ids:
+        return
+
+    db.execute(
+        update(StoryJob)
+        .where(StoryJob.job_id.in_(follower_ids))
+        .values(**values)
+    )
+    db.commit()
+    for follower_id in follower_ids:
+        get_job_event_bus().publish(follower_id)
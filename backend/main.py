@@ -1,13 +1,38 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 from core.config import settings
-from routers import story, job
-from db.database import create_tables
+from core.log_context import configure_logging
+from routers import story, job, metrics
+from db.database import async_engine, create_tables
+from core.llm_client import get_llm_client
+from core.job_queue import get_job_queue
+from core.job_events import get_job_event_bus
+from core.story_expander import get_node_expander
+from core.story_pool import get_story_pool
 
+configure_logging(settings.LOG_LEVEL, settings.LOG_FORMAT)
 create_tables()
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await get_job_event_bus().start()
+    await get_job_queue().start()
+    await get_story_pool().start()
+    yield
+    await get_story_pool().stop()
+    await get_job_queue().stop()
+    await get_node_expander().stop()
+    await get_job_event_bus().stop()
+    # 关闭推理服务的连接池
+    await get_llm_client().aclose()
+    await async_engine.dispose()
+
+
 app = FastAPI(
+    lifespan=lifespan,
     title="Choose Your Own Adventure Game APII",
     description="api to generate cool stories",
     version="0.1.1",
@@ -25,6 +50,7 @@ app.add_middleware(
 
 app.include_router(story.router, prefix=settings.API_PREFIX)
 app.include_router(job.router, prefix=settings.API_PREFIX)
+app.include_router(metrics.router)
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,126 @@
+"""
+Schema migrations for databases created before a model change.
+
+Each module in ``migrations/versions`` is a revision in the style of
+Alembic: it defines ``revision``, ``down_revision`` and ``upgrade(conn)`` /
+``downgrade(conn)``. ``upgrade_database`` applies the revisions a database
+has not seen yet and records the current one in ``schema_version``. A new
+database is stamped at the head revision, since create_all builds the
+current schema anyway.
+
+Databases from before the first revision were created by create_all from
+whatever the models looked like at the time, so the revisions for those
+model changes check what is already there (``add_column``,
+``Index.create(checkfirst=True)``) instead of assuming the old schema.
+"""
+import importlib
+import logging
+import pkgutil
+from types import ModuleType
+from typing import Any, List, Optional
+
+from sqlalchemy import Column, MetaData, String, Table, delete, inspect, insert, select, text
+from sqlalchemy.engine import Connection, Engine
+
+logger = logging.getLogger(__name__)
+
+# 多个进程（API、worker）同时启动时，PostgreSQL 上用事务级咨询锁串行执行迁移
+_ADVISORY_LOCK_KEY = 7305141
+
+_metadata = MetaData()
+schema_version = Table("schema_version", _metadata, Column("revision", String, nullable=True))
+
+
+def load_revisions() -> List[ModuleType]:
+    """All revisions, oldest first, following the ``down_revision`` chain."""
+    modules = [
+        importlib.import_module(f"{__name__}.versions.{info.name}")
+        for info in pkgutil.iter_modules(importlib.import_module(f"{__name__}.versions").__path__)
+    ]
+    by_parent = {module.down_revision: module for module in modules}
+    if len(by_parent) != len(modules):
+        raise RuntimeError("Migration revisions branch; every down_revision must be unique")
+
+    ordered = []
+    parent = None
+    while parent in by_parent:
+        ordered.append(by_parent[parent])
+        parent = ordered[-1].revision
+    if len(ordered) != len(modules):
+        raise RuntimeError("Migration revisions do not form a single chain")
+    return ordered
+
+
+def add_column(conn: Connection, table: Table, name: str, backfill: Any = None) -> None:
+    """Add column ``name`` of ``table`` unless it exists and set it to ``backfill`` on the existing rows."""
+    if name in {column["name"] for column in inspect(conn).get_columns(table.name)}:
+        return
+    column = table.c[name]
+    column_type = column.type.compile(dialect=conn.dialect)
+    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {name} {column_type}"))
+    if backfill is not None:
+        conn.execute(table.update().values({name: backfill}))
+
+
+def drop_column(conn: Connection, table: Table, name: str) -> None:
+    # SQLite 不能删除带索引的列，调用方先删除索引
+    conn.execute(text(f"ALTER TABLE {table.name} DROP COLUMN {name}"))
+
+
+def _lock(conn: Connection) -> None:
+    if conn.dialect.name == "postgresql":
+        conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": _ADVISORY_LOCK_KEY})
+
+
+def _stamp(conn: Connection, revision: Optional[str]) -> None:
+    conn.execute(delete(schema_version))
+    conn.execute(insert(schema_version).values(revision=revision))
+
+
+def current_revision(conn: Connection) -> Optional[str]:
+    if not inspect(conn).has_table("schema_version"):
+        return None
+    return conn.execute(select(schema_version.c.revision)).scalar()
+
+
+def upgrade_database(engine: Engine) -> None:
+    revisions = load_revisions()
+    head = revisions[-1].revision if revisions else None
+
+    with engine.begin() as conn:
+        _lock(conn)
+        if not inspect(conn).has_table("schema_version"):
+            schema_version.create(conn)
+            if not inspect(conn).has_table("story_nodes"):
+                # 新数据库：由 create_all 直接创建最新的表结构
+                _stamp(conn, head)
+                return
+            # 引入迁移之前创建的数据库，从第一个版本开始升级
+            _stamp(conn, None)
+
+        current = current_revision(conn)
+        names = [module.revision for module in revisions]
+        if current is not None and current not in names:
+            raise RuntimeError(f"Database is at unknown migration revision {current}")
+        start = names.index(current) + 1 if current is not None else 0
+        for module in revisions[start:]:
+            logger.info(f"Applying migration {module.revision}")
+            module.upgrade(conn)
+            _stamp(conn, module.revision)
+
+
+def downgrade_database(engine: Engine, target: Optional[str]) -> None:
+    """Revert revisions newer than ``target`` (None reverts all of them)."""
+    revisions = load_revisions()
+    with engine.begin() as conn:
+        _lock(conn)
+        current = current_revision(conn)
+        for module in reversed(revisions):
+            if current is None or current == target:
+                break
+            if module.revision != current:
+                continue
+            logger.info(f"Reverting migration {module.revision}")
+            module.downgrade(conn)
+            current = module.down_revision
+            _stamp(conn, current)
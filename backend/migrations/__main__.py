@@ -0,0 +1,29 @@
+import argparse
+import logging
+
+from migrations import current_revision, downgrade_database
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Apply or revert database schema migrations")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("upgrade", help="apply all pending migrations and create missing tables")
+    downgrade = subparsers.add_parser("downgrade", help="revert migrations newer than a revision")
+    downgrade.add_argument("revision", nargs="?", default=None, help="revision to keep (default: revert all)")
+    subparsers.add_parser("current", help="print the current revision")
+    args = parser.parse_args()
+
+    import models.job, models.story  # noqa: F401  注册表结构供 create_all 使用
+    from db.database import create_tables, engine
+
+    if args.command == "upgrade":
+        create_tables()
+    elif args.command == "downgrade":
+        downgrade_database(engine, args.revision)
+    with engine.connect() as conn:
+        print(current_revision(conn))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
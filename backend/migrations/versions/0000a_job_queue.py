@@ -0,0 +1,36 @@
+"""
+Job queue columns on story_job: priority, attempts and locked_until, and an
+index on ``status`` for the workers' claim query.
+"""
+from sqlalchemy import Column, DateTime, Index, Integer, MetaData, String, Table
+from sqlalchemy.engine import Connection
+
+from migrations import add_column, drop_column
+
+revision = "0000a_job_queue"
+down_revision = None
+
+metadata = MetaData()
+story_job = Table(
+    "story_job",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("status", String),
+    Column("priority", Integer),
+    Column("attempts", Integer),
+    Column("locked_until", DateTime(timezone=True)),
+)
+status_index = Index("ix_story_job_status", story_job.c.status)
+
+
+def upgrade(conn: Connection) -> None:
+    add_column(conn, story_job, "priority", backfill=0)
+    add_column(conn, story_job, "attempts", backfill=0)
+    add_column(conn, story_job, "locked_until")
+    status_index.create(conn, checkfirst=True)
+
+
+def downgrade(conn: Connection) -> None:
+    status_index.drop(conn)
+    for name in ("locked_until", "attempts", "priority"):
+        drop_column(conn, story_job, name)
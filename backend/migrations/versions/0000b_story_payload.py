@@ -0,0 +1,27 @@
+"""
+Precomputed story payload: ``stories.tree_json``. Existing stories have
+none and are serialized from their nodes on the first read.
+"""
+from sqlalchemy import Column, Integer, MetaData, Table, Text
+from sqlalchemy.engine import Connection
+
+from migrations import add_column, drop_column
+
+revision = "0000b_story_payload"
+down_revision = "0000a_job_queue"
+
+metadata = MetaData()
+stories = Table(
+    "stories",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("tree_json", Text),
+)
+
+
+def upgrade(conn: Connection) -> None:
+    add_column(conn, stories, "tree_json")
+
+
+def downgrade(conn: Connection) -> None:
+    drop_column(conn, stories, "tree_json")
@@ -0,0 +1,27 @@
+"""
+Stories written while the model answer streams in: ``stories.is_complete``.
+Every existing story was written in one go and is complete.
+"""
+from sqlalchemy import Boolean, Column, Integer, MetaData, Table
+from sqlalchemy.engine import Connection
+
+from migrations import add_column, drop_column
+
+revision = "0000c_streamed_stories"
+down_revision = "0000b_story_payload"
+
+metadata = MetaData()
+stories = Table(
+    "stories",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("is_complete", Boolean),
+)
+
+
+def upgrade(conn: Connection) -> None:
+    add_column(conn, stories, "is_complete", backfill=True)
+
+
+def downgrade(conn: Connection) -> None:
+    drop_column(conn, stories, "is_complete")
@@ -0,0 +1,35 @@
+"""
+Lazy story mode: ``mode`` on story_job and stories. Existing jobs and
+stories are full trees.
+"""
+from sqlalchemy import Column, Integer, MetaData, String, Table
+from sqlalchemy.engine import Connection
+
+from migrations import add_column, drop_column
+
+revision = "0000d_lazy_stories"
+down_revision = "0000c_streamed_stories"
+
+metadata = MetaData()
+story_job = Table(
+    "story_job",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("mode", String),
+)
+stories = Table(
+    "stories",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("mode", String),
+)
+
+
+def upgrade(conn: Connection) -> None:
+    add_column(conn, story_job, "mode", backfill="full")
+    add_column(conn, stories, "mode", backfill="full")
+
+
+def downgrade(conn: Connection) -> None:
+    drop_column(conn, stories, "mode")
+    drop_column(conn, story_job, "mode")
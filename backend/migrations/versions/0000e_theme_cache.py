@@ -0,0 +1,61 @@
+"""
+Theme cache and job coalescing: ``theme_key`` on story_job and stories,
+``story_job.coalesced_into``, their indexes and the partial unique index
+allowing one in-flight job per theme key.
+"""
+from sqlalchemy import Column, Index, Integer, MetaData, String, Table, and_
+from sqlalchemy.engine import Connection
+
+from migrations import add_column, drop_column
+
+revision = "0000e_theme_cache"
+down_revision = "0000d_lazy_stories"
+
+metadata = MetaData()
+story_job = Table(
+    "story_job",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("status", String),
+    Column("theme_key", String),
+    Column("coalesced_into", String),
+)
+stories = Table(
+    "stories",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("theme_key", String),
+)
+inflight_where = and_(
+    story_job.c.theme_key.isnot(None),
+    story_job.c.coalesced_into.is_(None),
+    story_job.c.status.in_(("pending", "processing")),
+)
+indexes = [
+    Index("ix_story_job_theme_key", story_job.c.theme_key),
+    Index("ix_story_job_coalesced_into", story_job.c.coalesced_into),
+    Index(
+        "uq_story_job_inflight_theme_key",
+        story_job.c.theme_key,
+        unique=True,
+        postgresql_where=inflight_where,
+        sqlite_where=inflight_where,
+    ),
+    Index("ix_stories_theme_key", stories.c.theme_key),
+]
+
+
+def upgrade(conn: Connection) -> None:
+    add_column(conn, story_job, "theme_key")
+    add_column(conn, story_job, "coalesced_into")
+    add_column(conn, stories, "theme_key")
+    for index in indexes:
+        index.create(conn, checkfirst=True)
+
+
+def downgrade(conn: Connection) -> None:
+    for index in reversed(indexes):
+        index.drop(conn)
+    drop_column(conn, stories, "theme_key")
+    drop_column(conn, story_job, "coalesced_into")
+    drop_column(conn, story_job, "theme_key")
@@ -0,0 +1,39 @@
+"""
+Pre-generated story inventory: ``story_job.purpose`` and
+``stories.is_pooled`` with its index. Existing jobs were requested by
+players and no existing story is in the pool.
+"""
+from sqlalchemy import Boolean, Column, Index, Integer, MetaData, String, Table
+from sqlalchemy.engine import Connection
+
+from migrations import add_column, drop_column
+
+revision = "0000f_story_pool"
+down_revision = "0000e_theme_cache"
+
+metadata = MetaData()
+story_job = Table(
+    "story_job",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("purpose", String),
+)
+stories = Table(
+    "stories",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("is_pooled", Boolean),
+)
+pooled_index = Index("ix_stories_is_pooled", stories.c.is_pooled)
+
+
+def upgrade(conn: Connection) -> None:
+    add_column(conn, story_job, "purpose", backfill="player")
+    add_column(conn, stories, "is_pooled", backfill=False)
+    pooled_index.create(conn, checkfirst=True)
+
+
+def downgrade(conn: Connection) -> None:
+    pooled_index.drop(conn)
+    drop_column(conn, stories, "is_pooled")
+    drop_column(conn, story_job, "purpose")
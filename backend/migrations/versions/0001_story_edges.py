@@ -0,0 +1,100 @@
+"""
+Move story options into the story_edges table.
+
+Creates story_edges from the ``story_nodes.options`` JSON, drops that column
+and the index on ``story_nodes.content``, and adds the partial unique index
+on root nodes.
+"""
+from collections import defaultdict
+
+from sqlalchemy import JSON, Boolean, Column, ForeignKey, Index, Integer, MetaData, String, Table, select, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.sql.expression import bindparam
+
+revision = "0001_story_edges"
+down_revision = "0000f_story_pool"
+
+BATCH_SIZE = 1000
+
+metadata = MetaData()
+stories = Table("stories", metadata, Column("id", Integer, primary_key=True))
+story_nodes = Table(
+    "story_nodes",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("story_id", Integer),
+    Column("content", String),
+    Column("is_root", Boolean),
+    Column("options", JSON),
+)
+story_edges = Table(
+    "story_edges",
+    metadata,
+    Column("parent_id", Integer, ForeignKey("story_nodes.id"), primary_key=True),
+    Column("position", Integer, primary_key=True),
+    Column("story_id", Integer, ForeignKey("stories.id"), nullable=False),
+    Column("child_id", Integer, ForeignKey("story_nodes.id"), nullable=True),
+    Column("text", String, nullable=False),
+    Index("ix_story_edges_story_parent", "story_id", "parent_id", "position"),
+    Index("ix_story_edges_child", "child_id"),
+)
+root_index = Index(
+    "uq_story_nodes_root",
+    story_nodes.c.story_id,
+    unique=True,
+    postgresql_where=story_nodes.c.is_root == True,
+    sqlite_where=story_nodes.c.is_root == True,
+)
+content_index = Index("ix_story_nodes_content", story_nodes.c.content)
+
+
+def upgrade(conn: Connection) -> None:
+    story_edges.create(conn)
+
+    rows = []
+    for node_id, story_id, options in conn.execute(
+        select(story_nodes.c.id, story_nodes.c.story_id, story_nodes.c.options).order_by(story_nodes.c.id)
+    ):
+        for position, option in enumerate(options or []):
+            rows.append({
+                "story_id": story_id,
+                "parent_id": node_id,
+                "position": position,
+                "child_id": option.get("node_id"),
+                "text": option["text"],
+            })
+        if len(rows) >= BATCH_SIZE:
+            conn.execute(story_edges.insert(), rows)
+            rows = []
+    if rows:
+        conn.execute(story_edges.insert(), rows)
+
+    conn.execute(text("DROP INDEX IF EXISTS ix_story_nodes_content"))
+    root_index.create(conn)
+    conn.execute(text("ALTER TABLE story_nodes DROP COLUMN options"))
+
+
+def downgrade(conn: Connection) -> None:
+    options_type = JSON().compile(dialect=conn.dialect)
+    conn.execute(text(f"ALTER TABLE story_nodes ADD COLUMN options {options_type}"))
+
+    options = defaultdict(list)
+    for parent_id, child_id, option_text in conn.execute(
+        select(story_edges.c.parent_id, story_edges.c.child_id, story_edges.c.text)
+        .order_by(story_edges.c.parent_id, story_edges.c.position)
+    ):
+        options[parent_id].append({"text": option_text, "node_id": child_id})
+    if options:
+        conn.execute(
+            story_nodes.update()
+            .where(story_nodes.c.id == bindparam("node_id"))
+            .values(options=bindparam("node_options")),
+            [{"node_id": node_id, "node_options": node_options} for node_id, node_options in options.items()],
+        )
+    conn.execute(
+        story_nodes.update().where(story_nodes.c.options.is_(None)).values(options=[])
+    )
+
+    root_index.drop(conn)
+    content_index.create(conn)
+    story_edges.drop(conn)
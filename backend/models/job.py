@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, DateTime, JSON
+from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, DateTime, JSON, Index, and_
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 
@@ -12,8 +12,32 @@ class StoryJob(Base):
     job_id = Column(String, index=True, unique=True)
     session_id = Column(String, index=True)
     theme = Column(String)
-    status = Column(String)
+    mode = Column(String, default="full")
+    # player：玩家请求；pool：为预生成库存生成，优先级最低
+    purpose = Column(String, default="player")
+    # 主题缓存键；非空时同一键同一时间只有一个进行中的生成任务
+    theme_key = Column(String, nullable=True, index=True)
+    # 合并到的进行中任务的 job_id，此任务自身不会被执行
+    coalesced_into = Column(String, nullable=True, index=True)
+    status = Column(String, index=True)
+    priority = Column(Integer, default=0)
+    attempts = Column(Integer, default=0)
+    locked_until = Column(DateTime(timezone=True), nullable=True)
     story_id = Column(Integer, nullable=True)
     error = Column(String, nullable=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
-    completed_at = Column(DateTime(timezone=True), nullable=True)
\ No newline at end of file
+    completed_at = Column(DateTime(timezone=True), nullable=True)
+
+    __table_args__ = (
+        Index(
+            "uq_story_job_inflight_theme_key",
+            "theme_key",
+            unique=True,
+            postgresql_where=and_(
+                theme_key.isnot(None), coalesced_into.is_(None), status.in_(("pending", "processing"))
+            ),
+            sqlite_where=and_(
+                theme_key.isnot(None), coalesced_into.is_(None), status.in_(("pending", "processing"))
+            ),
+        ),
+    )
@@ -1,6 +1,6 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, DateTime, JSON
+from sqlalchemy import Column, Integer, String, Text, ForeignKey, Boolean, DateTime, Index
 from sqlalchemy.sql import func
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import deferred, relationship
 
 from db.database import Base
 
@@ -12,6 +12,16 @@ class Story(Base):
     title = Column(String, index=True)
     session_id = Column(String, index=True)
     created_at = Column(DateTime(timezone=True), default=func.now())
+    # 生成完成时预先序列化好的 CompleteStoryResponse
+    tree_json = deferred(Column(Text, nullable=True))
+    # 流式生成期间为 False，此时只写入了部分节点
+    is_complete = Column(Boolean, default=True)
+    # full：一次生成整棵树；lazy：玩家选择选项时才生成子节点
+    mode = Column(String, default="full")
+    # 可复用的故事所属的主题缓存键
+    theme_key = Column(String, nullable=True, index=True)
+    # 预生成库存中尚未被玩家领取的故事
+    is_pooled = Column(Boolean, default=False, index=True)
 
     nodes = relationship("StoryNode", back_populates="story")
 
@@ -21,12 +31,38 @@ class StoryNode(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     story_id = Column(Integer, ForeignKey("stories.id"), index=True)
-    content = Column(String, index=True)
+    content = Column(String)
     is_root = Column(Boolean, default=False)
     is_ending = Column(Boolean, default=False)
     is_winning_ending = Column(Boolean, default=False)
-    options = Column(JSON, default=list)
 
     story = relationship("Story", back_populates="nodes")
 
+    __table_args__ = (
+        # 部分索引只包含根节点，同时保证每个故事只有一个根节点
+        Index(
+            "uq_story_nodes_root",
+            "story_id",
+            unique=True,
+            postgresql_where=is_root == True,
+            sqlite_where=is_root == True,
+        ),
+    )
 
+
+class StoryEdge(Base):
+    """Option ``position`` of ``parent_id``; ``child_id`` stays empty until a lazy story writes that branch."""
+
+    __tablename__ = "story_edges"
+
+    parent_id = Column(Integer, ForeignKey("story_nodes.id"), primary_key=True)
+    position = Column(Integer, primary_key=True)
+    story_id = Column(Integer, ForeignKey("stories.id"), nullable=False)
+    child_id = Column(Integer, ForeignKey("story_nodes.id"), nullable=True)
+    text = Column(String, nullable=False)
+
+    __table_args__ = (
+        # 按故事读取全部选项；沿 child_id 反向查找父节点（到某节点的路径）
+        Index("ix_story_edges_story_parent", "story_id", "parent_id", "position"),
+        Index("ix_story_edges_child", "child_id"),
+    )
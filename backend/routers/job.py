@@ -1,11 +1,16 @@
+import asyncio
 import uuid
 from typing import List, Optional
-from fastapi import APIRouter, Depends, HTTPException, Cookie
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Cookie, Query
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from db.database import get_db
+from db.database import AsyncSessionLocal, get_async_db
 from models.job import StoryJob
 from schemas.job import StoryJobResponse
+from core.job_events import get_job_event_bus
+from core.sse import format_sse
 
 
 router = APIRouter(
@@ -13,11 +18,82 @@ router = APIRouter(
     tags=["jobs"],
 )
 
+FINAL_STATUSES = ("completed", "failed")
+KEEPALIVE_INTERVAL = 15
+
+
+async def load_job_response(job_id: str) -> Optional[StoryJobResponse]:
+    async with AsyncSessionLocal() as db:
+        job = await db.scalar(select(StoryJob).where(StoryJob.job_id == job_id))
+        return StoryJobResponse.model_validate(job) if job else None
+
+
 @router.get("/{job_id}", response_model=StoryJobResponse)
-def get_job_status(job_id: str, db: Session = Depends(get_db)):
-    job = db.query(StoryJob).filter(StoryJob.job_id == job_id).first()
+async def get_job_status(
+    job_id: str,
+    wait: int = Query(0, ge=0, le=60, description="long-poll: wait up to this many seconds for a status change"),
+    db: AsyncSession = Depends(get_async_db)
+):
+    bus = get_job_event_bus()
+    events = bus.subscribe(job_id) if wait else None
+
+    try:
+        job = await db.scalar(select(StoryJob).where(StoryJob.job_id == job_id))
+
+        if not job:
+            raise HTTPException(status_code=404, detail="Job not found")
+
+        if events is None or job.status in FINAL_STATUSES:
+            return job
+
+        # 等待期间不占用连接池中的连接
+        await db.commit()
+        try:
+            await asyncio.wait_for(events.get(), wait)
+        except asyncio.TimeoutError:
+            return job
 
+        await db.refresh(job)
+        return job
+    finally:
+        if events is not None:
+            bus.unsubscribe(job_id, events)
+
+
+@router.get("/{job_id}/events")
+async def get_job_events(job_id: str):
+    bus = get_job_event_bus()
+    events = bus.subscribe(job_id)
+
+    job = await load_job_response(job_id)
     if not job:
+        bus.unsubscribe(job_id, events)
         raise HTTPException(status_code=404, detail="Job not found")
-    
-    return job
+
+    async def event_stream():
+        current = job
+        last_status = None
+        try:
+            while True:
+                if current.status != last_status:
+                    last_status = current.status
+                    yield format_sse(current.model_dump_json(), event="status")
+                if current.status in FINAL_STATUSES:
+                    return
+
+                while True:
+                    try:
+                        await asyncio.wait_for(events.get(), KEEPALIVE_INTERVAL)
+                        break
+                    except asyncio.TimeoutError:
+                        yield ": keepalive\n\n"
+
+                current = await load_job_response(job_id)
+                if current is None:
+                    return
+        finally:
+            bus.unsubscribe(job_id, events)
+
+    response = StreamingResponse(event_stream(), media_type="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    return response
@@ -1,23 +1,48 @@
+import json
+import logging
+import threading
+import time
 import uuid
-from typing import Optional
+import weakref
+from contextlib import closing
+from typing import Iterator, Optional
 from datetime import datetime
-from fastapi import APIRouter, Depends, HTTPException, Cookie, Response, BackgroundTasks
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Cookie, Header, Query, Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, undefer
 
-from db.database import get_db, SessionLocal
+from db.database import get_async_db, get_db, SessionLocal
 from models.story import Story, StoryNode
 from models.job import StoryJob
 from schemas.story import (
-    CompleteStoryResponse, CompleteStoryNodeResponse, CreateStoryRequest
+    CompleteStoryResponse, CompleteStoryNodeResponse, CreateStoryRequest, ExpandNodeRequest,
+    StoryNodesResponse, StoryOutlineResponse
 )
 from schemas.job import StoryJobResponse
 from core.story_generator import StoryGenerator
+from core.config import settings
+from core.job_queue import extend_job_lock, get_job_queue, job_lock_deadline
+from core.story_cache import dump_json, get_story_cache, make_etag, node_payload, serialize_complete_story
+from core.story_graph import load_outline, load_story_nodes, load_subtree
+from core.job_events import get_job_event_bus
+from core.sse import format_sse
+from core.story_expander import get_node_expander
+from core.theme_cache import create_story_job
+from core.story_pool import get_story_pool
+from core.llm_client import LLMServiceError
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(
     prefix="/stories",
     tags=["stories"]
 )
 
+# 流式生成占用的名额，与任务队列的 JOB_CONCURRENCY 分开计算
+stream_slots = threading.BoundedSemaphore(settings.STORY_STREAM_MAX_CONCURRENCY)
+
 def get_session_id(session_id: Optional[str] = Cookie(None)):
     if not session_id:
         session_id = str(uuid.uuid4())
@@ -27,37 +52,83 @@ def get_session_id(session_id: Optional[str] = Cookie(None)):
 @router.post("/create", response_model=StoryJobResponse)
 def create_story(
     resquest: CreateStoryRequest,
-    background_tasks: BackgroundTasks,
     response: Response,
     session_id: str = Depends(get_session_id),
     db: Session = Depends(get_db)
 ):
     response.set_cookie(key="session_id", value=session_id, httponly=True)
 
-    job_id = str(uuid.uuid4())
+    job = create_story_job(db, session_id, resquest.theme, resquest.mode)
 
-    job = StoryJob(
-        job_id=job_id,
-        session_id=session_id,
-        theme=resquest.theme,
-        status="pending"
-    )
+    # 命中主题缓存或合并到进行中任务的请求不需要入队
+    if job.status == "pending" and job.coalesced_into is None:
+        get_job_queue().enqueue(job.job_id, job.priority)
 
-    db.add(job)
-    db.commit()
+    return job
 
-    background_tasks.add_task(
-        generate_story_task,
-        job_id=job_id,
-        theme=resquest.theme,
-        session_id=session_id
-    )
 
+@router.get("/pool/stats")
+def get_pool_stats(db: Session = Depends(get_db)):
+    """Inventory and hit rate of the pre-generated story pool (hit rate is per process)."""
+    return get_story_pool().stats(db)
 
-    return job
 
+@router.post("/create/stream")
+def create_story_stream(
+    resquest: CreateStoryRequest,
+    session_id: str = Depends(get_session_id),
+    db: Session = Depends(get_db)
+):
+    """
+    Generate a full story inside this request and relay the model output as
+    server-sent events. At most STORY_STREAM_MAX_CONCURRENCY streams run per
+    process; beyond that the request is refused with 503 and the client can
+    fall back to POST /create.
+    """
+    if resquest.mode != "full":
+        raise HTTPException(status_code=400, detail="Streaming is only supported for full stories")
+
+    if not stream_slots.acquire(blocking=False):
+        raise HTTPException(
+            status_code=503, detail="Too many stories are being streamed, try again later", headers={"Retry-After": "10"}
+        )
+
+    try:
+        job_id = str(uuid.uuid4())
 
-def generate_story_task(job_id: str, theme: str, session_id: str):
+        # 流式任务在当前请求中直接执行，不进入任务队列
+        job = StoryJob(
+            job_id=job_id,
+            session_id=session_id,
+            theme=resquest.theme,
+            status="processing",
+            attempts=1,
+            locked_until=job_lock_deadline()
+        )
+
+        db.add(job)
+        db.commit()
+
+        pieces = stream_story_task(job_id=job_id, theme=resquest.theme, session_id=session_id)
+    except BaseException:
+        stream_slots.release()
+        raise
+    # 生成器结束后被回收时归还名额；连接在开始读取前断开、生成器从未执行时也是如此
+    weakref.finalize(pieces, stream_slots.release)
+
+    response = StreamingResponse(pieces, media_type="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.set_cookie(key="session_id", value=session_id, httponly=True)
+    return response
+
+
+def stream_story_task(job_id: str, theme: str, session_id: str) -> Iterator[str]:
+    """
+    Same as run_story_job in core.job_queue, but relays the model output while
+    it is generated. The job lock is extended while the answer streams in,
+    and a client that goes away fails the job: nobody is left to read it, so
+    the reaper must not requeue it for another full generation.
+    """
     db = SessionLocal()
 
     try:
@@ -65,60 +136,170 @@ def generate_story_task(job_id: str, theme: str, session_id: str):
 
         if not job:
             return
-        
-        try:
-            job.status = "processing"
+
+        def fail(error: str) -> None:
+            db.rollback()
+            job.story_id = None
+            job.status = "failed"
+            job.completed_at = datetime.now()
+            job.locked_until = None
+            job.error = error
             db.commit()
 
-            story = StoryGenerator.generate_story(db, session_id, theme)
+        try:
+            yield format_sse(StoryJobResponse.model_validate(job).model_dump_json(), event="status")
+
+            def on_story_created(story: Story) -> None:
+                job.story_id = story.id
+                db.commit()
+                get_job_event_bus().publish(job_id)
+
+            # 与队列 worker 的心跳间隔相同
+            lock_interval = settings.JOB_VISIBILITY_TIMEOUT / 3
+            lock_extended_at = time.monotonic()
+            writer = StoryGenerator.stream_writer(db, session_id, on_story_created)
+            try:
+                with closing(StoryGenerator.stream_story_text(theme)) as pieces:
+                    try:
+                        for piece in pieces:
+                            writer.feed(piece)
+                            if writer.should_flush():
+                                writer.flush()
+                            if time.monotonic() - lock_extended_at >= lock_interval:
+                                extend_job_lock(db, job_id)
+                                lock_extended_at = time.monotonic()
+                            yield format_sse(json.dumps({"text": piece}, ensure_ascii=False))
+                    except ValueError as e:
+                        # 格式错误或某个分支校验失败：停止读取，保留已解析的部分交给修复阶段
+                        if not settings.STORY_REPAIR_ENABLED:
+                            raise
+                        logger.warning(f"Story answer is malformed, repairing: {str(e)}")
+
+                if writer.complete or not settings.STORY_REPAIR_ENABLED:
+                    story = writer.finish()
+                else:
+                    extend_job_lock(db, job_id)
+                    story = StoryGenerator.repair_story(writer)
+            except BaseException:
+                writer.abort()
+                raise
 
             job.story_id = story.id
             job.status = "completed"
             job.completed_at = datetime.now()
+            job.locked_until = None
             db.commit()
+        except GeneratorExit:
+            fail("Client disconnected")
+            get_job_event_bus().publish(job_id)
+            raise
         except Exception as e:
-            job.status = "failed"
-            job.completed_at = datetime.now()
-            job.error = str(e)
-            db.commit()
+            fail(str(e))
+            logger.error(f"Story stream job failed: {str(e)}")
+
+        get_job_event_bus().publish(job_id)
+        yield format_sse(StoryJobResponse.model_validate(job).model_dump_json(), event=job.status)
     finally:
         db.close()
 
 
 @router.get("/{story_id}/complete", response_model=CompleteStoryResponse)
-def get_complete_story(story_id: int, db: Session = Depends(get_db)):
-    story = db.query(Story).filter(Story.id == story_id).first()
+async def get_complete_story(
+    story_id: int,
+    if_none_match: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_async_db)
+):
+    story_cache = get_story_cache()
+    cached = await story_cache.aget(story_id)
+
+    if cached is None:
+        story = await db.scalar(select(Story).where(Story.id == story_id).options(undefer(Story.tree_json)))
+        if not story:
+            raise HTTPException(status_code=404, detail="Story not found")
+
+        if story.tree_json:
+            payload = story.tree_json.encode("utf-8")
+        elif story.is_complete is False or story.mode == "lazy":
+            # 仍在生成中，或懒生成的故事会随展开增长：按当前节点返回，不缓存。
+            # 展开时只能清除本进程和 Redis 中的条目，其他副本的进程内缓存会一直返回旧的树
+            payload = await db.run_sync(serialize_complete_story_tree, story, is_complete=story.is_complete is not False)
+            headers = {"ETag": make_etag(payload), "Cache-Control": "no-store"}
+            return Response(content=payload, media_type="application/json", headers=headers)
+        else:
+            # 旧数据没有预先序列化的结果
+            payload = await db.run_sync(serialize_complete_story_tree, story)
+        cached = await story_cache.aset(story_id, payload)
+
+    payload, etag = cached
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=0, must-revalidate"}
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=payload, media_type="application/json", headers=headers)
+
+
+@router.get("/{story_id}/nodes/{node_id}", response_model=StoryNodesResponse)
+async def get_story_node(
+    story_id: int,
+    node_id: int,
+    depth: int = Query(0, ge=0, le=5, description="also return the descendants down to this many levels"),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """One node with its options, for clients that load a story as the player moves through it."""
+    nodes = await db.run_sync(load_subtree, story_id, node_id, depth)
+    if not nodes:
+        raise HTTPException(status_code=404, detail="Story node not found")
+
+    payload = dump_json({
+        "story_id": story_id,
+        "node_id": node_id,
+        "nodes": {node["id"]: node_payload(node) for node in nodes},
+    })
+    return Response(content=payload, media_type="application/json")
+
+
+@router.get("/{story_id}/outline", response_model=StoryOutlineResponse)
+async def get_story_outline(story_id: int, db: AsyncSession = Depends(get_async_db)):
+    """Structure of the story (edges and endings) without any node or option text."""
+    story = await db.scalar(select(Story).where(Story.id == story_id))
     if not story:
         raise HTTPException(status_code=404, detail="Story not found")
-    # TODO： 解析故事文本
-    complete_story = build_complete_story_tree(db, story)
-    return complete_story
-
-
-def build_complete_story_tree(db: Session, story: Story) -> CompleteStoryResponse:
-    nodes = db.query(StoryNode).filter(StoryNode.story_id == story.id).all()
-
-    node_dict = {}
-    for node in nodes:
-        node_response = CompleteStoryNodeResponse(
-            id=node.id,
-            content=node.content,
-            is_ending=node.is_ending,
-            is_winning_ending=node.is_winning_ending,
-            options=node.options
-        )
-        node_dict[node.id] = node_response
 
-    root_node = next((node for node in nodes if node.is_root), None)
+    root_id = await db.scalar(
+        select(StoryNode.id).where(StoryNode.story_id == story_id, StoryNode.is_root == True)
+    )
+    if root_id is None:
+        raise HTTPException(status_code=500, detail="Story root node not found")
+
+    edges, endings = await db.run_sync(load_outline, story_id)
+    payload = dump_json({
+        "id": story.id,
+        "title": story.title,
+        "root_id": root_id,
+        "is_complete": story.is_complete is not False,
+        "mode": story.mode or "full",
+        "edges": edges,
+        "endings": endings,
+    })
+    return Response(content=payload, media_type="application/json")
+
 
-    if not root_node:
+@router.post("/{story_id}/nodes/{node_id}/expand", response_model=CompleteStoryNodeResponse)
+async def expand_story_node(story_id: int, node_id: int, resquest: ExpandNodeRequest):
+    """Generate (once) the node behind option ``option_index`` of a lazy story node."""
+    try:
+        return await get_node_expander().expand(story_id, node_id, resquest.option_index, resquest.prefetch)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except LLMServiceError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+
+
+def serialize_complete_story_tree(db: Session, story: Story, is_complete: bool = True) -> bytes:
+    nodes = load_story_nodes(db, story.id)
+
+    try:
+        return serialize_complete_story(story, nodes, is_complete=is_complete)
+    except ValueError:
         raise HTTPException(status_code=500, detail="Story root node not found")
-    
-    return CompleteStoryResponse(
-        id=story.id,
-        title=story.title,
-        session_id=story.session_id,
-        created_at=story.created_at,
-        root_node=node_dict[root_node.id],
-        all_nodes=node_dict
-    )
@@ -14,6 +14,7 @@ class StoryJobResponse(BaseModel):
     story_id: Optional[int] = None
     completed_at: Optional[datetime] = None
     error: Optional[str] = None
+    coalesced_into: Optional[str] = None
 
     class Config:
         from_attributes = True
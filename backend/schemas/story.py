@@ -1,4 +1,4 @@
-from typing import List, Optional, Tuple, Union, Dict
+from typing import List, Literal, Optional, Tuple, Union, Dict
 from datetime import datetime
 from pydantic import BaseModel
 
@@ -32,6 +32,33 @@ class StoryBase(BaseModel):
 
 class CreateStoryRequest(BaseModel):
     theme: str
+    mode: Literal["full", "lazy"] = "full"
+
+
+class ExpandNodeRequest(BaseModel):
+    option_index: int
+    # 为空时按 LAZY_PREFETCH_OPTIONS 配置决定是否预取下一层
+    prefetch: Optional[bool] = None
+
+
+class StoryNodesResponse(BaseModel):
+    """A node and its descendants down to the requested depth, keyed by id."""
+    story_id: int
+    node_id: int
+    nodes: Dict[int, CompleteStoryNodeResponse]
+
+
+class StoryOutlineResponse(BaseModel):
+    """Structure of a story without any text."""
+    id: int
+    title: str
+    root_id: int
+    is_complete: bool = True
+    mode: str = "full"
+    # [parent_id, position, child_id]；child_id 为空表示该分支尚未生成
+    edges: List[Tuple[int, int, Optional[int]]]
+    # 结局节点 id → 是否为胜利结局
+    endings: Dict[int, bool]
 
 
 class CompleteStoryResponse(StoryBase):
@@ -39,6 +66,8 @@ class CompleteStoryResponse(StoryBase):
     created_at: datetime
     root_node: CompleteStoryNodeResponse
     all_nodes: Dict[int, CompleteStoryNodeResponse]
+    is_complete: bool = True
+    mode: str = "full"
 
     class Config:
         from_attributes = True
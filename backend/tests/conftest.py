@@ -0,0 +1,41 @@
+import os
+import tempfile
+
+import pytest
+
+# core.config 在导入时读取配置；测试不连接推理服务，同步与异步引擎共用一个临时 SQLite 文件
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'test.db')}")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("JOB_RUN_WORKERS", "false")
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """A session on freshly created tables, with an empty story cache."""
+    import core.story_cache
+    from db.database import Base, SessionLocal, engine
+    from models.job import StoryJob  # noqa: F401
+    from models.story import Story  # noqa: F401
+
+    monkeypatch.setattr(core.story_cache, "story_cache", core.story_cache.StoryCache(max_bytes=10 ** 7))
+    Base.metadata.create_all(bind=engine)
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+        Base.metadata.drop_all(bind=engine)
+
+
+@pytest.fixture
+def client(db):
+    """The story routes without the app lifespan: no workers, pool filler or event bus."""
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+
+    from routers import story
+
+    app = FastAPI()
+    app.include_router(story.router)
+    with TestClient(app) as test_client:
+        yield test_client
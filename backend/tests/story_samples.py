@@ -0,0 +1,141 @@
+"""Story trees for the backend tests; the random ones are also used by bench/serialization_benchmark.py."""
+import json
+import random
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Tuple
+
+from sqlalchemy.orm import Session
+
+from models.story import Story
+
+# 非 ASCII、需要转义的字符和控制字符
+ALPHABET = "abc xyz ÄÖü 中文 🐉 \" \\ / \n \t \r \x00 \x1f \x7f   </script> &"
+TIMEZONES = (None, timezone.utc, timezone(timedelta(hours=2)), timezone(timedelta(hours=-5, minutes=-30)))
+
+
+def random_text(rng: random.Random, length: int) -> str:
+    return "".join(rng.choice(ALPHABET) for _ in range(length))
+
+
+def random_story(rng: random.Random, story_id: int, max_nodes: int) -> Tuple[Story, List[Dict[str, Any]]]:
+    """A story row and its node rows in load_story_nodes format, with lazy options that have no child yet."""
+    created_at = datetime(2025, 1, 1) + timedelta(seconds=rng.randint(0, 10 ** 7))
+    if rng.random() < 0.5:
+        created_at = created_at.replace(microsecond=rng.choice((0, rng.randint(1, 999999))))
+    tz = rng.choice(TIMEZONES)
+    if tz is not None:
+        created_at = created_at.replace(tzinfo=tz)
+
+    story = Story(
+        id=story_id,
+        title=random_text(rng, rng.randint(1, 30)),
+        session_id=rng.choice((None, random_text(rng, 12))),
+        created_at=created_at,
+        mode=rng.choice(("full", "lazy", None)),
+    )
+
+    first_id = rng.randint(1, 10 ** 6)
+    nodes = [{"id": first_id, "is_root": True, "options": []}]
+    frontier = [nodes[0]]
+    while frontier and len(nodes) < max_nodes:
+        parent = frontier.pop(0)
+        for _ in range(rng.randint(0, 4)):
+            if rng.random() < 0.2:
+                parent["options"].append({"text": random_text(rng, 10), "node_id": None})
+                continue
+            child = {"id": first_id + len(nodes), "is_root": False, "options": []}
+            parent["options"].append({"text": random_text(rng, 10), "node_id": child["id"]})
+            nodes.append(child)
+            frontier.append(child)
+
+    for node in nodes:
+        node["content"] = random_text(rng, rng.randint(0, 200))
+        node["is_ending"] = not node["options"]
+        node["is_winning_ending"] = node["is_ending"] and rng.random() < 0.5
+    rng.shuffle(nodes)
+    return story, nodes
+
+
+def random_stories(seed: int, count: int, max_nodes: int) -> List[Tuple[Story, List[Dict[str, Any]]]]:
+    rng = random.Random(seed)
+    return [random_story(rng, story_id, max_nodes) for story_id in range(1, count + 1)]
+
+
+def sample_tree() -> Dict[str, Any]:
+    """A small fixed story tree in the LLM answer format: one winning and two losing endings."""
+    def ending(content: str, winning: bool = False) -> Dict[str, Any]:
+        return {"content": content, "isEnding": True, "isWinningEnding": winning, "options": None}
+
+    return {
+        "content": "You stand at the mouth of a cave.",
+        "isEnding": False,
+        "isWinningEnding": False,
+        "options": [
+            {"text": "Go in", "nextNode": {
+                "content": "A dragon sleeps on a pile of \"gold\" — 金币 🐉.",
+                "isEnding": False,
+                "isWinningEnding": False,
+                "options": [
+                    {"text": "Steal the gold", "nextNode": ending("The dragon wakes up.")},
+                    {"text": "Sneak past", "nextNode": ending("You find the way out with a crown.", True)},
+                ],
+            }},
+            {"text": "Walk away", "nextNode": ending("You go home and never know.")},
+        ],
+    }
+
+
+def sample_answer(title: str = "The Cave", ensure_ascii: bool = False) -> str:
+    return json.dumps({"title": title, "rootNode": sample_tree()}, ensure_ascii=ensure_ascii)
+
+
+def save_sample_story(db: Session, session_id: str, title: str = "The Cave") -> Story:
+    from core.story_generator import StoryGenerator
+
+    rows = StoryGenerator._flatten_story_tree(sample_tree())
+    return StoryGenerator._save_story_structure(db, session_id, title, rows)
+
+
+def nested_tree(rows: List[Dict[str, Any]], by_id: bool = True) -> Dict[str, Any]:
+    """
+    Rebuild the nested tree from node rows so stored and flattened stories
+    compare without their ids; ``by_id=False`` for _flatten_story_tree rows,
+    whose options reference children by list index.
+    """
+    index = {row["id"]: row for row in rows} if by_id else dict(enumerate(rows))
+    visited = []
+
+    def build(row: Dict[str, Any]) -> Dict[str, Any]:
+        visited.append(row)
+        return {
+            "content": row["content"],
+            "is_ending": row["is_ending"],
+            "is_winning_ending": row["is_winning_ending"],
+            "options": [
+                (option["text"], None if option["node_id"] is None else build(index[option["node_id"]]))
+                for option in row["options"]
+            ],
+        }
+
+    roots = [row for row in rows if row["is_root"]]
+    assert len(roots) == 1
+    tree = build(roots[0])
+    # 没有从根节点不可达的节点
+    assert len(visited) == len(rows)
+    return tree
+
+
+def save_lazy_sample_story(db: Session) -> Story:
+    """A lazy story: the sample root with its two options not generated yet."""
+    from core.models import LazyStoryLLMResponse
+    from core.story_generator import StoryGenerator
+
+    return StoryGenerator.save_lazy_story(db, "session", LazyStoryLLMResponse.model_validate({
+        "title": "The Cave",
+        "rootNode": {
+            "content": "You stand at the mouth of a cave.",
+            "isEnding": False,
+            "isWinningEnding": False,
+            "options": [{"text": "Go in"}, {"text": "Walk away"}],
+        },
+    }))
@@ -0,0 +1,85 @@
+from datetime import datetime, timedelta
+
+from core.config import settings
+from core.job_queue import claim_job, claim_next_job, extend_job_lock, pending_jobs, requeue_stale_jobs
+from core.theme_cache import job_priority
+from models.job import StoryJob
+
+
+def add_job(db, job_id, **values):
+    values.setdefault("status", "pending")
+    job = StoryJob(job_id=job_id, session_id="session", theme="Pirates", **values)
+    db.add(job)
+    db.commit()
+    return job
+
+
+def job(db, job_id):
+    db.expire_all()
+    return db.query(StoryJob).filter(StoryJob.job_id == job_id).one()
+
+
+def test_claim_order_follows_priority_then_age(db):
+    add_job(db, "pool", priority=job_priority(purpose="pool"))
+    add_job(db, "full", priority=job_priority("full"))
+    add_job(db, "lazy-1", priority=job_priority("lazy"))
+    add_job(db, "follower", priority=job_priority("lazy"), coalesced_into="lazy-1")
+    add_job(db, "lazy-2", priority=job_priority("lazy"))
+    add_job(db, "done", priority=job_priority("lazy"), status="completed")
+
+    assert pending_jobs(db)[0] == ("lazy-1", settings.JOB_PRIORITY_LAZY)
+    assert [claim_next_job(db) for _ in range(5)] == ["lazy-1", "lazy-2", "full", "pool", None]
+    # 合并到其他任务的请求不会被执行
+    assert job(db, "follower").status == "pending"
+
+
+def test_a_job_is_claimed_once(db):
+    add_job(db, "job")
+
+    assert claim_job(db, "job") is True
+    assert claim_job(db, "job") is False
+
+    claimed = job(db, "job")
+    assert (claimed.status, claimed.attempts) == ("processing", 1)
+    assert claimed.locked_until > datetime.now()
+
+
+def test_extend_job_lock(db):
+    add_job(db, "job", status="processing", attempts=1, locked_until=datetime.now() + timedelta(seconds=1))
+
+    extend_job_lock(db, "job")
+
+    assert job(db, "job").locked_until > datetime.now() + timedelta(seconds=settings.JOB_VISIBILITY_TIMEOUT - 60)
+
+
+def test_expired_lock_is_requeued(db):
+    add_job(db, "stale", status="processing", attempts=1, priority=5, locked_until=datetime.now() - timedelta(seconds=1))
+    add_job(db, "alive", status="processing", attempts=1, locked_until=datetime.now() + timedelta(minutes=5))
+
+    assert requeue_stale_jobs(db) == [("stale", 5)]
+
+    stale = job(db, "stale")
+    assert (stale.status, stale.locked_until, stale.attempts) == ("pending", None, 1)
+    assert job(db, "alive").status == "processing"
+    assert claim_next_job(db) == "stale"
+    assert job(db, "stale").attempts == 2
+
+
+def test_job_fails_after_max_attempts(db):
+    add_job(db, "job", theme_key="key")
+    add_job(db, "follower", coalesced_into="job")
+
+    for attempt in range(1, settings.JOB_MAX_ATTEMPTS + 1):
+        assert claim_next_job(db) == "job"
+        # 工作进程在任务完成前退出
+        stale = job(db, "job")
+        stale.locked_until = datetime.now() - timedelta(seconds=1)
+        db.commit()
+        requeued = requeue_stale_jobs(db)
+        assert requeued == ([] if attempt == settings.JOB_MAX_ATTEMPTS else [("job", 0)])
+
+    failed = job(db, "job")
+    assert (failed.status, failed.error, failed.attempts) == ("failed", "Job timed out", settings.JOB_MAX_ATTEMPTS)
+    assert failed.completed_at is not None
+    assert claim_next_job(db) is None
+    assert job(db, "follower").status == "failed"
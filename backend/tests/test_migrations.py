@@ -0,0 +1,140 @@
+import pytest
+from sqlalchemy import (
+    JSON, Boolean, Column, DateTime, ForeignKey, Integer, MetaData, String, Table, create_engine, inspect, select
+)
+from sqlalchemy.orm import Session, undefer
+
+from core.story_graph import load_story_nodes, path_to_node
+from db.database import Base
+from migrations import current_revision, downgrade_database, load_revisions, upgrade_database
+from models.job import StoryJob
+from models.story import Story
+
+# create_all 在引入迁移之前建出的表结构
+legacy = MetaData()
+legacy_stories = Table(
+    "stories", legacy,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("title", String, index=True),
+    Column("session_id", String, index=True),
+    Column("created_at", DateTime(timezone=True)),
+)
+legacy_nodes = Table(
+    "story_nodes", legacy,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("story_id", Integer, ForeignKey("stories.id"), index=True),
+    Column("content", String, index=True),
+    Column("is_root", Boolean),
+    Column("is_ending", Boolean),
+    Column("is_winning_ending", Boolean),
+    Column("options", JSON),
+)
+Table(
+    "story_job", legacy,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("job_id", String, index=True, unique=True),
+    Column("session_id", String, index=True),
+    Column("theme", String),
+    Column("status", String),
+    Column("story_id", Integer, nullable=True),
+    Column("error", String, nullable=True),
+    Column("created_at", DateTime(timezone=True)),
+    Column("completed_at", DateTime(timezone=True), nullable=True),
+)
+
+OPTIONS = {
+    1: [{"text": "Go in", "node_id": 2}, {"text": "Walk away", "node_id": 3}, {"text": "Wait", "node_id": None}],
+    2: [],
+    3: [],
+}
+
+
+@pytest.fixture
+def legacy_engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    legacy.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(legacy_stories.insert(), [{"id": 1, "title": "The Cave", "session_id": "session"}])
+        conn.execute(legacy_nodes.insert(), [
+            {"id": 1, "story_id": 1, "content": "A cave.", "is_root": True, "is_ending": False,
+             "is_winning_ending": False, "options": OPTIONS[1]},
+            {"id": 2, "story_id": 1, "content": "A crown.", "is_root": False, "is_ending": True,
+             "is_winning_ending": True, "options": OPTIONS[2]},
+            {"id": 3, "story_id": 1, "content": "Home.", "is_root": False, "is_ending": True,
+             "is_winning_ending": False, "options": OPTIONS[3]},
+        ])
+    yield engine
+    engine.dispose()
+
+
+def columns(engine, table):
+    return {column["name"] for column in inspect(engine).get_columns(table)}
+
+
+def indexes(engine, table):
+    return {index["name"] for index in inspect(engine).get_indexes(table)}
+
+
+def test_new_database_is_stamped_at_head(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'new.db'}")
+
+    upgrade_database(engine)
+
+    with engine.connect() as conn:
+        assert current_revision(conn) == load_revisions()[-1].revision
+    assert not inspect(engine).has_table("story_edges")
+    engine.dispose()
+
+
+def test_legacy_database_is_upgraded_to_story_edges(legacy_engine):
+    upgrade_database(legacy_engine)
+    # 与 create_tables 相同：迁移之后 create_all 不应再有需要创建的表
+    Base.metadata.create_all(bind=legacy_engine)
+
+    with legacy_engine.connect() as conn:
+        assert current_revision(conn) == "0001_story_edges"
+    assert "options" not in columns(legacy_engine, "story_nodes")
+    assert "ix_story_nodes_content" not in indexes(legacy_engine, "story_nodes")
+    assert "uq_story_nodes_root" in indexes(legacy_engine, "story_nodes")
+    assert {"tree_json", "is_complete", "mode", "theme_key", "is_pooled"} <= columns(legacy_engine, "stories")
+
+    with Session(legacy_engine) as db:
+        story = db.query(Story).options(undefer(Story.tree_json)).one()
+        assert (story.is_complete, story.mode, story.is_pooled, story.tree_json) == (True, "full", False, None)
+        assert {node["id"]: node["options"] for node in load_story_nodes(db, 1)} == OPTIONS
+        assert path_to_node(db, 2) == [("A cave.", "Go in"), ("A crown.", None)]
+
+        db.add(StoryJob(job_id="job", session_id="session", theme="Pirates", status="pending"))
+        db.commit()
+        job = db.query(StoryJob).one()
+        assert (job.mode, job.purpose, job.priority, job.attempts) == ("full", "player", 0, 0)
+
+
+def test_story_edges_downgrade_restores_the_options(legacy_engine):
+    upgrade_database(legacy_engine)
+
+    downgrade_database(legacy_engine, "0000f_story_pool")
+
+    with legacy_engine.connect() as conn:
+        assert current_revision(conn) == "0000f_story_pool"
+        restored = dict(conn.execute(select(legacy_nodes.c.id, legacy_nodes.c.options)).all())
+    assert restored == OPTIONS
+    assert not inspect(legacy_engine).has_table("story_edges")
+    assert "ix_story_nodes_content" in indexes(legacy_engine, "story_nodes")
+    assert "uq_story_nodes_root" not in indexes(legacy_engine, "story_nodes")
+
+    # 再次升级得到相同的数据
+    upgrade_database(legacy_engine)
+    with Session(legacy_engine) as db:
+        assert {node["id"]: node["options"] for node in load_story_nodes(db, 1)} == OPTIONS
+
+
+def test_full_downgrade_returns_to_the_legacy_schema(legacy_engine):
+    upgrade_database(legacy_engine)
+
+    downgrade_database(legacy_engine, None)
+
+    with legacy_engine.connect() as conn:
+        assert current_revision(conn) is None
+    assert columns(legacy_engine, "stories") == {"id", "title", "session_id", "created_at"}
+    assert columns(legacy_engine, "story_nodes") == {column.name for column in legacy_nodes.columns}
@@ -0,0 +1,90 @@
+import asyncio
+
+import pytest
+
+from core.models import StoryNodeStubLLM
+from core.story_expander import NodeExpander, save_expanded_node
+from core.story_generator import StoryGenerator
+from models.story import StoryEdge, StoryNode
+from tests.story_samples import save_lazy_sample_story
+
+
+def root_id(db, story):
+    return db.query(StoryNode.id).filter(StoryNode.story_id == story.id, StoryNode.is_root == True).scalar()
+
+
+def scene(choice):
+    return StoryNodeStubLLM.model_validate({
+        "content": f"After {choice}.", "isEnding": False, "isWinningEnding": False, "options": [{"text": "Go on"}],
+    })
+
+
+@pytest.fixture
+def generations(monkeypatch):
+    """Stands in for the LLM ``node`` task; each call is recorded and yields to the loop first."""
+    calls = []
+
+    async def agenerate_node(cls, title, path, choice, depth, max_depth):
+        calls.append((path, choice, depth))
+        await asyncio.sleep(0.01)
+        return scene(choice)
+
+    monkeypatch.setattr(StoryGenerator, "agenerate_node", classmethod(agenerate_node))
+    return calls
+
+
+def test_concurrent_expands_share_one_generation(db, generations):
+    story = save_lazy_sample_story(db)
+    root = root_id(db, story)
+    expander = NodeExpander(prefetch_options=0, prefetch_concurrency=1)
+
+    async def expand_all():
+        return await asyncio.gather(*(expander.expand(story.id, root, 0) for _ in range(5)))
+
+    children = asyncio.run(expand_all())
+
+    assert generations == [([("You stand at the mouth of a cave.", "Go in")], "Go in", 2)]
+    assert len({child.id for child in children}) == 1
+    assert children[0].content == "After Go in."
+    assert db.query(StoryEdge.child_id).filter(StoryEdge.parent_id == root, StoryEdge.position == 0).scalar() == children[0].id
+    assert db.query(StoryNode).count() == 2
+    assert expander._inflight == {}
+
+
+def test_expanded_option_is_not_generated_again(db, generations):
+    story = save_lazy_sample_story(db)
+    root = root_id(db, story)
+    expander = NodeExpander(prefetch_options=0, prefetch_concurrency=1)
+
+    first = asyncio.run(expander.expand(story.id, root, 1))
+    again = asyncio.run(expander.expand(story.id, root, 1))
+
+    assert len(generations) == 1
+    assert again.id == first.id
+    assert [option.text for option in again.options] == ["Go on"]
+
+
+def test_second_writer_gets_the_linked_child(db):
+    story = save_lazy_sample_story(db)
+    root = root_id(db, story)
+
+    # 两个副本各自生成了同一个选项的子节点，后写入的放弃自己的节点
+    first = save_expanded_node(db, story.id, root, 0, scene("Go in"))
+    second = save_expanded_node(db, story.id, root, 0, StoryNodeStubLLM.model_validate({
+        "content": "Something else.", "isEnding": True, "isWinningEnding": False,
+    }))
+
+    assert second.id == first.id and second.content == "After Go in."
+    assert db.query(StoryNode).count() == 2
+
+
+def test_invalid_expands(db, generations):
+    story = save_lazy_sample_story(db)
+    root = root_id(db, story)
+    expander = NodeExpander(prefetch_options=0, prefetch_concurrency=1)
+
+    with pytest.raises(ValueError):
+        asyncio.run(expander.expand(story.id, root, 2))
+    with pytest.raises(LookupError):
+        asyncio.run(expander.expand(story.id + 1, root, 0))
+    assert generations == []
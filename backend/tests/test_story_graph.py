@@ -0,0 +1,85 @@
+from core.story_generator import StoryGenerator
+from core.story_graph import load_outline, load_subtree, path_to_node, winning_endings
+from models.story import StoryNode
+from tests.story_samples import save_lazy_sample_story, save_sample_story
+
+ROOT = "You stand at the mouth of a cave."
+DRAGON = 'A dragon sleeps on a pile of "gold" — 金币 🐉.'
+CROWN = "You find the way out with a crown."
+
+
+def node_ids(db, story):
+    return {content: node_id for node_id, content in db.query(StoryNode.id, StoryNode.content).filter(
+        StoryNode.story_id == story.id
+    )}
+
+
+def ending(content, winning):
+    return {"content": content, "isEnding": True, "isWinningEnding": winning}
+
+
+def test_path_to_node(db):
+    story = save_sample_story(db, "session")
+    ids = node_ids(db, story)
+
+    assert path_to_node(db, ids[CROWN]) == [(ROOT, "Go in"), (DRAGON, "Sneak past"), (CROWN, None)]
+    assert path_to_node(db, ids["You go home and never know."]) == [(ROOT, "Walk away"), ("You go home and never know.", None)]
+    assert path_to_node(db, ids[ROOT]) == [(ROOT, None)]
+
+
+def test_winning_endings_are_ordered_by_depth(db):
+    save_sample_story(db, "other")
+    story = StoryGenerator._save_story_structure(db, "session", "Two ways", StoryGenerator._flatten_story_tree({
+        "content": "Start", "isEnding": False, "isWinningEnding": False, "options": [
+            {"text": "Long way", "nextNode": {"content": "Halfway", "isEnding": False, "isWinningEnding": False, "options": [
+                {"text": "Push on", "nextNode": ending("Deep win", True)},
+                {"text": "Give up", "nextNode": ending("Loss", False)},
+            ]}},
+            {"text": "Short way", "nextNode": ending("Quick win", True)},
+        ],
+    }))
+    ids = node_ids(db, story)
+
+    assert winning_endings(db, story.id) == [(ids["Quick win"], 1), (ids["Deep win"], 2)]
+
+
+def test_winning_endings_skip_unwritten_branches(db):
+    story = save_lazy_sample_story(db)
+
+    assert winning_endings(db, story.id) == []
+
+
+def test_load_subtree(db):
+    story = save_sample_story(db, "session")
+    other = save_sample_story(db, "other")
+    ids = node_ids(db, story)
+
+    assert [node["content"] for node in load_subtree(db, story.id, ids[ROOT], 0)] == [ROOT]
+    level_one = load_subtree(db, story.id, ids[ROOT], 1)
+    assert [node["content"] for node in level_one] == [ROOT, DRAGON, "You go home and never know."]
+    assert level_one[0]["options"] == [
+        {"text": "Go in", "node_id": ids[DRAGON]},
+        {"text": "Walk away", "node_id": ids["You go home and never know."]},
+    ]
+    assert len(load_subtree(db, story.id, ids[ROOT], 5)) == 5
+    # 其他故事的节点
+    assert load_subtree(db, other.id, ids[ROOT], 1) == []
+
+
+def test_load_outline(db):
+    story = save_sample_story(db, "session")
+    ids = node_ids(db, story)
+
+    edges, endings = load_outline(db, story.id)
+
+    assert edges == [
+        (ids[ROOT], 0, ids[DRAGON]),
+        (ids[ROOT], 1, ids["You go home and never know."]),
+        (ids[DRAGON], 0, ids["The dragon wakes up."]),
+        (ids[DRAGON], 1, ids[CROWN]),
+    ]
+    assert endings == {
+        ids["The dragon wakes up."]: False,
+        ids[CROWN]: True,
+        ids["You go home and never know."]: False,
+    }
@@ -0,0 +1,148 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import core.story_pool
+from core.story_pool import POOL_SESSION_ID, StoryPool, claim_pooled_story
+from core.theme_cache import create_story_job, theme_cache_key
+from models.job import StoryJob
+from models.story import Story
+from tests.story_samples import save_sample_story
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    pool = StoryPool(
+        themes=["Pirates"], low=2, high=4, concurrency=10, max_pending=0, interval=1, failure_backoff=60
+    )
+    monkeypatch.setattr(core.story_pool, "story_pool", pool)
+    return pool
+
+
+def pooled_story(db, theme="Pirates"):
+    story = save_sample_story(db, POOL_SESSION_ID)
+    story.theme_key = theme_cache_key(theme)
+    story.is_pooled = True
+    db.commit()
+    return story
+
+
+def finish_pool_jobs(db):
+    for job in db.query(StoryJob).filter(StoryJob.purpose == "pool"):
+        job.status = "completed"
+    db.commit()
+
+
+def test_claimed_story_is_served_with_the_players_session_id(db, client, pool):
+    story_id = pooled_story(db).id
+    # 库存故事生成时的响应已进入缓存
+    assert client.get(f"/stories/{story_id}/complete").json()["session_id"] == POOL_SESSION_ID
+
+    job = create_story_job(db, "player", " pirates! ")
+
+    assert (job.status, job.story_id) == ("completed", story_id)
+    response = client.get(f"/stories/{story_id}/complete")
+    assert response.status_code == 200
+    assert response.json()["session_id"] == "player"
+    assert response.json()["title"] == "The Cave"
+    assert db.query(Story.is_pooled).filter(Story.id == story_id).scalar() is False
+    assert pool.stats(db)["hits"] == 1
+
+
+def test_each_pooled_story_is_claimed_once(db, pool):
+    first, second = pooled_story(db).id, pooled_story(db).id
+    key = theme_cache_key("Pirates")
+
+    claimed = [claim_pooled_story(db, key, "a"), claim_pooled_story(db, key, "b"), claim_pooled_story(db, key, "c")]
+    db.commit()
+
+    assert claimed == [first, second, None]
+    assert pool.stats(db)["themes"]["pirates"]["ready"] == 0
+
+
+def test_empty_pool_falls_back_to_a_generation_job(db, pool):
+    job = create_story_job(db, "player", "Pirates")
+
+    assert job.status == "pending" and job.story_id is None
+    assert pool.stats(db)["misses"] == 1
+
+
+def test_lazy_requests_do_not_claim_from_the_pool(db, pool):
+    story_id = pooled_story(db).id
+
+    job = create_story_job(db, "player", "Pirates", mode="lazy")
+
+    assert job.status == "pending"
+    assert db.get(Story, story_id).is_pooled is True
+
+
+def test_fill_tops_up_to_the_high_watermark(db, pool):
+    job_ids = pool.fill(db)
+
+    assert len(job_ids) == 4
+    jobs = db.query(StoryJob).filter(StoryJob.job_id.in_(job_ids)).all()
+    assert {(job.purpose, job.session_id, job.theme) for job in jobs} == {("pool", POOL_SESSION_ID, "Pirates")}
+    # 进行中的任务计入水位
+    assert pool.fill(db) == []
+
+
+def test_fill_waits_for_the_low_watermark(db, pool):
+    pool.fill(db)
+    assert pool.fill(db) == []
+    finish_pool_jobs(db)
+    for _ in range(3):
+        pooled_story(db)
+
+    # 到达高水位后，库存降到低水位以下才重新补充
+    assert pool.fill(db) == []
+
+    key = theme_cache_key("Pirates")
+    claim_pooled_story(db, key, "a")
+    claim_pooled_story(db, key, "b")
+    db.commit()
+
+    assert len(pool.fill(db)) == 3
+
+
+def test_fill_respects_the_concurrency_budget(db, pool):
+    pool.concurrency = 3
+    db.add(StoryJob(job_id="running", session_id=POOL_SESSION_ID, theme="Pirates", purpose="pool", status="processing"))
+    db.commit()
+
+    assert len(pool.fill(db)) == 2
+
+
+def test_fill_backs_off_while_players_are_waiting(db, pool):
+    db.add(StoryJob(job_id="player", session_id="player", theme="Dragons", status="pending"))
+    db.commit()
+
+    assert pool.fill(db) == []
+
+    pool.max_pending = 1
+    assert len(pool.fill(db)) == 4
+
+
+def test_followers_do_not_count_as_waiting_players(db, pool):
+    pool.max_pending = 1
+    db.add_all([
+        StoryJob(job_id="leader", session_id="a", theme="Dragons", status="pending"),
+        StoryJob(job_id="follower", session_id="b", theme="Dragons", status="pending", coalesced_into="leader"),
+    ])
+    db.commit()
+
+    assert len(pool.fill(db)) == 4
+
+
+def test_fill_skips_a_theme_whose_pool_job_just_failed(db, pool):
+    failed = StoryJob(
+        job_id="failed", session_id=POOL_SESSION_ID, theme="Pirates", purpose="pool",
+        status="failed", completed_at=datetime.now()
+    )
+    db.add(failed)
+    db.commit()
+
+    assert pool.fill(db) == []
+
+    failed.completed_at = datetime.now() - timedelta(seconds=120)
+    db.commit()
+    assert len(pool.fill(db)) == 4
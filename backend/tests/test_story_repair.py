@@ -0,0 +1,180 @@
+import json
+
+import pytest
+
+from core.models import StoryNodeLLM
+from core.story_generator import StoryGenerator
+from core.story_graph import load_story_nodes
+from core.story_stream import StoryTreeStreamWriter
+from tests.story_samples import nested_tree, sample_tree
+
+
+def ending(content):
+    return {"content": content, "isEnding": True, "isWinningEnding": False, "options": None}
+
+
+@pytest.fixture
+def branches(monkeypatch):
+    """Stands in for the LLM ``branch`` task: each hole gets an ending that names its choice."""
+    holes = []
+
+    def generate_branch(cls, title, hole):
+        holes.append(hole)
+        return StoryNodeLLM.model_validate(ending(f"After {hole.choice}."))
+
+    monkeypatch.setattr(StoryGenerator, "generate_branch", classmethod(generate_branch))
+    return holes
+
+
+def dead_end_answer():
+    """The sample story with "Walk away" leading to a non-ending node without options."""
+    tree = sample_tree()
+    tree["options"][1]["nextNode"] = {"content": "You hesitate.", "isEnding": False, "isWinningEnding": False}
+    return json.dumps({"title": "The Cave", "rootNode": tree})
+
+
+def repaired_tree():
+    tree = sample_tree()
+    tree["options"][1]["nextNode"] = ending("After Walk away.")
+    return nested_tree(StoryGenerator._flatten_story_tree(tree), by_id=False)
+
+
+def test_flatten_rejects_a_dead_end(db):
+    with pytest.raises(ValueError, match="not an ending but has no options"):
+        StoryGenerator._flatten_story_tree(json.loads(dead_end_answer())["rootNode"])
+
+
+def test_stream_rejects_a_dead_end(db):
+    writer = StoryTreeStreamWriter(db, "session", flush_interval=0)
+
+    with pytest.raises(ValueError, match="not an ending but has no options"):
+        writer.feed(dead_end_answer())
+    with pytest.raises(ValueError):
+        writer.finish()
+
+
+def test_both_paths_replace_a_dead_end(db, branches):
+    # 整体解析失败后走 repair_story_text，流式写入走 repair_story，结果应一致
+    saved = StoryGenerator.save_story_text(db, "session", dead_end_answer())
+
+    writer = StoryTreeStreamWriter(db, "session", flush_interval=0)
+    with pytest.raises(ValueError):
+        writer.feed(dead_end_answer())
+    streamed = StoryGenerator.repair_story(writer)
+
+    assert [hole.choice for hole in branches] == ["Walk away", "Walk away"]
+    assert all(hole.replace is not None for hole in branches)
+    assert nested_tree(load_story_nodes(db, saved.id)) == repaired_tree()
+    assert nested_tree(load_story_nodes(db, streamed.id)) == repaired_tree()
+
+
+def cut_writer(db, marker, occurrence=1, offset=0):
+    """A writer fed the sample answer up to the ``occurrence``-th ``marker``."""
+    answer = json.dumps({"title": "The Cave", "rootNode": sample_tree()})
+    end = -1
+    for _ in range(occurrence):
+        end = answer.index(marker, end + 1)
+    writer = StoryTreeStreamWriter(db, "session", flush_interval=0)
+    writer.feed(answer[:end + offset])
+    assert not writer.complete
+    return writer
+
+
+def test_complete_subtree_is_kept(db, branches):
+    writer = cut_writer(db, "You go home")
+
+    holes = writer.holes()
+
+    hole, = holes
+    assert (hole.parent, hole.position, hole.choice, hole.replace) == (writer.root, 1, "Walk away", None)
+    assert hole.path == [("You stand at the mouth of a cave.", "Walk away")]
+    assert hole.depth == 2
+
+    kept = {node["content"]: node["id"] for node in load_story_nodes(db, writer.story.id)}
+    story = StoryGenerator._attach_branches(writer, holes, [StoryGenerator.generate_branch(writer.title, hole)])
+    nodes = load_story_nodes(db, story.id)
+    assert nested_tree(nodes) == repaired_tree()
+    # 已写入的节点原样保留
+    assert {node["content"]: node["id"] for node in nodes if node["content"] in kept} == kept
+    assert story.is_complete is True
+
+
+def test_truncated_trailing_option_is_dropped(db, branches):
+    writer = cut_writer(db, "Walk away", offset=4)
+
+    assert writer.holes() == []
+
+    story = StoryGenerator.repair_story(writer)
+    tree = nested_tree(load_story_nodes(db, story.id))
+    assert [text for text, _ in tree["options"]] == ["Go in"]
+    assert tree["options"][0] == nested_tree(
+        StoryGenerator._flatten_story_tree(sample_tree()), by_id=False
+    )["options"][0]
+    assert branches == []
+
+
+def test_node_without_options_is_replaced_as_a_whole(db, branches):
+    writer = cut_writer(db, '"options"', occurrence=2)
+    dragon = writer.root.options[0].node
+    assert dragon.ready and not dragon.options
+
+    hole, = writer.holes()
+    assert dragon.id is not None
+    assert (hole.parent, hole.position, hole.choice, hole.replace) == (writer.root, 0, "Go in", dragon)
+    assert hole.path == [("You stand at the mouth of a cave.", "Go in")]
+
+    story = StoryGenerator.repair_story(writer)
+    tree = nested_tree(load_story_nodes(db, story.id))
+    assert tree["options"] == [("Go in", {
+        "content": "After Go in.", "is_ending": True, "is_winning_ending": False, "options": [],
+    })]
+    assert dragon.content not in {node["content"] for node in load_story_nodes(db, story.id)}
+
+
+@pytest.mark.parametrize("marker, occurrence", [('"options"', 1), ('"isWinningEnding"', 1), ('"rootNode"', 1)])
+def test_root_cut_off_before_its_options_raises(db, branches, marker, occurrence):
+    writer = cut_writer(db, marker, occurrence)
+
+    with pytest.raises(ValueError, match="cut off before"):
+        writer.holes()
+    with pytest.raises(ValueError):
+        StoryGenerator.repair_story(writer)
+    assert branches == []
+
+
+def test_too_many_holes_are_not_repaired(db, branches, monkeypatch):
+    from core.config import settings
+
+    monkeypatch.setattr(settings, "STORY_REPAIR_MAX_BRANCHES", 0)
+    writer = cut_writer(db, "You go home")
+
+    with pytest.raises(ValueError, match="too many to repair"):
+        StoryGenerator.repair_story(writer)
+    assert branches == []
+
+
+def test_arepair_story(db, monkeypatch):
+    import asyncio
+
+    holes = []
+
+    async def agenerate_branch(cls, title, hole):
+        holes.append(hole)
+        return StoryNodeLLM.model_validate(ending(f"After {hole.choice}."))
+
+    monkeypatch.setattr(StoryGenerator, "agenerate_branch", classmethod(agenerate_branch))
+    writer = cut_writer(db, "You find the way out")
+
+    story = asyncio.run(StoryGenerator.arepair_story(writer))
+
+    hole, = holes
+    assert hole.path == [
+        ("You stand at the mouth of a cave.", "Go in"),
+        ('A dragon sleeps on a pile of "gold" — 金币 🐉.', "Sneak past"),
+    ]
+    assert hole.depth == 3
+    tree = nested_tree(load_story_nodes(db, story.id))
+    assert [text for text, _ in tree["options"]] == ["Go in"]
+    assert tree["options"][0][1]["options"][1] == ("Sneak past", {
+        "content": "After Sneak past.", "is_ending": True, "is_winning_ending": False, "options": [],
+    })
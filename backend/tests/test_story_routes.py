@@ -0,0 +1,109 @@
+import gc
+import threading
+
+import pytest
+
+import routers.story
+from core.story_generator import StoryGenerator
+from models.job import StoryJob
+from models.story import Story
+from tests.story_samples import sample_answer
+
+
+@pytest.fixture
+def stream_slots(monkeypatch):
+    slots = threading.BoundedSemaphore(1)
+    monkeypatch.setattr(routers.story, "stream_slots", slots)
+    return slots
+
+
+@pytest.fixture
+def model_answer(monkeypatch):
+    """Stands in for the LLM service stream with the sample answer in small pieces."""
+    def stream_story_text(cls, theme):
+        answer = sample_answer()
+        for i in range(0, len(answer), 20):
+            yield answer[i:i + 20]
+
+    monkeypatch.setattr(StoryGenerator, "stream_story_text", classmethod(stream_story_text))
+
+
+def test_stream_is_refused_when_every_slot_is_taken(db, client, stream_slots, model_answer):
+    stream_slots.acquire()
+
+    response = client.post("/stories/create/stream", json={"theme": "Pirates"})
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"]
+    assert db.query(StoryJob).count() == 0
+
+
+def test_stream_returns_its_slot(db, client, stream_slots, model_answer):
+    response = client.post("/stories/create/stream", json={"theme": "Pirates"})
+
+    assert response.status_code == 200
+    assert "event: completed" in response.text
+    job = db.query(StoryJob).one()
+    assert job.status == "completed"
+    assert db.get(Story, job.story_id).title == "The Cave"
+
+    gc.collect()
+    assert stream_slots.acquire(blocking=False)
+
+
+def test_slot_is_returned_when_the_stream_never_starts(db, stream_slots, model_answer):
+    response = routers.story.create_story_stream(routers.story.CreateStoryRequest(theme="Pirates"), "session", db)
+    assert not stream_slots.acquire(blocking=False)
+
+    # 响应在开始读取前被丢弃
+    del response
+    gc.collect()
+    assert stream_slots.acquire(blocking=False)
+
+
+def test_lazy_stories_cannot_be_streamed(db, client, stream_slots):
+    response = client.post("/stories/create/stream", json={"theme": "Pirates", "mode": "lazy"})
+
+    assert response.status_code == 400
+    assert stream_slots.acquire(blocking=False)
+
+
+def test_lazy_story_is_served_uncached(db, client, monkeypatch):
+    from core.models import StoryNodeStubLLM
+    from core.story_cache import get_story_cache
+    from core.story_expander import save_expanded_node
+    from models.story import StoryNode
+    from tests.story_samples import save_lazy_sample_story
+
+    story = save_lazy_sample_story(db)
+    root_id = db.query(StoryNode.id).filter(StoryNode.story_id == story.id).scalar()
+
+    response = client.get(f"/stories/{story.id}/complete")
+    assert response.status_code == 200
+    assert response.headers["Cache-Control"] == "no-store"
+    assert (response.json()["mode"], response.json()["is_complete"]) == ("lazy", True)
+    assert [option["node_id"] for option in response.json()["root_node"]["options"]] == [None, None]
+    assert get_story_cache().get(story.id) is None
+
+    # 另一个副本展开了节点：本进程没有收到失效通知，也不能返回旧的树
+    monkeypatch.setattr(get_story_cache(), "invalidate", lambda story_id: None)
+    child = save_expanded_node(db, story.id, root_id, 0, StoryNodeStubLLM.model_validate({
+        "content": "A dragon.", "isEnding": True, "isWinningEnding": False,
+    }))
+
+    body = client.get(f"/stories/{story.id}/complete").json()
+    assert body["root_node"]["options"][0]["node_id"] == child.id
+    assert body["all_nodes"][str(child.id)]["content"] == "A dragon."
+
+
+def test_complete_story_is_cached(db, client):
+    from core.story_cache import get_story_cache
+    from tests.story_samples import save_sample_story
+
+    story = save_sample_story(db, "session")
+    get_story_cache().invalidate(story.id)
+
+    response = client.get(f"/stories/{story.id}/complete")
+    assert response.headers["Cache-Control"] == "private, max-age=0, must-revalidate"
+    assert get_story_cache().get(story.id) == (response.content, response.headers["ETag"])
+    assert client.get(f"/stories/{story.id}/complete", headers={"If-None-Match": response.headers["ETag"]}).status_code == 304
@@ -0,0 +1,56 @@
+"""
+The orjson read path must produce the same bytes as the pydantic response
+models it replaces.
+"""
+import random
+
+import pytest
+
+from core.story_cache import build_complete_story_response, dump_json, node_payload, serialize_complete_story
+from schemas.story import CompleteStoryNodeResponse, StoryNodesResponse, StoryOutlineResponse
+from tests.story_samples import random_stories
+
+SAMPLES = random_stories(seed=0, count=40, max_nodes=60)
+
+
+@pytest.mark.parametrize("story, nodes", SAMPLES, ids=lambda value: getattr(value, "id", None))
+@pytest.mark.parametrize("is_complete", [True, False])
+def test_complete_story_matches_response_model(story, nodes, is_complete):
+    expected = build_complete_story_response(story, nodes, is_complete=is_complete).model_dump_json().encode()
+    assert serialize_complete_story(story, nodes, is_complete=is_complete) == expected
+
+
+@pytest.mark.parametrize("story, nodes", SAMPLES, ids=lambda value: getattr(value, "id", None))
+def test_story_nodes_match_response_model(story, nodes):
+    subset = nodes[:random.Random(story.id).randint(1, len(nodes))]
+    expected = StoryNodesResponse(story_id=story.id, node_id=subset[0]["id"], nodes={
+        node["id"]: CompleteStoryNodeResponse(**node) for node in subset
+    }).model_dump_json().encode()
+    assert dump_json({
+        "story_id": story.id,
+        "node_id": subset[0]["id"],
+        "nodes": {node["id"]: node_payload(node) for node in subset},
+    }) == expected
+
+
+@pytest.mark.parametrize("story, nodes", SAMPLES, ids=lambda value: getattr(value, "id", None))
+def test_outline_matches_response_model(story, nodes):
+    outline = {
+        "id": story.id,
+        "title": story.title,
+        "root_id": next(node["id"] for node in nodes if node["is_root"]),
+        "is_complete": story.id % 2 == 0,
+        "mode": story.mode or "full",
+        "edges": [
+            (node["id"], position, option["node_id"])
+            for node in nodes for position, option in enumerate(node["options"])
+        ],
+        "endings": {node["id"]: node["is_winning_ending"] for node in nodes if node["is_ending"]},
+    }
+    assert dump_json(outline) == StoryOutlineResponse(**outline).model_dump_json().encode()
+
+
+def test_missing_root_is_rejected():
+    story, nodes = SAMPLES[0]
+    with pytest.raises(ValueError):
+        serialize_complete_story(story, [node for node in nodes if not node["is_root"]])
@@ -0,0 +1,130 @@
+import pytest
+
+from core.story_generator import StoryGenerator
+from core.story_graph import load_story_nodes
+from core.story_stream import StoryTreeStreamWriter
+from models.story import Story, StoryEdge, StoryNode
+from tests.story_samples import nested_tree, sample_answer, sample_tree
+
+
+def chunks(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def stream(writer, pieces):
+    """Feed ``pieces`` the way agenerate_story does, flushing between them."""
+    for piece in pieces:
+        writer.feed(piece)
+        if writer.should_flush():
+            writer.flush()
+
+
+def expected_tree():
+    return nested_tree(StoryGenerator._flatten_story_tree(sample_tree()), by_id=False)
+
+
+def stored_tree(db, story_id):
+    return nested_tree(load_story_nodes(db, story_id))
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64, 10 ** 6])
+@pytest.mark.parametrize("ensure_ascii", [False, True])
+def test_story_is_stored_like_the_flattened_tree_for_any_chunking(db, size, ensure_ascii):
+    created = []
+    writer = StoryTreeStreamWriter(db, "session", flush_interval=0, on_story_created=created.append)
+    # 模型常在 JSON 前后加上代码块标记
+    answer = "```json\n" + sample_answer(ensure_ascii=ensure_ascii) + "\n```"
+
+    stream(writer, chunks(answer, size))
+    assert writer.complete
+    story = writer.finish()
+
+    assert created == [story]
+    assert (story.title, story.session_id, story.is_complete) == ("The Cave", "session", True)
+    assert stored_tree(db, story.id) == expected_tree()
+    assert db.query(StoryEdge).filter(StoryEdge.story_id == story.id).count() == 4
+
+
+def test_nodes_are_playable_before_the_answer_ends(db):
+    writer = StoryTreeStreamWriter(db, "session", flush_interval=0)
+    answer = sample_answer()
+
+    stream(writer, [answer[:answer.index('"options"')], answer[answer.index('"options"'):answer.index("Walk away")]])
+
+    story = db.get(Story, writer.story.id)
+    assert story.is_complete is False
+    root, = [node for node in load_story_nodes(db, story.id) if node["is_root"]]
+    assert root["content"] == "You stand at the mouth of a cave."
+    assert [option["text"] for option in root["options"]] == ["Go in"]
+
+
+def test_finish_publishes_the_payload(db):
+    from core.story_cache import get_story_cache, serialize_complete_story
+
+    writer = StoryTreeStreamWriter(db, "session", flush_interval=0)
+    stream(writer, chunks(sample_answer(), 50))
+    story = writer.finish()
+
+    payload = serialize_complete_story(story, load_story_nodes(db, story.id))
+    assert story.tree_json == payload.decode("utf-8")
+    assert get_story_cache().get(story.id)[0] == payload
+
+
+def test_abort_removes_the_partial_story(db):
+    writer = StoryTreeStreamWriter(db, "session", flush_interval=0)
+    answer = sample_answer()
+    stream(writer, chunks(answer[:answer.index("Sneak past")], 16))
+    story_id = writer.story.id
+    assert db.query(StoryNode).filter(StoryNode.story_id == story_id).count() == 3
+
+    writer.abort()
+
+    assert db.get(Story, story_id) is None
+    assert db.query(StoryNode).count() == 0
+    assert db.query(StoryEdge).count() == 0
+
+
+def test_abort_before_anything_was_written(db):
+    writer = StoryTreeStreamWriter(db, "session", flush_interval=0)
+    writer.feed('{"title": "The Cave", "rootNode": {"content": "You st')
+
+    writer.abort()
+
+    assert writer.story is None
+    assert db.query(Story).count() == 0
+
+
+@pytest.mark.parametrize("answer", [
+    # 语法错误
+    '{"title": "The Cave", "rootNode": {"content": "A cave", "isEnding": false,, }',
+    # 字段校验失败
+    '{"title": "The Cave", "rootNode": {"content": "A cave", "isEnding": "maybe", "isWinningEnding": false}}',
+    # 选项不是对象，节点因此没有选项
+    '{"title": "The Cave", "rootNode": {"content": "A cave", "isEnding": false, "isWinningEnding": false,'
+    ' "options": ["Go in"]}}',
+    # 选项缺少 nextNode
+    '{"title": "The Cave", "rootNode": {"content": "A cave", "isEnding": false, "isWinningEnding": false,'
+    ' "options": [{"text": "Go in"}]}}',
+])
+def test_malformed_answer_raises(db, answer):
+    writer = StoryTreeStreamWriter(db, "session", flush_interval=0)
+
+    with pytest.raises(ValueError):
+        stream(writer, chunks(answer, 5))
+    assert not writer.complete
+
+
+def test_answer_cut_off_mid_option_keeps_the_complete_branches(db):
+    writer = StoryTreeStreamWriter(db, "session", flush_interval=0)
+    answer = sample_answer()
+    stream(writer, chunks(answer[:answer.index("You go home")], 9))
+
+    assert not writer.complete
+    with pytest.raises(ValueError):
+        writer.finish()
+
+    writer.flush()
+    tree = stored_tree(db, writer.story.id)
+    go_in, = tree["options"]
+    assert go_in == expected_tree()["options"][0]
+    assert db.get(Story, writer.story.id).is_complete is False
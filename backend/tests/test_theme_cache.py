@@ -0,0 +1,100 @@
+import threading
+
+import core.theme_cache
+from core.config import settings
+from core.theme_cache import create_story_job, find_inflight_job, normalize_theme, sync_followers, theme_cache_key
+from db.database import SessionLocal
+from models.job import StoryJob
+from models.story import Story
+from tests.story_samples import save_sample_story
+
+
+def test_normalize_theme():
+    assert normalize_theme("  Space   Pirates!! ") == normalize_theme("space pirates") == "space pirates"
+    assert theme_cache_key("Pirates.") == theme_cache_key("pirates")
+
+
+def test_concurrent_requests_for_one_theme_share_a_generation(db, monkeypatch):
+    barrier = threading.Barrier(2)
+    waited = threading.local()
+
+    def racing_find_inflight_job(db, theme_key):
+        leader = find_inflight_job(db, theme_key)
+        # 两个请求都先确认没有进行中的任务，再同时写入
+        if not getattr(waited, "done", False):
+            waited.done = True
+            barrier.wait(timeout=10)
+        return leader
+
+    monkeypatch.setattr(core.theme_cache, "find_inflight_job", racing_find_inflight_job)
+    results, errors = {}, []
+
+    def request(session_id):
+        session = SessionLocal()
+        try:
+            job = create_story_job(session, session_id, "Pirates")
+            results[session_id] = (job.job_id, job.status, job.coalesced_into)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            session.close()
+
+    threads = [threading.Thread(target=request, args=(session_id,)) for session_id in ("a", "b")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=30)
+
+    assert errors == []
+    leaders = [job_id for job_id, _, coalesced_into in results.values() if coalesced_into is None]
+    followers = [coalesced_into for _, _, coalesced_into in results.values() if coalesced_into is not None]
+    assert len(leaders) == 1 and followers == leaders
+    assert all(status == "pending" for _, status, _ in results.values())
+    assert db.query(StoryJob).count() == 2
+
+
+def test_follower_gets_the_leaders_outcome(db):
+    leader = create_story_job(db, "a", "Pirates")
+    follower = create_story_job(db, "b", " pirates ")
+    assert follower.coalesced_into == leader.job_id
+
+    story = save_sample_story(db, "a")
+    leader.story_id, leader.status = story.id, "completed"
+    db.commit()
+    sync_followers(db, leader)
+
+    db.refresh(follower)
+    assert (follower.status, follower.story_id) == ("completed", story.id)
+
+
+def test_follower_of_a_leader_that_just_finished(db, monkeypatch):
+    leader = create_story_job(db, "a", "Pirates")
+
+    def finish_leader(db, theme_key):
+        # 查到领头任务后、写入之前它恰好完成
+        found = find_inflight_job(db, theme_key)
+        if found is not None:
+            found.status, found.error = "failed", "boom"
+            db.commit()
+        return found
+
+    monkeypatch.setattr(core.theme_cache, "find_inflight_job", finish_leader)
+    follower = create_story_job(db, "b", "Pirates")
+
+    assert follower.coalesced_into == leader.job_id
+    assert (follower.status, follower.error) == ("failed", "boom")
+
+
+def test_kept_stories_are_reused(db, monkeypatch):
+    monkeypatch.setattr(settings, "THEME_CACHE_STORIES_PER_THEME", 2)
+    story_ids = set()
+    for _ in range(2):
+        story = save_sample_story(db, "a")
+        story.theme_key = theme_cache_key("Pirates")
+        story_ids.add(story.id)
+    db.commit()
+
+    job = create_story_job(db, "b", "PIRATES")
+
+    assert job.status == "completed" and job.story_id in story_ids
+    assert db.query(Story).count() == 2
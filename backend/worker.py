@@ -0,0 +1,42 @@
+import asyncio
+import logging
+import signal
+
+from prometheus_client import start_http_server
+
+from core.config import settings
+from core.log_context import configure_logging
+from core.job_queue import DatabaseJobQueue
+from core.job_events import get_job_event_bus
+from core.story_expander import get_node_expander
+from core.llm_client import get_llm_client
+from db.database import create_tables
+
+configure_logging(settings.LOG_LEVEL, settings.LOG_FORMAT)
+logger = logging.getLogger(__name__)
+
+
+async def main():
+    """独立的故事生成 worker 进程，从 story_job 表中领取任务"""
+    create_tables()
+    if settings.WORKER_METRICS_PORT:
+        start_http_server(settings.WORKER_METRICS_PORT)
+    await get_job_event_bus().start()
+    queue = DatabaseJobQueue(settings.JOB_CONCURRENCY, settings.JOB_POLL_INTERVAL)
+    await queue.start()
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await stop.wait()
+    logger.info("Stopping worker...")
+    await queue.stop()
+    await get_node_expander().stop()
+    await get_job_event_bus().stop()
+    await get_llm_client().aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
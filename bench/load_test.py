@@ -0,0 +1,156 @@
+"""
+Replay story themes against a running backend and report latency per stage.
+
+    python bench/load_test.py --base-url http://127.0.0.1:8000/api --stories 50 --concurrency 8
+
+Each virtual user runs POST /stories/create -> GET /jobs/{id} until the job
+finishes -> GET /stories/{id}/complete. Themes are read from a JSONL file
+with a "theme" field per line. When the backend was started with
+bench/run_backend.py, per-stage DB query counts are included in the report.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from report import format_report, summarize  # noqa: E402
+
+DEFAULT_THEMES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "requests.jsonl")
+FINAL_STATUSES = ("completed", "failed")
+
+
+def load_themes(path: str) -> List[str]:
+    themes = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                themes.append(json.loads(line)["theme"])
+    if not themes:
+        raise ValueError(f"No themes found in {path}")
+    return themes
+
+
+class LoadRunner:
+    def __init__(self, base_url: str, wait: int, poll_interval: float, timeout: float) -> None:
+        self.base_url = base_url.rstrip("/")
+        self.wait = wait
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.completed = 0
+        self.failed = 0
+        self.errors: Dict[str, int] = defaultdict(int)
+
+    def _record(self, stage: str, started: float) -> float:
+        now = time.perf_counter()
+        self.latencies[stage].append(now - started)
+        return now
+
+    async def run_story(self, client: httpx.AsyncClient, theme: str) -> None:
+        started = time.perf_counter()
+        try:
+            response = await client.post(f"{self.base_url}/stories/create", json={"theme": theme})
+            response.raise_for_status()
+            job = response.json()
+            stage_start = self._record("create", started)
+
+            deadline = stage_start + self.timeout
+            while job["status"] not in FINAL_STATUSES:
+                if time.perf_counter() > deadline:
+                    raise TimeoutError(f"job {job['job_id']} did not finish")
+                if not self.wait:
+                    await asyncio.sleep(self.poll_interval)
+                response = await client.get(f"{self.base_url}/jobs/{job['job_id']}", params={"wait": self.wait})
+                response.raise_for_status()
+                job = response.json()
+            stage_start = self._record("job", stage_start)
+
+            if job["status"] == "failed":
+                self.failed += 1
+                self.errors[job.get("error") or "job failed"] += 1
+                return
+
+            response = await client.get(f"{self.base_url}/stories/{job['story_id']}/complete")
+            response.raise_for_status()
+            response.json()
+            self._record("complete", stage_start)
+            self._record("total", started)
+            self.completed += 1
+        except Exception as e:
+            self.failed += 1
+            self.errors[f"{type(e).__name__}: {e}"] += 1
+
+    async def run(self, themes: List[str], stories: int, concurrency: int) -> float:
+        pending = iter(itertools.islice(itertools.cycle(themes), stories))
+        limits = httpx.Limits(max_connections=concurrency)
+
+        async def user() -> None:
+            # 每个虚拟用户拥有独立的 session cookie
+            async with httpx.AsyncClient(timeout=self.wait + 30, limits=limits) as client:
+                for theme in pending:
+                    await self.run_story(client, theme)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(user() for _ in range(concurrency)))
+        return time.perf_counter() - started
+
+
+async def fetch_db_stats(base_url: str, reset: bool = False) -> Optional[dict]:
+    root = base_url.rstrip("/").rsplit("/api", 1)[0]
+    async with httpx.AsyncClient(timeout=10) as client:
+        try:
+            if reset:
+                response = await client.post(f"{root}/bench/stats/reset")
+            else:
+                response = await client.get(f"{root}/bench/stats")
+        except httpx.HTTPError:
+            return None
+    return response.json() if response.status_code == 200 else None
+
+
+async def main_async(args) -> dict:
+    themes = load_themes(args.themes)
+    await fetch_db_stats(args.base_url, reset=True)
+
+    runner = LoadRunner(args.base_url, args.wait, args.poll_interval, args.job_timeout)
+    wall_time = await runner.run(themes, args.stories, args.concurrency)
+
+    db_stats = await fetch_db_stats(args.base_url)
+    summary = summarize(runner.latencies, wall_time, runner.completed, runner.failed, db_stats)
+    summary["errors"] = dict(runner.errors)
+    return summary
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000/api")
+    parser.add_argument("--themes", default=DEFAULT_THEMES, help="JSONL file with a \"theme\" per line")
+    parser.add_argument("--stories", type=int, default=20, help="total stories to create")
+    parser.add_argument("--concurrency", type=int, default=4, help="virtual users")
+    parser.add_argument("--wait", type=int, default=30, help="long-poll seconds for /jobs/{id}; 0 to poll")
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="seconds between polls when --wait=0")
+    parser.add_argument("--job-timeout", type=float, default=900.0)
+    parser.add_argument("--output", help="also write the summary as JSON to this file")
+    args = parser.parse_args()
+
+    summary = asyncio.run(main_async(args))
+    print(format_report(summary))
+    for error, count in summary["errors"].items():
+        print(f"error x{count}: {error}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
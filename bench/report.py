@@ -0,0 +1,86 @@
+"""Latency / throughput summary for the load generator."""
+import math
+from typing import Dict, List, Optional, Sequence
+
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(values: Sequence[float], p: float) -> Optional[float]:
+    """Linear-interpolated percentile, ``p`` in [0, 100]."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * p / 100
+    low, high = math.floor(rank), math.ceil(rank)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def summarize(
+    latencies: Dict[str, List[float]],
+    wall_time: float,
+    completed: int,
+    failed: int,
+    db_stats: Optional[dict] = None,
+) -> dict:
+    stages = {}
+    for stage, values in latencies.items():
+        stages[stage] = {
+            "count": len(values),
+            **{f"p{p}": percentile(values, p) for p in PERCENTILES},
+            "max": max(values) if values else None,
+        }
+
+    db = None
+    if db_stats is not None:
+        queries = db_stats.get("queries", {})
+        requests = db_stats.get("requests", {})
+        db = {
+            stage: {
+                "queries": count,
+                "requests": requests.get(stage, 0),
+                "per_request": count / requests[stage] if requests.get(stage) else None,
+                "per_story": count / completed if completed else None,
+            }
+            for stage, count in sorted(queries.items())
+        }
+
+    return {
+        "completed": completed,
+        "failed": failed,
+        "wall_time": wall_time,
+        "throughput": completed / wall_time if wall_time else 0.0,
+        "latency": stages,
+        "db_queries": db,
+    }
+
+
+def _fmt(value: Optional[float], unit: str = "ms") -> str:
+    if value is None:
+        return "-"
+    if unit == "ms":
+        return f"{value * 1000:.1f}"
+    return f"{value:.2f}"
+
+
+def format_report(summary: dict) -> str:
+    lines = [
+        f"stories completed: {summary['completed']}  failed: {summary['failed']}",
+        f"wall time: {summary['wall_time']:.2f}s  throughput: {summary['throughput']:.2f} stories/s",
+        "",
+        f"{'stage':<12}{'count':>8}" + "".join(f"{f'p{p} ms':>12}" for p in PERCENTILES) + f"{'max ms':>12}",
+    ]
+    for stage, row in summary["latency"].items():
+        lines.append(
+            f"{stage:<12}{row['count']:>8}"
+            + "".join(f"{_fmt(row[f'p{p}']):>12}" for p in PERCENTILES)
+            + f"{_fmt(row['max']):>12}"
+        )
+
+    if summary["db_queries"]:
+        lines += ["", f"{'db stage':<12}{'queries':>10}{'requests':>10}{'per req':>10}{'per story':>11}"]
+        for stage, row in summary["db_queries"].items():
+            lines.append(
+                f"{stage:<12}{row['queries']:>10}{row['requests']:>10}"
+                f"{_fmt(row['per_request'], ''):>10}{_fmt(row['per_story'], ''):>11}"
+            )
+    return "\n".join(lines)
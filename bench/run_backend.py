@@ -0,0 +1,122 @@
+"""
+Run the backend API with per-stage database query counting.
+
+    DATABASE_URL=sqlite:///bench.db python bench/run_backend.py --port 8000
+
+Every SQL statement is attributed to the stage of the request that issued
+it (create / job / complete / other); statements issued by the job
+workers outside a request count as "worker". Totals are served at
+GET /bench/stats and reset with POST /bench/stats/reset.
+"""
+import argparse
+import os
+import sys
+import threading
+from collections import Counter
+from contextvars import ContextVar
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend")
+
+STAGES = (
+    ("/stories/create", "create"),
+    ("/complete", "complete"),
+    ("/jobs/", "job"),
+)
+
+current_stage: ContextVar[str] = ContextVar("bench_stage", default="worker")
+
+
+def stage_for_path(path: str) -> str:
+    for marker, stage in STAGES:
+        if marker in path:
+            return stage
+    return "other"
+
+
+class QueryCounter:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.queries: Counter = Counter()
+        self.requests: Counter = Counter()
+
+    def count_query(self, *args) -> None:
+        stage = current_stage.get()
+        with self._lock:
+            self.queries[stage] += 1
+
+    def count_request(self, stage: str) -> None:
+        with self._lock:
+            self.requests[stage] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"queries": dict(self.queries), "requests": dict(self.requests)}
+
+    def reset(self) -> None:
+        with self._lock:
+            self.queries.clear()
+            self.requests.clear()
+
+
+class StageMiddleware:
+    """Tag everything a request does (including threadpool work) with its stage."""
+
+    def __init__(self, app, counter: QueryCounter) -> None:
+        self.app = app
+        self.counter = counter
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith("/bench/"):
+            await self.app(scope, receive, send)
+            return
+        stage = stage_for_path(scope["path"])
+        self.counter.count_request(stage)
+        token = current_stage.set(stage)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_stage.reset(token)
+
+
+def create_app():
+    sys.path.insert(0, BACKEND_DIR)
+    from sqlalchemy import event
+
+    from db.database import async_engine, engine
+    from main import app
+
+    counter = QueryCounter()
+    event.listen(engine, "before_cursor_execute", counter.count_query)
+    event.listen(async_engine.sync_engine, "before_cursor_execute", counter.count_query)
+
+    @app.get("/bench/stats", include_in_schema=False)
+    def bench_stats():
+        return counter.snapshot()
+
+    @app.post("/bench/stats/reset", include_in_schema=False)
+    def bench_stats_reset():
+        counter.reset()
+        return counter.snapshot()
+
+    app.add_middleware(StageMiddleware, counter=counter)
+    return app
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    # 便于在笔记本上直接运行：默认使用 SQLite 和本地 stub 推理服务
+    os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.abspath("bench.db"))
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    os.environ.setdefault("LLM_SERVICE_URLS", "http://127.0.0.1:8001/api/qwen3/generate")
+
+    import uvicorn
+
+    uvicorn.run(create_app(), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
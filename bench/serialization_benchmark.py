@@ -0,0 +1,52 @@
+"""
+Time the orjson read path against the pydantic response models.
+
+    python bench/serialization_benchmark.py --stories 200 --nodes 300
+
+Random trees (see backend/tests/story_samples.py) are serialized with
+``serialize_complete_story`` and with ``model_dump_json`` of
+CompleteStoryResponse. That both produce the same bytes is checked by
+backend/tests/test_story_serialization.py.
+"""
+import argparse
+import os
+import sys
+import time
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Time the orjson and pydantic story serializers")
+    parser.add_argument("--stories", type=int, default=200)
+    parser.add_argument("--nodes", type=int, default=300, help="maximum nodes per story")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    sys.path.insert(0, BACKEND_DIR)
+    os.environ.setdefault("DATABASE_URL", "sqlite://")
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    from core.story_cache import build_complete_story_response, serialize_complete_story
+    from tests.story_samples import random_stories
+
+    samples = random_stories(args.seed, args.stories, args.nodes)
+
+    total_nodes = sum(len(nodes) for _, nodes in samples)
+    started = time.perf_counter()
+    for story, nodes in samples:
+        build_complete_story_response(story, nodes).model_dump_json()
+    pydantic_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for story, nodes in samples:
+        serialize_complete_story(story, nodes)
+    orjson_time = time.perf_counter() - started
+
+    print(f"{len(samples)} stories, {total_nodes} nodes")
+    print(f"pydantic models: {pydantic_time * 1000:.1f} ms  ({len(samples) / pydantic_time:.0f} stories/s)")
+    print(f"orjson:          {orjson_time * 1000:.1f} ms  ({len(samples) / orjson_time:.0f} stories/s)")
+    print(f"speedup:         {pydantic_time / orjson_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""
+Deterministic stand-in for the llm_servers Qwen3 API.
+
+Serves /api/qwen3/generate and /api/qwen3/generate/stream with valid story
+JSON (or, for the lazy-mode tasks, a root with option stubs or a single
+node; for repairs, the subtree behind one choice), so the backend pipeline
+can be measured without a GPU:
+
+    python bench/stub_llm.py --port 8001 --latency 0.5 --tokens-per-sec 400 --depth 3 --branching 3
+
+The same prompt always produces the same story. ``--truncate-ratio`` cuts
+off that share of full-story answers to exercise the repair stage.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import re
+from typing import Any, Dict, List, Optional
+
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+# 粗略估算：平均每个 token 约 4 个字符
+CHARS_PER_TOKEN = 4
+
+
+class StubConfig(BaseModel):
+    latency: float = 0.5
+    tokens_per_sec: float = 400.0
+    depth: int = 3
+    branching: int = 3
+    ending_ratio: float = 0.3
+    truncate_ratio: float = 0.0
+
+
+class GenerateRequest(BaseModel):
+    prompt: str
+    max_nodes: Optional[int] = None
+    max_depth: Optional[int] = None
+    task: str = "story"
+
+
+def build_story(prompt: str, config: StubConfig, depth: Optional[int] = None) -> Dict[str, Any]:
+    rng = random.Random(hashlib.sha256(prompt.encode("utf-8")).hexdigest())
+    theme = prompt.split(":")[-1].strip() or "adventure"
+    counter = [0]
+    depth = depth or config.depth
+
+    def node(level: int) -> Dict[str, Any]:
+        counter[0] += 1
+        number = counter[0]
+        is_ending = level >= depth or (level > 1 and rng.random() < config.ending_ratio)
+        content = f"Scene {number} of the {theme} story. " + " ".join(
+            rng.choice(["The", "wind", "whispers", "a", "secret", "door", "opens", "beyond", "the", "hill"])
+            for _ in range(rng.randint(20, 40))
+        )
+        data = {
+            "content": content,
+            "isEnding": is_ending,
+            "isWinningEnding": is_ending and rng.random() < 0.5,
+            "options": [],
+        }
+        if not is_ending:
+            data["options"] = [
+                {"text": f"Choice {number}.{i + 1}", "nextNode": node(level + 1)}
+                for i in range(config.branching)
+            ]
+        return data
+
+    root = node(1)
+    # 保证至少有一个胜利结局
+    cursor = root
+    while cursor["options"]:
+        cursor = cursor["options"][0]["nextNode"]
+    cursor["isWinningEnding"] = True
+    return {"title": f"The {theme.title()} Chronicle", "rootNode": root}
+
+
+def build_answer(request: GenerateRequest, config: StubConfig) -> str:
+    story = build_story(request.prompt, config)
+    if request.task == "lazy_story":
+        root = story["rootNode"]
+        root["options"] = [{"text": option["text"]} for option in root["options"]]
+        return json.dumps(story, ensure_ascii=False, indent=2)
+    if request.task == "node":
+        node = story["rootNode"]["options"][0]["nextNode"] if story["rootNode"]["options"] else story["rootNode"]
+        if "must be an ending" in request.prompt:
+            node["isEnding"], node["options"] = True, []
+        node["options"] = [{"text": option["text"]} for option in node["options"]]
+        return json.dumps(node, ensure_ascii=False, indent=2)
+    if request.task == "branch":
+        limit = re.search(r"at most (\d+) scenes deep", request.prompt)
+        return json.dumps(
+            build_story(request.prompt, config, int(limit.group(1)) if limit else 1)["rootNode"],
+            ensure_ascii=False,
+            indent=2,
+        )
+
+    answer = json.dumps(story, ensure_ascii=False, indent=2)
+    rng = random.Random(hashlib.sha256(b"truncate" + request.prompt.encode("utf-8")).hexdigest())
+    if rng.random() < config.truncate_ratio:
+        # 模拟达到 token 上限：在前四分之一之后的任意位置截断
+        return answer[:rng.randint(len(answer) // 4, len(answer) - 1)]
+    return answer
+
+
+def split_pieces(text: str, size: int = CHARS_PER_TOKEN) -> List[str]:
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def create_app(config: StubConfig) -> FastAPI:
+    app = FastAPI(title="Stub Qwen3 API")
+
+    @app.post("/api/qwen3/generate")
+    async def generate(request: GenerateRequest):
+        answer = build_answer(request, config)
+        tokens = len(answer) / CHARS_PER_TOKEN
+        await asyncio.sleep(config.latency + tokens / config.tokens_per_sec)
+        return {"thinking_content": "", "answer": answer, "stop_reason": "json_complete"}
+
+    @app.post("/api/qwen3/generate/stream")
+    async def generate_stream(request: GenerateRequest):
+        answer = build_answer(request, config)
+
+        async def event_stream():
+            await asyncio.sleep(config.latency)
+            for piece in split_pieces(answer):
+                await asyncio.sleep(1 / config.tokens_per_sec)
+                yield f"data: {json.dumps({'text': piece}, ensure_ascii=False)}\n\n"
+            done = {"thinking_content": "", "answer": answer, "stop_reason": "json_complete"}
+            yield f"event: done\ndata: {json.dumps(done, ensure_ascii=False)}\n\n"
+
+        return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+    @app.get("/healthz")
+    async def healthz():
+        return {"status": "ok"}
+
+    return app
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=0.5, help="fixed seconds before the first token")
+    parser.add_argument("--tokens-per-sec", type=float, default=400.0)
+    parser.add_argument("--depth", type=int, default=3, help="tree depth including the root")
+    parser.add_argument("--branching", type=int, default=3, help="options per non-ending node")
+    parser.add_argument("--ending-ratio", type=float, default=0.3, help="chance an inner node is an early ending")
+    parser.add_argument("--truncate-ratio", type=float, default=0.0, help="share of story answers that are cut off")
+    args = parser.parse_args()
+
+    config = StubConfig(
+        latency=args.latency,
+        tokens_per_sec=args.tokens_per_sec,
+        depth=args.depth,
+        branching=args.branching,
+        ending_ratio=args.ending_ratio,
+        truncate_ratio=args.truncate_ratio,
+    )
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
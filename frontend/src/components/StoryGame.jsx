@@ -1,24 +1,37 @@
 import {useState, useEffect} from 'react';
 
-function StoryGame({story, onNewStory}) {
+function StoryGame({story, onNewStory, onExpandOption, onVisitNode}) {
     const [currentNodeId, setCurrentNodeId] = useState(null);
     const [currentNode, setCurrentNode] = useState(null);
     const [options, setOptions] = useState([]);
     const [isEnding, setIsEnding] = useState(false);
     const [isWinningEnding, setIsWinningEnding] = useState(false);
+    const [expanding, setExpanding] = useState(false);
+    const [expandError, setExpandError] = useState(null);
 
     useEffect(() => {
-        if (story && story.root_node) {
+        // 部分生成的故事会被刷新，不要把玩家重置回开头
+        if (story && story.root_node && !currentNodeId) {
             const rootNodeId = story.root_node.id
             setCurrentNodeId(rootNodeId)
         }
     }, [story])
 
+    useEffect(() => {
+        // 按需加载：让上层取回当前节点及其后续分支
+        if (currentNodeId && onVisitNode) {
+            onVisitNode(currentNodeId)
+        }
+    }, [currentNodeId])
+
     useEffect(() => {
         if (currentNodeId && story && story.all_nodes) {
             const node = story.all_nodes[currentNodeId]
 
-            setCurrentNode(node)
+            setCurrentNode(node || null)
+            if (!node) {
+                return
+            }
             setIsEnding(node.is_ending)
             setIsWinningEnding(node.is_winning_ending)
 
@@ -30,8 +43,23 @@ function StoryGame({story, onNewStory}) {
         }
     }, [currentNodeId, story])
 
-    const chooseOption = (optionnId) => {
-        setCurrentNodeId(optionnId)
+    const chooseOption = async (option, index) => {
+        if (option.node_id) {
+            setCurrentNodeId(option.node_id)
+            return
+        }
+        if (!onExpandOption || expanding) {
+            return
+        }
+        setExpanding(true)
+        setExpandError(null)
+        try {
+            setCurrentNodeId(await onExpandOption(currentNodeId, index))
+        } catch (e) {
+            setExpandError(`Failed to continue the story: ${e.message}`)
+        } finally {
+            setExpanding(false)
+        }
     }
 
     const restartStory = () => {
@@ -45,6 +73,7 @@ function StoryGame({story, onNewStory}) {
             <h2>{story.title}</h2>
         </header>
         <div className='story-content'>
+            {!currentNode && currentNodeId && <p className='story-pending'>Loading...</p>}
             {currentNode && <div className='story-node'>
                 <p>{currentNode.content}</p>
 
@@ -56,12 +85,17 @@ function StoryGame({story, onNewStory}) {
                     :
                     <div className='story-options'>
                         <h3>What will you do?</h3>
+                        {options.length === 0 && story.is_complete === false &&
+                            <p className='story-pending'>The next part of the story is still being written...</p>}
+                        {expanding && <p className='story-pending'>Writing what happens next...</p>}
+                        {expandError && <p className='error-message'>{expandError}</p>}
                         <div className='options-list'>
                             {options.map((option, index) => {
                                 return <button
                                     key={index}
-                                    onClick={() => chooseOption(option.node_id)}
+                                    onClick={() => chooseOption(option, index)}
                                     className='option-btn'
+                                    disabled={expanding}
                                     >
                                     {option.text}
                                     </button>
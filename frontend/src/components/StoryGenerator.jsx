@@ -15,63 +15,93 @@ function StoryGenerator() {
     const [loading, setLoading] = useState(false)
 
     useEffect(() => {
-        let pollInterval
+        if (!jobId || !["pending", "processing"].includes(jobStatus)) {
+            return
+        }
+
+        let cancelled = false
+        let source = null
+
+        const longPollJobStatus = async () => {
+            while (!cancelled) {
+                const status = await pollJobStatus(jobId, 30)
+                if (!status || status === "completed" || status === "failed") {
+                    break
+                }
+            }
+        }
 
-        if (jobId && jobStatus === "processing") {
-            pollInterval = setInterval(() => {
-                pollJobStatus(jobId)
-            }, 5000)
+        if (window.EventSource) {
+            source = new EventSource(`${API_BASE_URL}/jobs/${jobId}/events`)
+            source.addEventListener("status", (event) => {
+                const status = handleJobStatus(JSON.parse(event.data))
+                if (status === "completed" || status === "failed") {
+                    source.close()
+                }
+            })
+            source.onerror = () => {
+                // SSE 不可用时退回到长轮询
+                source.close()
+                longPollJobStatus()
+            }
+        } else {
+            longPollJobStatus()
         }
 
         return () => {
-            if (pollInterval) {
-                clearInterval(pollInterval)
+            cancelled = true
+            if (source) {
+                source.close()
             }
         }
-    }, [jobId, jobStatus])
+    }, [jobId])
 
-    const generateStory = async (theme) => {
+    const generateStory = async (theme, mode = "full") => {
         setLoading(true)
         setError(null)
         setTheme(theme)
 
         try {
-            const response = await axios.post(`${API_BASE_URL}/stories/create`, {theme})
+            const response = await axios.post(`${API_BASE_URL}/stories/create`, {theme, mode})
             const {job_id, status} = response.data
             setJobId(job_id)
             setJobStatus(status)
-
-            pollJobStatus(job_id)
         } catch (e) {
             setLoading(false)
             setError(`Failed to generate story: ${e.message}`)
         }
     }
 
-    const pollJobStatus = async (id) => {
-        try {
-            const response = await axios.get(`${API_BASE_URL}/jobs/${id}`)
-            const {status, story_id, error:jobError} = response.data
-            setJobStatus(status)
+    const handleJobStatus = ({status, story_id, error:jobError}) => {
+        setJobStatus(status)
 
-            if (status === "completed" && story_id) {
-                fetchStory(story_id)
-            } else if (status === "failed" || jobError) {
-                setError(jobError || `Failed to generate story`)
-                setLoading(false)
-            }
+        // 根节点写入后即可开始游戏，其余分支在后台继续生成
+        if (story_id && status !== "failed") {
+            fetchStory(story_id)
+        } else if (status === "failed" || jobError) {
+            setError(jobError || `Failed to generate story`)
+            setLoading(false)
+        }
+        return status
+    }
+
+    const pollJobStatus = async (id, wait = 0) => {
+        try {
+            const response = await axios.get(`${API_BASE_URL}/jobs/${id}`, {params: {wait}})
+            return handleJobStatus(response.data)
         } catch (e) {
             if (e.response?.status !== 404) {
                 setError(`Failed to check story status: ${e.message}`)
                 setLoading(false)
             }
+            return null
         }
     }
 
     const fetchStory = async (id) => {
         try {
             setLoading(false)
-            setJobStatus("completed")
+            setJobStatus(null)
             navigate(`/story/${id}`)
         } catch (e) {
             setError(`Failed to load story: ${e.message}`)
@@ -1,4 +1,4 @@
-import { useState, useEffect } from "react"
+import { useState, useEffect, useRef } from "react"
 import {useParams, useNavigate} from "react-router-dom"
 import axios from "axios"
 import LodingStatus  from "./LoadingStatus.jsx"
@@ -7,24 +7,88 @@ import {API_BASE_URL} from "../util.js"
 
 // const API_BASE_URL = "/api"
 
+// 每次加载一个节点时一并取回的后代层数，玩家的下一次选择无需等待
+const NODE_PREFETCH_DEPTH = 2
+
+function withNodes(story, nodes) {
+    const allNodes = {...story.all_nodes, ...nodes}
+    return {...story, all_nodes: allNodes, root_node: allNodes[story.root_id]}
+}
+
 function StoryLoader() {
     const {id} = useParams();
     const navigate = useNavigate();
     const [story, setStory] = useState(null);
     const [loading, setLoading] = useState(true);
     const [error, setError] = useState(null);
+    const currentNodeId = useRef(null);
 
     useEffect(() => {
         loadStory(id)
     }, [id])
 
+    useEffect(() => {
+        // 故事仍在生成中：定期刷新以获取新写入的分支
+        if (!story || story.is_complete !== false) {
+            return
+        }
+        const timer = setTimeout(() => refreshStory(id), 2000)
+        return () => clearTimeout(timer)
+    }, [story, id])
+
+    const fetchNodes = async (storyId, nodeId) => {
+        const response = await axios.get(
+            `${API_BASE_URL}/stories/${storyId}/nodes/${nodeId}`,
+            {params: {depth: NODE_PREFETCH_DEPTH}}
+        )
+        return response.data.nodes
+    }
+
+    const refreshStory = async (storyId) => {
+        try {
+            const outline = await axios.get(`${API_BASE_URL}/stories/${storyId}/outline`)
+            const nodes = await fetchNodes(storyId, currentNodeId.current || outline.data.root_id)
+            setStory((current) => withNodes({...current, is_complete: outline.data.is_complete}, nodes))
+        } catch (err) {
+            setStory({...story})
+        }
+    }
+
+    const loadNodes = async (nodeId) => {
+        try {
+            const nodes = await fetchNodes(id, nodeId)
+            setStory((current) => withNodes(current, nodes))
+        } catch (err) {
+            setError("Failed to load story.")
+        }
+    }
+
+    const visitNode = (nodeId) => {
+        // 只在当前节点或其子节点尚未加载时请求
+        currentNodeId.current = nodeId
+        const node = story.all_nodes[nodeId]
+        const loaded = node && node.options.every((option) => !option.node_id || story.all_nodes[option.node_id])
+        if (!loaded) {
+            loadNodes(nodeId)
+        }
+    }
+
     const loadStory = async (storyId) => {
         setLoading(true);
         setError(null);
+        currentNodeId.current = null
 
         try {
-            const response = await axios.get(`${API_BASE_URL}/stories/${storyId}/complete`)
-            setStory(response.data);
+            const outline = (await axios.get(`${API_BASE_URL}/stories/${storyId}/outline`)).data
+            const nodes = await fetchNodes(storyId, outline.root_id)
+            setStory(withNodes({
+                id: outline.id,
+                title: outline.title,
+                root_id: outline.root_id,
+                is_complete: outline.is_complete,
+                mode: outline.mode,
+                all_nodes: {},
+            }, nodes));
             setLoading(false)
         } catch (err) {
             if (err.response?.status === 404) {
@@ -38,6 +102,23 @@ function StoryLoader() {
         
     }
 
+    const expandOption = async (nodeId, optionIndex) => {
+        // 懒生成模式：首次选择某个选项时才生成其后续节点
+        const response = await axios.post(
+            `${API_BASE_URL}/stories/${id}/nodes/${nodeId}/expand`,
+            {option_index: optionIndex}
+        )
+        const child = response.data
+        setStory((current) => {
+            const parent = current.all_nodes[nodeId]
+            const options = parent.options.map((option, index) =>
+                index === optionIndex ? {...option, node_id: child.id} : option
+            )
+            return withNodes(current, {[nodeId]: {...parent, options}, [child.id]: child})
+        })
+        return child.id
+    }
+
     const createNewStory = () => {
         navigate("/")
     }
@@ -58,7 +139,12 @@ function StoryLoader() {
 
     if (story) {
         return <div className="story-loader">
-            <StoryGame story={story} onNewStory={createNewStory}/>
+            <StoryGame
+                story={story}
+                onNewStory={createNewStory}
+                onExpandOption={expandOption}
+                onVisitNode={visitNode}
+            />
         </div>
     }
 }
@@ -3,6 +3,7 @@ import {useState} from 'react'
 function ThemeInput({onSubmit}) {
     const [theme, setTheme] = useState('')
     const [error, setError] = useState('')
+    const [lazy, setLazy] = useState(false)
 
     const handleSubmit = (e) => {
         e.preventDefault();
@@ -12,7 +13,7 @@ function ThemeInput({onSubmit}) {
             return
         }
 
-        onSubmit(theme);
+        onSubmit(theme, lazy ? 'lazy' : 'full');
     }
 
     return <div className='theme-input-container'>
@@ -30,6 +31,14 @@ function ThemeInput({onSubmit}) {
                 />
                 {error && <p className='error-text'>{error}</p>}
             </div>
+            <label className='mode-toggle'>
+                <input
+                    type='checkbox'
+                    checked={lazy}
+                    onChange={(e) => setLazy(e.target.checked)}
+                />
+                Quick start (write each branch when you choose it)
+            </label>
             <button type='submit' className='generate-btn'>
                 Generate Story
             </button>
@@ -1,4 +1,4 @@
-from typing import List
+from typing import Dict, List, Optional
 from pydantic_settings import BaseSettings
 # from pydantic import field_validator
 
@@ -7,13 +7,68 @@ class Settings(BaseSettings):
     API_PREFIX: str = "/api"
     DEBUG: bool = False
 
+    # 日志：json（每行一个 JSON 对象，带后端传来的 job_id）或 text（本地开发）
+    LOG_LEVEL: str = "INFO"
+    LOG_FORMAT: str = "json"
+
     LLM_PATH: str
     TTS_PATH: str
-    
+
+    MAX_NEW_TOKENS: int = 32768
+
+    # 推理后端：cuda（bitsandbytes 4-bit）、cpu，或 auto（有 GPU 时用 cuda，否则用 cpu）
+    INFERENCE_BACKEND: str = "auto"
+    # CPU 后端：int8 为 Linear 层动态量化（其余 fp32）；none 按 CPU_DTYPE 直接加载
+    CPU_QUANTIZATION: str = "int8"
+    CPU_DTYPE: str = "bfloat16"
+    # 推理线程数，None 表示使用 torch 默认值（全部物理核）
+    CPU_NUM_THREADS: Optional[int] = None
+
+    # 量化后的模型导出到本地 safetensors 缓存，之后的启动直接内存映射加载，不再重新量化；为空表示关闭
+    QUANTIZED_CACHE_DIR: Optional[str] = "model_cache"
+    # 启动时的预热生成长度，0 表示不预热
+    WARMUP_NEW_TOKENS: int = 8
+
+    # 故事 JSON 闭合即停止生成，以及默认的节点预算（None 表示不限制）
+    STOP_ON_JSON_COMPLETE: bool = True
+    STORY_MAX_NODES: Optional[int] = None
+    STORY_MAX_DEPTH: Optional[int] = None
+
+    # 按任务的 JSON schema 约束解码，保证输出一次就能解析；请求里的 constrained 优先于这个默认值
+    CONSTRAINED_DECODING_DEFAULT: bool = False
+    # 启动时建好词表的字节表和各任务首步的掩码
+    CONSTRAINED_DECODING_PRECOMPILE: bool = True
+
+    # 系统提示前缀 KV 缓存
+    PREFIX_CACHE_ENABLED: bool = True
+
+    # 推测解码：与主模型共用分词器的小草稿模型（如 Qwen3-0.6B），为空表示关闭
+    DRAFT_MODEL_PATH: Optional[str] = None
+    # 每轮草稿 token 数；heuristic 按接受情况自动增减，constant 固定不变
+    DRAFT_NUM_TOKENS: int = 5
+    DRAFT_SCHEDULE: str = "heuristic"
+    # 不使用草稿模型的请求比例，用于持续测量加速比的基线
+    DRAFT_BASELINE_FRACTION: float = 0.05
+
+    # LoRA 适配器：名称到路径（JSON），启动时注册，前 ADAPTER_MAX_LOADED 个预加载，其余首次使用时加载
+    ADAPTERS: Dict[str, str] = {}
+    # 同时留在内存中的适配器个数，超出时卸载最久未用的
+    ADAPTER_MAX_LOADED: int = 4
+    # 管理接口（加载、卸载适配器）要求的 X-Admin-Token；为空时不提供管理接口
+    ADMIN_TOKEN: Optional[str] = None
+
+    # 动态批处理
+    BATCH_ENABLED: bool = True
+    BATCH_MAX_SIZE: int = 8
+    BATCH_WINDOW_MS: int = 20
+    BATCH_STEP_TOKENS: int = 64
+    # 关闭批处理时同时进行的流式生成个数（每个占一个生成线程）
+    STREAM_MAX_CONCURRENCY: int = 4
+
     class Config:
         env_file = ".env"
         env_file_encoding = "utf-8"
         case_sensitive = True
-    
 
-settings = Settings()
\ No newline at end of file
+
+settings = Settings()
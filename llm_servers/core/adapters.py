@@ -0,0 +1,213 @@
+import logging
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager, nullcontext
+from typing import ContextManager, Dict, Iterator, List, Optional
+
+from core.metrics import ADAPTER_LOAD_DURATION, ADAPTER_SWITCHES, ADAPTERS_LOADED
+from load_llm import get_backend, get_model
+
+logger = logging.getLogger(__name__)
+
+# 模型上当前生效的适配器未知（加载失败或卸载之后），下次使用时重新设置
+_UNKNOWN = object()
+
+
+class AdapterRegistry:
+    """
+    Named LoRA adapters on top of the one base model.
+
+    Adapters are registered by name and path and loaded into the base model
+    on first use. At most ``max_loaded`` stay in memory; loading another one
+    unloads the least recently used.
+
+    The active adapter is model state, so ``use`` gates every generate call:
+    calls for the active adapter (or for the plain base model, ``None``) run
+    together, and a call for another adapter waits until they have finished.
+    While a call waits for a switch, new calls for the active adapter wait
+    too, so neither side starves.
+
+    The batch scheduler, which also serves streams, enters the gate once per
+    decode step, so a switch waits for at most one step of the other
+    adapter. Without the scheduler a call holds it for its whole generate.
+    """
+
+    def __init__(self, max_loaded: int) -> None:
+        self.max_loaded = max(1, max_loaded)
+        self._paths: Dict[str, str] = {}
+        # 已加载的适配器，按最近使用排序（最近的在最后）
+        self._loaded: "OrderedDict[str, float]" = OrderedDict()
+        self._cond = threading.Condition()
+        self._active = _UNKNOWN
+        self._users = 0
+        self._busy = False
+        self._waiting: Counter = Counter()
+
+    def is_registered(self, name: str) -> bool:
+        return name in self._paths
+
+    def list(self) -> List[Dict[str, object]]:
+        with self._cond:
+            return [
+                {
+                    "name": name,
+                    "path": path,
+                    "loaded": name in self._loaded,
+                    "active": name == self._active and self._users > 0,
+                    "last_used": self._loaded.get(name),
+                }
+                for name, path in sorted(self._paths.items())
+            ]
+
+    def register(self, name: str, path: str, preload: bool = True) -> None:
+        """Register (or re-point) an adapter; ``preload`` loads it now instead of on first use."""
+        backend = get_backend()
+        if backend is not None and not backend.supports_adapters:
+            raise ValueError(f"The {backend.describe()} backend cannot serve LoRA adapters")
+        if self._paths.get(name) != path:
+            if name in self._paths:
+                self.unload(name)
+            with self._cond:
+                self._paths[name] = path
+        if preload:
+            try:
+                with self.use(name):
+                    pass
+            except BaseException:
+                with self._cond:
+                    self._paths.pop(name, None)
+                raise
+
+    def unload(self, name: str) -> None:
+        """Remove an adapter from memory and from the registry once no request is using it."""
+        with self._exclusive():
+            if name not in self._paths:
+                raise ValueError(f"Unknown adapter {name!r}")
+            if name in self._loaded:
+                self._delete(name)
+            with self._cond:
+                self._paths.pop(name)
+
+    @contextmanager
+    def use(self, name: Optional[str]) -> Iterator[None]:
+        """Run the enclosed generate calls with adapter ``name`` active (``None``: the base model)."""
+        with self._cond:
+            if name is not None and name not in self._paths:
+                raise ValueError(f"Unknown adapter {name!r}")
+            self._waiting[name] += 1
+            try:
+                self._cond.wait_for(lambda: self._can_enter(name))
+            finally:
+                self._waiting[name] -= 1
+            self._users += 1
+            switch = self._active != name
+            if switch:
+                self._busy = True
+        try:
+            if switch:
+                self._switch(name)
+            yield
+        finally:
+            with self._cond:
+                self._users -= 1
+                if name in self._loaded:
+                    self._loaded[name] = time.time()
+                    self._loaded.move_to_end(name)
+                self._cond.notify_all()
+
+    def _can_enter(self, name: Optional[str]) -> bool:
+        if self._busy:
+            return False
+        others_waiting = any(count for other, count in self._waiting.items() if other != name)
+        if self._users == 0:
+            # 空闲时优先切换到其他适配器，避免当前适配器的请求源源不断地插队
+            return self._active != name or not others_waiting
+        return self._active == name and not others_waiting
+
+    def _switch(self, name: Optional[str]) -> None:
+        """Activate ``name``; the caller is the only user of the model."""
+        active = _UNKNOWN
+        try:
+            model = get_model()
+            if name is None:
+                if getattr(model, "_hf_peft_config_loaded", False):
+                    model.disable_adapters()
+            else:
+                if name not in self._loaded:
+                    self._load(name)
+                model.enable_adapters()
+                model.set_adapter(name)
+            active = name
+            ADAPTER_SWITCHES.inc()
+        finally:
+            with self._cond:
+                self._active = active
+                self._busy = False
+                self._cond.notify_all()
+
+    def _load(self, name: str) -> None:
+        while len(self._loaded) >= self.max_loaded:
+            evicted = next(iter(self._loaded))
+            logger.info(f"Unloading least recently used adapter {evicted}")
+            self._delete(evicted)
+        started = time.perf_counter()
+        get_model().load_adapter(self._paths[name], adapter_name=name)
+        ADAPTER_LOAD_DURATION.observe(time.perf_counter() - started)
+        with self._cond:
+            self._loaded[name] = time.time()
+        ADAPTERS_LOADED.set(len(self._loaded))
+        logger.info(f"Loaded adapter {name} from {self._paths[name]}")
+
+    def _delete(self, name: str) -> None:
+        get_model().delete_adapter(name)
+        with self._cond:
+            self._loaded.pop(name)
+        ADAPTERS_LOADED.set(len(self._loaded))
+
+    @contextmanager
+    def _exclusive(self) -> Iterator[None]:
+        with self._cond:
+            self._cond.wait_for(lambda: self._users == 0 and not self._busy)
+            self._busy = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._active = _UNKNOWN
+                self._busy = False
+                self._cond.notify_all()
+
+
+registry: Optional[AdapterRegistry] = None
+
+
+def start_registry(adapters: Dict[str, str], max_loaded: int) -> AdapterRegistry:
+    """Register the configured adapters and load as many as stay in memory."""
+    global registry
+    registry = AdapterRegistry(max_loaded)
+    for index, (name, path) in enumerate(adapters.items()):
+        registry.register(name, path, preload=index < registry.max_loaded)
+    # 预加载会切换到最后一个适配器；恢复为基础模型
+    with registry.use(None):
+        pass
+    return registry
+
+
+def stop_registry() -> None:
+    global registry
+    registry = None
+
+
+def get_registry() -> Optional[AdapterRegistry]:
+    """获取 LoRA 适配器注册表的函数"""
+    return registry
+
+
+def use_adapter(name: Optional[str]) -> ContextManager[None]:
+    """``AdapterRegistry.use`` for one generate call; without a registry only the base model is available."""
+    if registry is None:
+        if name is not None:
+            raise ValueError(f"Unknown adapter {name!r}")
+        return nullcontext()
+    return registry.use(name)
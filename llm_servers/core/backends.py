@@ -0,0 +1,182 @@
+import logging
+from contextlib import nullcontext
+from typing import Any, Callable, ContextManager, Dict, Optional
+
+import torch
+from transformers import AutoModelForCausalLM, BitsAndBytesConfig
+
+logger = logging.getLogger(__name__)
+
+# 启动阶段计时：load_llm 传入 startup_phase，基准脚本里不计时
+Phase = Callable[[str], ContextManager[None]]
+
+DTYPES = {"float32": torch.float32, "bfloat16": torch.bfloat16, "float16": torch.float16}
+
+
+def _no_phase(name: str) -> ContextManager[None]:
+    return nullcontext()
+
+
+class InferenceBackend:
+    """
+    How the main model is loaded and prepared for the hardware of this node.
+
+    Every backend returns a transformers model, so everything built on
+    ``model.generate`` (schema constraints, JSON stopping, the prefix cache,
+    the draft model and batching) runs unchanged on all of them.
+    """
+
+    name = "base"
+    # 导出缓存目录名中的量化标记；None 表示加载结果不能导出（每次启动重新准备）
+    cache_tag: Optional[str] = None
+    # 能否在模型上挂载 LoRA 适配器
+    supports_adapters = True
+
+    def cache_key(self) -> Dict[str, Any]:
+        """Settings that change the exported weights, part of the cache directory key."""
+        return {"backend": self.name}
+
+    def load(self, llm_path: str, phase: Phase = _no_phase):
+        raise NotImplementedError
+
+    def load_exported(self, cache_path: str):
+        raise NotImplementedError(f"Backend {self.name} cannot load an exported model")
+
+    def describe(self) -> str:
+        return self.name
+
+
+class CudaBackend(InferenceBackend):
+    """bitsandbytes 4-bit NF4 weights with fp16 compute on the GPU."""
+
+    name = "cuda"
+    cache_tag = "nf4"
+
+    def quantization_config(self) -> BitsAndBytesConfig:
+        return BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_use_double_quant=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=torch.float16
+        )
+
+    def cache_key(self) -> Dict[str, Any]:
+        return {"backend": self.name, "quantization": self.quantization_config().to_dict()}
+
+    def load(self, llm_path: str, phase: Phase = _no_phase):
+        with phase("quantize"):
+            return AutoModelForCausalLM.from_pretrained(
+                llm_path,
+                quantization_config=self.quantization_config(),
+                device_map="auto",
+                low_cpu_mem_usage=True,
+                trust_remote_code=True,
+                dtype=torch.float16
+            )
+
+    def load_exported(self, cache_path: str):
+        # 量化配置保存在缓存的 config.json 里，权重已是 4-bit
+        return AutoModelForCausalLM.from_pretrained(
+            cache_path,
+            device_map="auto",
+            low_cpu_mem_usage=True,
+            trust_remote_code=True,
+            dtype=torch.float16
+        )
+
+
+class CpuBackend(InferenceBackend):
+    """
+    CPU inference without bitsandbytes or fp16 kernels.
+
+    ``int8`` applies dynamic quantization to the Linear layers: int8
+    weights, activations quantized per batch, fp32 everywhere else. The
+    output projection stays in fp32 so the logits (and the schema masks
+    applied to them) keep full precision. ``none`` loads the weights in
+    ``dtype`` as they are; bfloat16 only pays off on CPUs with native bf16
+    support (AVX512-BF16 or AMX).
+    """
+
+    name = "cpu"
+    QUANTIZATIONS = ("int8", "none")
+
+    def __init__(self, quantization: str = "int8", dtype: str = "bfloat16", num_threads: Optional[int] = None) -> None:
+        if quantization not in self.QUANTIZATIONS:
+            raise ValueError(f"Unknown CPU quantization {quantization!r}, expected one of {self.QUANTIZATIONS}")
+        if dtype not in DTYPES:
+            raise ValueError(f"Unknown CPU dtype {dtype!r}, expected one of {tuple(DTYPES)}")
+        self.quantization = quantization
+        self.dtype = dtype
+        self.num_threads = num_threads
+        # peft 不能包装动态量化后的 Linear 层
+        self.supports_adapters = quantization != "int8"
+
+    def describe(self) -> str:
+        precision = "int8" if self.quantization == "int8" else self.dtype
+        return f"{self.name} ({precision}, {torch.get_num_threads()} threads)"
+
+    def configure_threads(self) -> None:
+        # torch 默认使用全部物理核；与其他进程共享节点时用 CPU_NUM_THREADS 限制
+        if self.num_threads:
+            torch.set_num_threads(self.num_threads)
+
+    def load(self, llm_path: str, phase: Phase = _no_phase):
+        self.configure_threads()
+        with phase("load"):
+            # int8 量化前按 bf16 读入：逐层量化时内存峰值约为 bf16 权重，而不是整份 fp32
+            dtype = torch.bfloat16 if self.quantization == "int8" else DTYPES[self.dtype]
+            model = AutoModelForCausalLM.from_pretrained(
+                llm_path,
+                low_cpu_mem_usage=True,
+                trust_remote_code=True,
+                dtype=dtype
+            ).eval()
+        if self.quantization == "int8":
+            with phase("quantize"):
+                quantize_linear_int8(model)
+        return model
+
+
+def quantize_linear_int8(model) -> None:
+    """Dynamic int8 quantization of every Linear layer except the output projection, in place."""
+    torch.ao.quantization.quantize_dynamic(
+        model,
+        {torch.nn.Linear: torch.ao.quantization.default_dynamic_qconfig, "lm_head": None},
+        dtype=torch.qint8,
+        inplace=True,
+    )
+    # 动态量化的 Linear 以 fp32 计算，嵌入、归一化和输出层随之转为 fp32
+    model.float()
+
+
+def weight_bytes(model) -> int:
+    """
+    Memory of the model weights. ``get_memory_footprint`` only counts
+    parameters and buffers, which misses the packed int8 weights of
+    dynamically quantized layers.
+    """
+    total = model.get_memory_footprint()
+    for module in model.modules():
+        if isinstance(module, torch.ao.nn.quantized.dynamic.Linear):
+            weight = module.weight()
+            total += weight.numel() * weight.element_size()
+            bias = module.bias()
+            if bias is not None:
+                total += bias.numel() * bias.element_size()
+    return total
+
+
+def build_backend(
+    name: str,
+    cpu_quantization: str = "int8",
+    cpu_dtype: str = "bfloat16",
+    cpu_num_threads: Optional[int] = None,
+) -> InferenceBackend:
+    """``auto`` picks the GPU backend when CUDA is available and the CPU backend otherwise."""
+    if name == "auto":
+        name = "cuda" if torch.cuda.is_available() else "cpu"
+    if name == "cuda":
+        return CudaBackend()
+    if name == "cpu":
+        return CpuBackend(cpu_quantization, cpu_dtype, cpu_num_threads)
+    raise ValueError(f"Unknown inference backend {name!r}, expected auto, cuda or cpu")
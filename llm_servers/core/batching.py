@@ -0,0 +1,534 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Callable, Dict, List, Optional, Set
+
+import torch
+from transformers import DynamicCache, LogitsProcessorList, StoppingCriteriaList
+from transformers.generation.streamers import BaseStreamer
+
+from config import settings
+from core.adapters import use_adapter
+from core.log_context import job_id_var
+from core.constrained import JsonConstraint, JsonSchemaLogitsProcessor
+from core.metrics import BATCH_SIZE, OUTPUT_TOKENS, PREFILL_DURATION, QUEUE_WAIT, TOKENIZE_DURATION, TokenTimer
+from core.qwen3 import LLMQwen
+from core import speculative
+from core.stopping import CancelStoppingCriteria, JsonStoryTracker, JsonStoryStoppingCriteria
+from schemas.qwen3 import GenerateResponse
+
+logger = logging.getLogger(__name__)
+
+# 调度器还没有运行过任何适配器分组
+_NO_TURN = object()
+
+
+@dataclass
+class _Sequence:
+    """One pending request inside the scheduler."""
+
+    prompt_ids: List[int]
+    future: asyncio.Future
+    max_new_tokens: int
+    tracker: Optional[JsonStoryTracker] = None
+    constraint: Optional[JsonConstraint] = None
+    task: str = "story"
+    adapter: Optional[str] = None
+    job_id: Optional[str] = None
+    use_draft: bool = False
+    speculation: speculative.SpeculationStats = field(default_factory=speculative.SpeculationStats)
+    queued_at: float = field(default_factory=time.perf_counter)
+    started: bool = False
+    output_ids: List[int] = field(default_factory=list)
+    finished: bool = False
+    # 流式请求：生成的 token 逐个放入队列，结束时放入 None
+    tokens: Optional[asyncio.Queue] = None
+
+    @property
+    def remaining(self) -> int:
+        return self.max_new_tokens - len(self.output_ids)
+
+    @property
+    def input_ids(self) -> List[int]:
+        return self.prompt_ids + self.output_ids
+
+    def check_tracker(self) -> None:
+        """Finish once the tracker stopped on a token that is already in ``output_ids``."""
+        if self.tracker and self.tracker.stopped and len(self.output_ids) >= self.tracker.num_tokens:
+            self.finished = True
+
+    def accept(self, token_id: int, eos_ids: Set[int]) -> None:
+        """Take one generated token; tokens after the end of the sequence (padding) are dropped."""
+        # 停止条件在 streamer 之后才看到 token，所以上一个 token 触发的停止在这里检查
+        self.check_tracker()
+        if self.finished or self.future.done():
+            return
+        if token_id in eos_ids:
+            self.finished = True
+            return
+        self.output_ids.append(token_id)
+        if self.tokens is not None:
+            self.future.get_loop().call_soon_threadsafe(self.tokens.put_nowait, token_id)
+        if self.remaining <= 0:
+            self.finished = True
+
+
+class _StepStreamer(BaseStreamer):
+    """
+    Hands the tokens of one decode step to the sequences of the batch as
+    generate() produces them. A plain step puts one token per row (a 1-d
+    tensor), an assisted step the accepted tokens of its single row.
+    """
+
+    def __init__(self, batch: List[_Sequence], eos_ids: Set[int]) -> None:
+        self.batch = batch
+        self.eos_ids = eos_ids
+        self._prompt_seen = False
+
+    def put(self, value) -> None:
+        if not self._prompt_seen:
+            self._prompt_seen = True
+            return
+        if value.dim() == 1:
+            value = value[:, None]
+        for seq, token_ids in zip(self.batch, value.tolist()):
+            for token_id in token_ids:
+                seq.accept(token_id, self.eos_ids)
+
+    def end(self) -> None:
+        pass
+
+
+class _BatchCache:
+    """
+    KV cache of the rows of one adapter group, kept from step to step.
+
+    Rows are left-padded to the longest one and the cache covers every
+    column but the last, so a step only feeds each row's last token instead
+    of prefilling prompt and output again. A request joining the group is
+    prefilled on its own (from the system prefix cache where it applies)
+    and merged in; rows that leave are cut out, together with the padding
+    columns no remaining row needs.
+    """
+
+    def __init__(self) -> None:
+        self.rows: List[_Sequence] = []
+        self.past_key_values: Optional[DynamicCache] = None
+
+    @property
+    def width(self) -> int:
+        return max(len(seq.input_ids) for seq in self.rows)
+
+    def clear(self) -> None:
+        self.rows = []
+        self.past_key_values = None
+
+    def sync(self, batch: List[_Sequence], model) -> None:
+        """Make the rows of the cache the sequences of ``batch``, in a stable order."""
+        members = {id(seq) for seq in batch}
+        keep = [i for i, seq in enumerate(self.rows) if id(seq) in members]
+        if len(keep) < len(self.rows):
+            self.rows = [self.rows[i] for i in keep]
+            if not self.rows:
+                self.past_key_values = None
+            else:
+                self.past_key_values.batch_select_indices(torch.tensor(keep, device=model.device))
+                _trim_left(self.past_key_values, self.past_key_values.get_seq_length() - (self.width - 1))
+
+        known = {id(seq) for seq in self.rows}
+        for seq in batch:
+            if id(seq) not in known:
+                self._join(seq, model)
+
+    def _join(self, seq: _Sequence, model) -> None:
+        input_ids = seq.input_ids
+        started = time.perf_counter()
+        past_key_values = LLMQwen.decoding_kwargs(input_ids, seq.task, False, seq.adapter).get("past_key_values")
+        if past_key_values is None or past_key_values.get_seq_length() >= len(input_ids) - 1:
+            past_key_values = DynamicCache(config=model.config)
+        start = past_key_values.get_seq_length()
+        model(
+            input_ids=torch.tensor([input_ids[start:-1]], device=model.device),
+            past_key_values=past_key_values,
+            use_cache=True,
+        )
+        PREFILL_DURATION.labels("batch").observe(time.perf_counter() - started)
+
+        if self.past_key_values is None:
+            self.past_key_values = past_key_values
+        else:
+            _merge_rows(self.past_key_values, past_key_values)
+        self.rows.append(seq)
+
+
+def _pad_left(tensor: torch.Tensor, columns: int) -> torch.Tensor:
+    if columns <= 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[-2] = columns
+    return torch.cat([tensor.new_zeros(shape), tensor], dim=-2)
+
+
+def _merge_rows(cache: DynamicCache, other: DynamicCache) -> None:
+    """Append the rows of ``other`` to ``cache``; the shorter side is left-padded (masked out by the attention mask)."""
+    length = max(cache.get_seq_length(), other.get_seq_length())
+    cache_pad = length - cache.get_seq_length()
+    other_pad = length - other.get_seq_length()
+    for layer, other_layer in zip(cache.layers, other.layers):
+        layer.keys = torch.cat([_pad_left(layer.keys, cache_pad), _pad_left(other_layer.keys, other_pad)], dim=0)
+        layer.values = torch.cat([_pad_left(layer.values, cache_pad), _pad_left(other_layer.values, other_pad)], dim=0)
+
+
+def _trim_left(cache: DynamicCache, columns: int) -> None:
+    """Drop leading padding columns that every row has."""
+    if columns <= 0:
+        return
+    for layer in cache.layers:
+        layer.keys = layer.keys[..., columns:, :]
+        layer.values = layer.values[..., columns:, :]
+
+
+class BatchScheduler:
+    """
+    Collects concurrent generate requests and runs them through one batched
+    ``model.generate``.
+
+    Decoding advances in steps of ``step_tokens``. After every step finished
+    sequences leave the batch and waiting requests take their slots, so a long
+    story does not hold back the requests queued behind it. The KV cache of
+    the batch carries over from step to step (see ``_BatchCache``), so every
+    token is prefilled once. A step with a single sequence decodes
+    speculatively when a draft model is loaded; assisted generation does not
+    support larger batches and keeps its own caches, so those steps prefill
+    the sequence again.
+
+    A step decodes the sequences of one LoRA adapter (or of the base model)
+    only, since the active adapter applies to the whole forward pass; the
+    adapters present in the batch take turns step by step.
+
+    Streamed requests (``stream``) decode in the same batches and receive
+    their tokens as each step produces them. A request whose future is
+    cancelled (client gone) stops at the next token.
+    """
+
+    def __init__(self, max_batch_size: int, window_ms: int, step_tokens: int) -> None:
+        self.max_batch_size = max_batch_size
+        self.window = window_ms / 1000
+        self.step_tokens = step_tokens
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._active: List[_Sequence] = []
+        self._last_adapter = _NO_TURN
+        # 每个适配器分组的 KV 缓存，只在执行器线程里读写
+        self._caches: Dict[Optional[str], _BatchCache] = {}
+        self._task: Optional[asyncio.Task] = None
+        # 单线程执行器：同一时刻只有一个批次占用模型
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="qwen3-batch")
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        for seq in self._active:
+            if not seq.future.done():
+                seq.future.cancel()
+        while not self._queue.empty():
+            self._queue.get_nowait().future.cancel()
+        self._executor.shutdown(wait=False)
+
+    def _sequence(
+        self,
+        prompt: str,
+        max_nodes: Optional[int],
+        max_depth: Optional[int],
+        task: str,
+        constrained: Optional[bool],
+        adapter: Optional[str],
+    ) -> _Sequence:
+        model, tokenizer = LLMQwen._get_llm()
+        with TOKENIZE_DURATION.labels(task).time():
+            prompt_ids = tokenizer(LLMQwen.build_chat_text(tokenizer, prompt, task)).input_ids
+        return _Sequence(
+            task=task,
+            adapter=adapter,
+            job_id=job_id_var.get(),
+            prompt_ids=prompt_ids,
+            future=asyncio.get_running_loop().create_future(),
+            max_new_tokens=settings.MAX_NEW_TOKENS,
+            tracker=LLMQwen.build_tracker(max_nodes, max_depth),
+            constraint=LLMQwen.build_constraint(model, tokenizer, task, constrained),
+            use_draft=speculative.use_draft(),
+        )
+
+    def _response(self, seq: _Sequence) -> GenerateResponse:
+        response = LLMQwen.decode_output(LLMQwen._get_llm()[1], seq.future.result(), seq.tracker)
+        response.speculative = seq.speculation.publish()
+        return response
+
+    async def submit(
+        self,
+        prompt: str,
+        max_nodes: Optional[int] = None,
+        max_depth: Optional[int] = None,
+        task: str = "story",
+        constrained: Optional[bool] = None,
+        adapter: Optional[str] = None,
+    ) -> GenerateResponse:
+        seq = self._sequence(prompt, max_nodes, max_depth, task, constrained, adapter)
+        await self._queue.put(seq)
+        await seq.future
+        return self._response(seq)
+
+    async def stream(
+        self,
+        prompt: str,
+        max_nodes: Optional[int] = None,
+        max_depth: Optional[int] = None,
+        task: str = "story",
+        on_finish: Optional[Callable[[GenerateResponse], None]] = None,
+        constrained: Optional[bool] = None,
+        adapter: Optional[str] = None,
+    ) -> AsyncIterator[str]:
+        """
+        Yield decoded text pieces as the batch steps produce tokens. Closing
+        the iterator early cancels the request. ``on_finish`` receives the
+        whole response, as with ``LLMQwen.stream_response``.
+        """
+        seq = self._sequence(prompt, max_nodes, max_depth, task, constrained, adapter)
+        seq.tokens = asyncio.Queue()
+        seq.future.add_done_callback(lambda _: seq.tokens.put_nowait(None))
+        text = _TextPieces(LLMQwen._get_llm()[1])
+        await self._queue.put(seq)
+        try:
+            while True:
+                token_id = await seq.tokens.get()
+                if token_id is None:
+                    break
+                piece = text.add(token_id)
+                if piece:
+                    yield piece
+            # 失败或被取消时在这里抛出
+            seq.future.result()
+            piece = text.flush()
+            if piece:
+                yield piece
+        finally:
+            if not seq.future.done():
+                seq.future.cancel()
+        if on_finish is not None:
+            on_finish(self._response(seq))
+
+    async def _collect(self) -> None:
+        """Wait up to the batching window for more requests to arrive."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.window
+        while len(self._active) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                self._active.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+    def _admit_waiting(self) -> None:
+        """Move queued requests into free slots without waiting."""
+        while len(self._active) < self.max_batch_size and not self._queue.empty():
+            self._active.append(self._queue.get_nowait())
+
+    def _next_group(self) -> List[_Sequence]:
+        """The active sequences of the adapter whose turn it is, in order of arrival."""
+        adapters = list(dict.fromkeys(seq.adapter for seq in self._active))
+        if self._last_adapter in adapters:
+            adapter = adapters[(adapters.index(self._last_adapter) + 1) % len(adapters)]
+        else:
+            adapter = adapters[0]
+        self._last_adapter = adapter
+        return [seq for seq in self._active if seq.adapter == adapter]
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._active:
+                self._active.append(await self._queue.get())
+                await self._collect()
+            else:
+                self._admit_waiting()
+
+            # 已断开的请求不再占用批次
+            self._active = [seq for seq in self._active if not seq.future.done()]
+            adapters = {seq.adapter for seq in self._active}
+            for adapter in [adapter for adapter in self._caches if adapter not in adapters]:
+                del self._caches[adapter]
+            if not self._active:
+                continue
+
+            batch = self._next_group()
+            now = time.perf_counter()
+            for seq in batch:
+                if not seq.started:
+                    seq.started = True
+                    QUEUE_WAIT.observe(now - seq.queued_at)
+            BATCH_SIZE.observe(len(batch))
+            try:
+                await loop.run_in_executor(self._executor, self._step, batch)
+            except Exception as e:
+                logger.error(
+                    f"Batched generation failed: {str(e)}",
+                    extra={"batch_job_ids": [seq.job_id for seq in batch]},
+                )
+                for seq in batch:
+                    if not seq.future.done():
+                        seq.future.set_exception(e)
+                failed = {id(seq) for seq in batch}
+                # 失败时缓存可能只更新了一部分
+                self._caches.pop(batch[0].adapter, None)
+                self._active = [seq for seq in self._active if id(seq) not in failed]
+                continue
+
+            still_running = []
+            for seq in self._active:
+                if seq.future.done():
+                    continue
+                if seq.finished:
+                    OUTPUT_TOKENS.labels(seq.task).observe(len(seq.output_ids))
+                    seq.future.set_result(seq.output_ids)
+                else:
+                    still_running.append(seq)
+            self._active = still_running
+
+    @torch.inference_mode()
+    def _step(self, batch: List[_Sequence]) -> None:
+        """Run one left-padded decode step of at most ``step_tokens`` tokens."""
+        model, tokenizer = LLMQwen._get_llm()
+        pad_token_id = tokenizer.pad_token_id
+        if pad_token_id is None:
+            pad_token_id = tokenizer.eos_token_id
+        eos_ids = set(LLMQwen.eos_token_ids(model, tokenizer))
+        adapter = batch[0].adapter
+        use_draft = len(batch) == 1 and batch[0].use_draft
+        cache = self._caches.setdefault(adapter, _BatchCache())
+
+        with use_adapter(adapter):
+            if use_draft:
+                cache.clear()
+                decoding_kwargs = speculative.assisted_kwargs()
+            else:
+                cache.sync(batch, model)
+                batch = cache.rows
+                decoding_kwargs = {"past_key_values": cache.past_key_values}
+
+            rows = [seq.input_ids for seq in batch]
+            width = max(len(row) for row in rows)
+            input_ids = torch.tensor(
+                [[pad_token_id] * (width - len(row)) + row for row in rows],
+                device=model.device,
+            )
+            attention_mask = torch.tensor(
+                [[0] * (width - len(row)) + [1] * len(row) for row in rows],
+                device=model.device,
+            )
+
+            # 已取消的请求（客户端断开）在下一个 token 处停止
+            stopping_criteria = StoppingCriteriaList([CancelStoppingCriteria([seq.future.done for seq in batch])])
+            trackers = [seq.tracker for seq in batch]
+            if any(trackers):
+                stopping_criteria.append(JsonStoryStoppingCriteria(tokenizer, trackers))
+
+            # 约束状态跨步骤保留在序列上；每行生成部分从 width - len(output_ids) 列开始
+            constraints = [seq.constraint for seq in batch]
+            logits_processor = None
+            if any(constraints):
+                logits_processor = LogitsProcessorList([
+                    JsonSchemaLogitsProcessor(constraints, [width - len(seq.output_ids) for seq in batch])
+                ])
+
+            timer = TokenTimer(inner=_StepStreamer(batch, eos_ids))
+            with speculative.draft_counter() as counter:
+                model.generate(
+                    input_ids=input_ids,
+                    attention_mask=attention_mask,
+                    **decoding_kwargs,
+                    max_new_tokens=min(self.step_tokens, max(seq.remaining for seq in batch)),
+                    pad_token_id=pad_token_id,
+                    stopping_criteria=stopping_criteria,
+                    logits_processor=logits_processor,
+                    streamer=timer,
+                )
+        # 缓存命中时 generate 只前向每行最后一个 token，加入批次时的预填充单独计时
+        timer.observe("batch", draft=use_draft, prefill=use_draft)
+        if use_draft:
+            batch[0].speculation.add(timer, counter.drafted)
+        elif len(batch) == 1 and speculative.get_draft_model() is not None:
+            speculative.baseline.update(timer.decode_rate)
+
+        # 生成的 token 已经由 _StepStreamer 交给各序列；最后一个 token 触发的停止还没有检查
+        for seq in batch:
+            seq.check_tracker()
+
+
+class _TextPieces:
+    """
+    Incremental detokenizer for one streamed sequence. Holds text back while
+    it ends in an incomplete UTF-8 character and starts over after a newline,
+    so each token decodes only the current line.
+    """
+
+    def __init__(self, tokenizer) -> None:
+        self.tokenizer = tokenizer
+        self._token_ids: List[int] = []
+        self._sent = 0
+
+    def add(self, token_id: int) -> str:
+        self._token_ids.append(token_id)
+        text = self.tokenizer.decode(self._token_ids, skip_special_tokens=True)
+        if text.endswith("\ufffd"):
+            return ""
+        piece = text[self._sent:]
+        if text.endswith("\n"):
+            self._token_ids = []
+            self._sent = 0
+        else:
+            self._sent = len(text)
+        return piece
+
+    def flush(self) -> str:
+        piece = self.tokenizer.decode(self._token_ids, skip_special_tokens=True)[self._sent:]
+        self._token_ids = []
+        self._sent = 0
+        return piece
+
+
+scheduler: Optional[BatchScheduler] = None
+
+
+async def start_scheduler() -> None:
+    global scheduler
+    if not settings.BATCH_ENABLED:
+        return
+    scheduler = BatchScheduler(
+        max_batch_size=settings.BATCH_MAX_SIZE,
+        window_ms=settings.BATCH_WINDOW_MS,
+        step_tokens=settings.BATCH_STEP_TOKENS,
+    )
+    scheduler.start()
+    logger.info(f"Batch scheduler started (max_batch_size={settings.BATCH_MAX_SIZE})")
+
+
+async def stop_scheduler() -> None:
+    global scheduler
+    if scheduler:
+        await scheduler.stop()
+        scheduler = None
+
+
+def get_scheduler() -> Optional[BatchScheduler]:
+    """获取批处理调度器实例的函数"""
+    return scheduler
@@ -0,0 +1,475 @@
+import bisect
+import json
+import logging
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import torch
+from transformers import LogitsProcessor
+
+from core.metrics import CONSTRAINT_MASK_DURATION
+
+logger = logging.getLogger(__name__)
+
+
+def _node_schema(option_ref: str) -> Dict[str, Any]:
+    return {
+        "type": "object",
+        "properties": {
+            "content": {"type": "string"},
+            "isEnding": {"type": "boolean"},
+            "isWinningEnding": {"type": "boolean"},
+            "options": {
+                "anyOf": [
+                    {"type": "array", "items": {"$ref": f"#/$defs/{option_ref}"}},
+                    {"type": "null"},
+                ]
+            },
+        },
+    }
+
+
+_STUB_OPTION = {"type": "object", "properties": {"text": {"type": "string"}}}
+
+_STORY_DEFS = {
+    "StoryNodeLLM": _node_schema("StoryOptionLLM"),
+    "StoryOptionLLM": {
+        "type": "object",
+        "properties": {"text": {"type": "string"}, "nextNode": {"$ref": "#/$defs/StoryNodeLLM"}},
+    },
+}
+
+# 与 backend/core/models.py 中的 StoryLLMResponse / StoryNodeLLM 保持一致。
+# 键按提示里示例的顺序固定输出；完整故事和 branch 里 nextNode 递归为节点，lazy_story 和 node 的选项只有 text
+TASK_SCHEMAS: Dict[str, Dict[str, Any]] = {
+    "story": {
+        "$defs": _STORY_DEFS,
+        "type": "object",
+        "properties": {"title": {"type": "string"}, "rootNode": {"$ref": "#/$defs/StoryNodeLLM"}},
+    },
+    "lazy_story": {
+        "$defs": {"StoryNodeLLM": _node_schema("StoryOptionStub"), "StoryOptionStub": _STUB_OPTION},
+        "type": "object",
+        "properties": {"title": {"type": "string"}, "rootNode": {"$ref": "#/$defs/StoryNodeLLM"}},
+    },
+    "node": {
+        "$defs": {"StoryOptionStub": _STUB_OPTION},
+        **_node_schema("StoryOptionStub"),
+    },
+    "branch": {"$defs": _STORY_DEFS, "$ref": "#/$defs/StoryNodeLLM"},
+}
+
+# 结构位置上连续空白的上限，防止模型在约束下不停输出换行
+MAX_WHITESPACE = 64
+
+_WHITESPACE = frozenset(b" \t\n\r")
+_HEX_DIGITS = frozenset(b"0123456789abcdefABCDEF")
+_ESCAPES = frozenset(b'"\\/bfnrt')
+# 字符串里不能原样出现的字节：引号、反斜杠和控制字符
+_NOT_PLAIN = bytes([0x22, 0x5C] + list(range(0x20)))
+
+_STRING = ("str",)
+_ESCAPE = ("esc",)
+
+# (pending expectations, lexeme in progress, whitespace run)
+State = Tuple[tuple, Optional[tuple], int]
+
+
+class SchemaGrammar:
+    """
+    Pushdown automaton over the bytes of a JSON document matching a schema.
+
+    Supports the subset the story schemas use: objects with a fixed key
+    order (all keys required), arrays, strings, booleans, ``anyOf`` with
+    null and recursive ``$ref``. A state is an immutable tuple
+    ``(stack, lexeme, whitespace)``: the stack holds what is expected next
+    (top last), the lexeme tracks a literal or string being written.
+    States are hashable, so token masks can be cached per state.
+    """
+
+    def __init__(self, schema: Dict[str, Any]) -> None:
+        self._defs = schema.get("$defs", {})
+        self._refs: Dict[str, int] = {}
+        self._types: List[Optional[tuple]] = []
+        self.initial: State = ((("value", self._compile(schema)),), None, 0)
+
+    def _compile(self, schema: Dict[str, Any]) -> int:
+        if "$ref" in schema:
+            name = schema["$ref"].rsplit("/", 1)[-1]
+            if name not in self._refs:
+                # 先占位再编译，递归引用会指回同一个类型
+                self._refs[name] = len(self._types)
+                self._types.append(None)
+                self._types[self._refs[name]] = self._compile_type(self._defs[name])
+            return self._refs[name]
+        self._types.append(self._compile_type(schema))
+        return len(self._types) - 1
+
+    def _compile_type(self, schema: Dict[str, Any]) -> tuple:
+        if "anyOf" in schema:
+            variants = [variant for variant in schema["anyOf"] if variant.get("type") != "null"]
+            if len(variants) != 1 or len(schema["anyOf"]) != 2:
+                raise ValueError(f"Unsupported anyOf in schema: {schema}")
+            return ("nullable", self._compile(variants[0]))
+
+        kind = schema.get("type")
+        if kind in ("string", "boolean"):
+            return (kind,)
+        if kind == "array":
+            return ("array", self._compile(schema["items"]))
+        if kind == "object":
+            expected = []
+            for index, (key, value) in enumerate(schema["properties"].items()):
+                if index:
+                    expected.append(("lit", b","))
+                expected += [("lit", json.dumps(key).encode()), ("lit", b":"), ("value", self._compile(value))]
+            expected.append(("lit", b"}"))
+            # 压栈顺序：最先期待的在栈顶（元组末尾）
+            return ("object", tuple(reversed(expected)))
+        raise ValueError(f"Unsupported schema type: {kind}")
+
+    @staticmethod
+    def is_complete(state: State) -> bool:
+        return not state[0] and state[1] is None
+
+    def advance(self, state: State, byte: int) -> Optional[State]:
+        """The state after ``byte``, or None if the byte cannot appear here."""
+        stack, lexeme, whitespace = state
+        if lexeme is not None:
+            kind = lexeme[0]
+            if kind == "str":
+                if byte == 0x22:
+                    return (stack, None, 0)
+                if byte == 0x5C:
+                    return (stack, _ESCAPE, 0)
+                return state if byte >= 0x20 else None
+            if kind == "lit":
+                rest = lexeme[1]
+                if byte != rest[0]:
+                    return None
+                return (stack, ("lit", rest[1:]) if len(rest) > 1 else None, 0)
+            if kind == "esc":
+                if byte == 0x75:
+                    return (stack, ("hex", 4), 0)
+                return (stack, _STRING, 0) if byte in _ESCAPES else None
+            if byte not in _HEX_DIGITS:
+                return None
+            return (stack, ("hex", lexeme[1] - 1) if lexeme[1] > 1 else _STRING, 0)
+
+        if byte in _WHITESPACE:
+            # 文档结束后只允许 EOS
+            if not stack or whitespace >= MAX_WHITESPACE:
+                return None
+            return (stack, None, whitespace + 1)
+        return self._start(stack, byte)
+
+    def _start(self, stack: tuple, byte: int) -> Optional[State]:
+        """Begin the next lexeme with ``byte``, expanding the expectation on top of the stack."""
+        while stack:
+            item = stack[-1]
+            rest = stack[:-1]
+            kind = item[0]
+            if kind == "lit":
+                literal = item[1]
+                if byte != literal[0]:
+                    return None
+                return (rest, ("lit", literal[1:]) if len(literal) > 1 else None, 0)
+            if kind == "first":
+                # 紧跟在 "[" 之后：空数组或第一个元素
+                if byte == 0x5D:
+                    return (rest, None, 0)
+                stack = rest + (("more", item[1]), ("value", item[1]))
+                continue
+            if kind == "more":
+                if byte == 0x2C:
+                    return (rest + (item, ("value", item[1])), None, 0)
+                return (rest, None, 0) if byte == 0x5D else None
+
+            schema = self._types[item[1]]
+            kind = schema[0]
+            if kind == "string":
+                return (rest, _STRING, 0) if byte == 0x22 else None
+            if kind == "boolean":
+                if byte == 0x74:
+                    return (rest, ("lit", b"rue"), 0)
+                return (rest, ("lit", b"alse"), 0) if byte == 0x66 else None
+            if kind == "nullable":
+                if byte == 0x6E:
+                    return (rest, ("lit", b"ull"), 0)
+                stack = rest + (("value", schema[1]),)
+                continue
+            if kind == "array":
+                return (rest + (("first", schema[1]),), None, 0) if byte == 0x5B else None
+            return (rest + schema[1], None, 0) if byte == 0x7B else None
+        return None
+
+
+GRAMMARS: Dict[str, SchemaGrammar] = {task: SchemaGrammar(schema) for task, schema in TASK_SCHEMAS.items()}
+
+
+def _byte_decoder() -> Dict[str, int]:
+    """Inverse of the GPT-2 byte-to-unicode table used by byte-level BPE vocabularies."""
+    printable = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    chars = list(printable)
+    extra = 0
+    for byte in range(256):
+        if byte not in printable:
+            printable.append(byte)
+            chars.append(256 + extra)
+            extra += 1
+    return {chr(char): byte for byte, char in zip(printable, chars)}
+
+
+def token_bytes(tokenizer) -> Dict[int, bytes]:
+    """
+    Raw bytes of every ordinary token. Special and added tokens (chat
+    markers, EOS) are left out: their text must never be written into the
+    document. Byte-level BPE (Qwen, GPT-2) is decoded exactly; other
+    vocabularies fall back to ``tokenizer.decode`` per token.
+    """
+    excluded = set(tokenizer.all_special_ids) | set(getattr(tokenizer, "added_tokens_decoder", {}))
+    vocab = {token: token_id for token, token_id in tokenizer.get_vocab().items() if token_id not in excluded}
+
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None and type(backend.decoder).__name__ == "ByteLevel":
+        decoder = _byte_decoder()
+        return {
+            token_id: bytes(decoder[char] for char in token)
+            for token, token_id in vocab.items()
+            if all(char in decoder for char in token)
+        }
+    return {token_id: tokenizer.decode([token_id]).encode("utf-8") for token_id in vocab.values()}
+
+
+def _skip_prefix(tokens: List[bytes], prefix: bytes, lo: int) -> int:
+    """Index of the first sorted token at or after ``lo`` that does not start with ``prefix``."""
+    upper = prefix.rstrip(b"\xff")
+    if not upper:
+        return len(tokens)
+    return bisect.bisect_left(tokens, upper[:-1] + bytes([upper[-1] + 1]), lo)
+
+
+class TokenVocabulary:
+    """
+    Token bytes of one tokenizer, sorted for prefix scans, plus a cache of
+    the allowed-token mask per grammar state.
+
+    A mask is found by walking the sorted tokens with the grammar, sharing
+    work between tokens with a common prefix and skipping every token behind
+    a dead prefix with one bisect. Inside a string every token without
+    quote, backslash or control bytes is allowed, so only the remaining few
+    are walked there. Masks are cached: a story document visits a small set
+    of states (the same fields at the same depths), so after the first
+    requests constraining a step is a dictionary lookup.
+    """
+
+    def __init__(self, tokenizer, cache_size: int = 4096) -> None:
+        self.bytes = token_bytes(tokenizer)
+        ordered = sorted((data, token_id) for token_id, data in self.bytes.items() if data)
+        self._tokens = [data for data, _ in ordered]
+        self._ids = [token_id for _, token_id in ordered]
+
+        special = [(data, token_id) for data, token_id in ordered if len(data.translate(None, _NOT_PLAIN)) != len(data)]
+        self._string_tokens = [data for data, _ in special]
+        self._string_ids = [token_id for _, token_id in special]
+        self._plain_ids = sorted(set(self._ids) - set(self._string_ids))
+
+        self.cache_size = cache_size
+        self._masks: "OrderedDict[tuple, Tuple[str, torch.Tensor]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _scan(self, grammar: SchemaGrammar, state: State, tokens: List[bytes], ids: List[int]) -> List[int]:
+        allowed = []
+        # 上一个 token 各前缀之后的状态：(前缀长度, 状态)
+        prefixes = [(0, state)]
+        previous = b""
+        index = 0
+        while index < len(tokens):
+            token = tokens[index]
+            common = 0
+            limit = min(len(previous), len(token))
+            while common < limit and previous[common] == token[common]:
+                common += 1
+            while prefixes[-1][0] > common:
+                prefixes.pop()
+
+            position, current = prefixes[-1]
+            while position < len(token):
+                current = grammar.advance(current, token[position])
+                if current is None:
+                    break
+                position += 1
+                prefixes.append((position, current))
+            previous = token
+
+            if current is None:
+                # 共享这个失败前缀的 token 全部跳过
+                index = _skip_prefix(tokens, token[: position + 1], index + 1)
+            else:
+                allowed.append(ids[index])
+                index += 1
+        return allowed
+
+    def _build(self, grammar: SchemaGrammar, state: State, eos_ids: Tuple[int, ...], width: int, device) -> Tuple[str, torch.Tensor]:
+        if grammar.is_complete(state):
+            return "ids", torch.tensor(eos_ids, dtype=torch.long, device=device)
+        if state[1] is _STRING:
+            allowed = self._plain_ids + self._scan(grammar, state, self._string_tokens, self._string_ids)
+            blocked = torch.ones(width, dtype=torch.bool)
+            blocked[allowed] = False
+            return "blocked", blocked.to(device)
+        return "ids", torch.tensor(self._scan(grammar, state, self._tokens, self._ids), dtype=torch.long, device=device)
+
+    def mask(
+        self, grammar: SchemaGrammar, state: State, eos_ids: Tuple[int, ...], width: int, device
+    ) -> Tuple[str, torch.Tensor]:
+        """
+        The tokens allowed in ``state``: ``("ids", allowed ids)`` for the
+        structural states, where few tokens fit, or ``("blocked", bool mask)``
+        inside strings, where most do.
+        """
+        key = (grammar, state, eos_ids, width, str(device))
+        with self._lock:
+            cached = self._masks.get(key)
+            if cached is not None:
+                self._masks.move_to_end(key)
+                return cached
+
+        started = time.perf_counter()
+        built = self._build(grammar, state, eos_ids, width, device)
+        CONSTRAINT_MASK_DURATION.observe(time.perf_counter() - started)
+
+        with self._lock:
+            self._masks[key] = built
+            if len(self._masks) > self.cache_size:
+                self._masks.popitem(last=False)
+        return built
+
+
+_vocabularies: "weakref.WeakKeyDictionary[Any, TokenVocabulary]" = weakref.WeakKeyDictionary()
+_vocabularies_lock = threading.Lock()
+
+
+def get_vocabulary(tokenizer) -> TokenVocabulary:
+    """The token table of ``tokenizer``, built on first use and kept as long as the tokenizer lives."""
+    with _vocabularies_lock:
+        vocabulary = _vocabularies.get(tokenizer)
+        if vocabulary is None:
+            started = time.perf_counter()
+            vocabulary = _vocabularies[tokenizer] = TokenVocabulary(tokenizer)
+            logger.info(
+                "Built token table for constrained decoding",
+                extra={"tokens": len(vocabulary.bytes), "seconds": round(time.perf_counter() - started, 2)},
+            )
+        return vocabulary
+
+
+def precompile(tokenizer, eos_ids: Sequence[int], width: int, device) -> None:
+    """Build the token table and the masks of every task's first step before traffic arrives."""
+    vocabulary = get_vocabulary(tokenizer)
+    for grammar in GRAMMARS.values():
+        vocabulary.mask(grammar, grammar.initial, tuple(eos_ids), width, device)
+
+
+class JsonConstraint:
+    """
+    Grammar state of one constrained sequence.
+
+    Keeps the state after every generated token, so the sequence can be
+    re-synchronised from the ``input_ids`` generate() passes in: plain and
+    batched decoding only append, assisted decoding also rewinds rejected
+    draft tokens at the tail.
+    """
+
+    def __init__(self, task: str, tokenizer, eos_ids: Sequence[int]) -> None:
+        self.task = task
+        self.grammar = GRAMMARS[task]
+        self.vocabulary = get_vocabulary(tokenizer)
+        self.eos_ids = tuple(eos_ids)
+        self.tokens: List[int] = []
+        self.states: List[State] = [self.grammar.initial]
+        self.failed = False
+
+    def sync(self, row: torch.Tensor, start: int) -> None:
+        """Catch up with the generated part ``row[start:]`` of one row of ``input_ids``."""
+        length = row.shape[0] - start
+        # 从最后一个已知 token 开始比对，覆盖被拒绝的草稿 token
+        position = max(min(length, len(self.tokens)) - 1, 0)
+        for token_id in row[start + position:].tolist():
+            if position < len(self.tokens) and self.tokens[position] == token_id:
+                position += 1
+                continue
+            del self.tokens[position:]
+            del self.states[position + 1:]
+            self._feed(token_id)
+            position += 1
+            if self.failed:
+                return
+        del self.tokens[length:]
+        del self.states[length + 1:]
+
+    def _feed(self, token_id: int) -> None:
+        state = self.states[-1]
+        data = self.vocabulary.bytes.get(token_id)
+        if self.grammar.is_complete(state):
+            # 文档已完整：EOS，或批次中已结束的行被 generate 填充的 pad
+            next_state = state
+        elif data is None:
+            next_state = None
+        else:
+            next_state = state
+            for byte in data:
+                next_state = self.grammar.advance(next_state, byte)
+                if next_state is None:
+                    break
+        if next_state is None:
+            self.failed = True
+            logger.warning(
+                "Constrained decoding lost track of the document, continuing unconstrained",
+                extra={"task": self.task, "token_id": token_id, "position": len(self.tokens)},
+            )
+            return
+        self.tokens.append(token_id)
+        self.states.append(next_state)
+
+    def apply(self, scores: torch.Tensor) -> None:
+        """Mask the scores of one row in place."""
+        kind, mask = self.vocabulary.mask(
+            self.grammar, self.states[-1], self.eos_ids, scores.shape[-1], scores.device
+        )
+        if kind == "blocked":
+            scores.masked_fill_(mask, float("-inf"))
+        elif not len(mask):
+            # 词表里没有能接上的 token，放弃约束也比输出 NaN 好
+            self.failed = True
+            logger.warning("No token can continue the document", extra={"task": self.task})
+        else:
+            allowed = scores[mask]
+            scores.fill_(float("-inf"))
+            scores[mask] = allowed
+
+
+class JsonSchemaLogitsProcessor(LogitsProcessor):
+    """
+    Restrict every row to the tokens that keep its output a valid prefix of
+    the task's JSON document, and allow EOS only once the document is
+    complete. Rows without a constraint are left untouched, so constrained
+    and unconstrained requests can share a batch. ``starts`` is the column of
+    each row's first generated token.
+    """
+
+    def __init__(self, constraints: Sequence[Optional[JsonConstraint]], starts: Sequence[int]) -> None:
+        self.constraints = list(constraints)
+        self.starts = list(starts)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        for row, (constraint, start) in enumerate(zip(self.constraints, self.starts)):
+            if constraint is None or constraint.failed:
+                continue
+            constraint.sync(input_ids[row], start)
+            if not constraint.failed:
+                constraint.apply(scores[row])
+        return scores
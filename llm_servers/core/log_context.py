@@ -0,0 +1,81 @@
+import json
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Iterator, Optional
+
+from starlette.datastructures import Headers
+
+# 后端调用时带上的故事任务 id，两端日志可以对应起来
+job_id_var: ContextVar[Optional[str]] = ContextVar("job_id", default=None)
+
+JOB_ID_HEADER = "X-Job-ID"
+
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "job_id"}
+
+
+@contextmanager
+def bind_job_id(job_id: Optional[str]) -> Iterator[None]:
+    token = job_id_var.set(job_id)
+    try:
+        yield
+    finally:
+        job_id_var.reset(token)
+
+
+class JobIdMiddleware:
+    """Binds the ``X-Job-ID`` request header for everything the request runs, including threadpool calls."""
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        with bind_job_id(Headers(scope=scope).get(JOB_ID_HEADER)):
+            await self.app(scope, receive, send)
+
+
+class JobIdFilter(logging.Filter):
+    """Adds the current ``job_id`` to every record."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.job_id = job_id_var.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; fields passed with ``extra=`` are kept as keys."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "job_id": getattr(record, "job_id", None),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                payload[key] = value
+        if record.exc_info:
+            payload["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+def configure_logging(level: str = "INFO", fmt: str = "json") -> None:
+    """Install the root handler: ``json`` for log shipping, ``text`` for local development."""
+    handler = logging.StreamHandler()
+    handler.addFilter(JobIdFilter())
+    if fmt == "json":
+        handler.setFormatter(JsonFormatter())
+    elif fmt == "text":
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s [job=%(job_id)s] %(message)s"))
+    else:
+        raise ValueError(f"Unknown LOG_FORMAT: {fmt}")
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
@@ -0,0 +1,178 @@
+import time
+from typing import Optional
+
+import torch
+from prometheus_client import Counter, Gauge, Histogram
+from transformers.generation.streamers import BaseStreamer
+
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+REQUEST_BUCKETS = (0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600, 900)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+RATE_BUCKETS = (1, 2.5, 5, 10, 15, 20, 30, 40, 60, 80, 120, 160, 240)
+
+QUEUE_WAIT = Histogram(
+    "llm_queue_wait_seconds",
+    "Time a request waited in the batch scheduler before its first decode step",
+    buckets=STAGE_BUCKETS + (30, 60, 120),
+)
+TOKENIZE_DURATION = Histogram(
+    "llm_tokenize_seconds",
+    "Chat template rendering and tokenization of one prompt",
+    ["task"],
+    buckets=STAGE_BUCKETS,
+)
+PREFILL_DURATION = Histogram(
+    "llm_prefill_seconds",
+    "Prefill of one prompt up to its first new token (batch: a request joining the batch)",
+    ["mode"],
+    buckets=STAGE_BUCKETS,
+)
+DECODE_RATE = Histogram(
+    "llm_decode_tokens_per_second",
+    "Decode speed of one sequence after its first step",
+    ["mode", "draft"],
+    buckets=RATE_BUCKETS,
+)
+DRAFT_ACCEPTANCE = Histogram(
+    "llm_draft_acceptance_rate",
+    "Share of draft-model tokens accepted by the main model, per request",
+    buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0),
+)
+SPECULATIVE_SPEEDUP = Histogram(
+    "llm_speculative_speedup",
+    "Decode speed of a speculative request relative to the plain-decoding baseline",
+    buckets=(0.5, 0.75, 1, 1.25, 1.5, 1.75, 2, 2.5, 3, 4),
+)
+CONSTRAINT_MASK_DURATION = Histogram(
+    "llm_constraint_mask_seconds",
+    "Building the allowed-token mask of one grammar state (cache misses only)",
+    buckets=STAGE_BUCKETS,
+)
+OUTPUT_TOKENS = Histogram(
+    "llm_output_tokens",
+    "Tokens generated for one request",
+    ["task"],
+    buckets=TOKEN_BUCKETS,
+)
+REQUEST_DURATION = Histogram(
+    "llm_request_seconds",
+    "End-to-end handling of one generate request",
+    ["task", "endpoint"],
+    buckets=REQUEST_BUCKETS,
+)
+BATCH_SIZE = Histogram(
+    "llm_batch_size",
+    "Sequences decoded together in one scheduler step",
+    buckets=(1, 2, 3, 4, 6, 8, 12, 16, 24, 32),
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "llm_requests_in_flight",
+    "Generate requests currently being handled",
+)
+MODEL_MEMORY = Gauge(
+    "llm_model_memory_bytes",
+    "Memory footprint of the loaded model weights",
+)
+CUDA_MEMORY_ALLOCATED = Gauge(
+    "llm_cuda_memory_allocated_bytes",
+    "Memory currently allocated by tensors on the CUDA device",
+)
+CUDA_MEMORY_RESERVED = Gauge(
+    "llm_cuda_memory_reserved_bytes",
+    "Memory held by the CUDA caching allocator",
+)
+
+STARTUP_PHASE_DURATION = Gauge(
+    "llm_startup_phase_seconds",
+    "Duration of each startup phase of the last model load",
+    ["phase"],
+)
+ADAPTERS_LOADED = Gauge(
+    "llm_adapters_loaded",
+    "LoRA adapters currently loaded on the base model",
+)
+ADAPTER_LOAD_DURATION = Histogram(
+    "llm_adapter_load_seconds",
+    "Loading one LoRA adapter into the base model",
+    buckets=STAGE_BUCKETS + (30, 60),
+)
+ADAPTER_SWITCHES = Counter(
+    "llm_adapter_switches",
+    "Changes of the active adapter (or back to the base model)",
+)
+MODEL_READY = Gauge(
+    "llm_model_ready",
+    "1 once the model is loaded and warmed up and requests are accepted",
+)
+
+
+def watch_model_memory(model) -> None:
+    """Publish the weight footprint once; CUDA allocator usage is read at scrape time."""
+    from core.backends import weight_bytes
+    MODEL_MEMORY.set(weight_bytes(model))
+    if torch.cuda.is_available():
+        CUDA_MEMORY_ALLOCATED.set_function(torch.cuda.memory_allocated)
+        CUDA_MEMORY_RESERVED.set_function(torch.cuda.memory_reserved)
+
+
+class TokenTimer(BaseStreamer):
+    """
+    Streamer that timestamps the decode steps of one ``model.generate`` call.
+
+    generate() hands the prompt to the streamer first and then the new tokens
+    of every step, which splits the call into prefill (up to the first step)
+    and decode. A plain step adds one token per sequence (a 1-d tensor); an
+    assisted step adds the accepted draft tokens plus one (a ``(1, n)``
+    tensor). Another streamer can be wrapped to keep streaming text.
+    """
+
+    def __init__(self, inner: Optional[BaseStreamer] = None) -> None:
+        self.inner = inner
+        self.started = time.perf_counter()
+        self.first_token_at: Optional[float] = None
+        self.last_token_at: Optional[float] = None
+        self.steps = 0
+        self.tokens = 0
+        self.first_step_tokens = 0
+        self._prompt_seen = False
+
+    def put(self, value) -> None:
+        if self._prompt_seen:
+            now = time.perf_counter()
+            tokens = value.shape[-1] if value.dim() == 2 else 1
+            if self.first_token_at is None:
+                self.first_token_at = now
+                self.first_step_tokens = tokens
+            self.last_token_at = now
+            self.steps += 1
+            self.tokens += tokens
+        self._prompt_seen = True
+        if self.inner is not None:
+            self.inner.put(value)
+
+    def end(self) -> None:
+        if self.inner is not None:
+            self.inner.end()
+
+    @property
+    def decode_seconds(self) -> float:
+        return self.last_token_at - self.first_token_at if self.first_token_at is not None else 0.0
+
+    @property
+    def decode_tokens(self) -> int:
+        return self.tokens - self.first_step_tokens
+
+    @property
+    def decode_rate(self) -> Optional[float]:
+        """Tokens per second after the first step, None for a single-step call."""
+        if self.decode_tokens <= 0 or self.decode_seconds <= 0:
+            return None
+        return self.decode_tokens / self.decode_seconds
+
+    def observe(self, mode: str, draft: bool = False, prefill: bool = True) -> None:
+        if self.first_token_at is None:
+            return
+        if prefill:
+            PREFILL_DURATION.labels(mode).observe(self.first_token_at - self.started)
+        if self.decode_rate is not None:
+            DECODE_RATE.labels(mode, "yes" if draft else "no").observe(self.decode_rate)
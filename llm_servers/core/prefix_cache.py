@@ -0,0 +1,74 @@
+import copy
+import hashlib
+import logging
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# 用于定位用户消息起点的占位符
+_USER_SENTINEL = "\x00user-prompt\x00"
+
+
+class PrefixCache:
+    """Token ids and past_key_values of the fixed system prefix of every chat prompt."""
+
+    def __init__(self, key: Tuple[str, str], input_ids: List[int], past_key_values) -> None:
+        self.key = key
+        self.input_ids = input_ids
+        self.past_key_values = past_key_values
+
+    def match(self, input_ids: List[int]) -> bool:
+        """Whether ``input_ids`` starts with the cached prefix and has a suffix left to prefill."""
+        n = len(self.input_ids)
+        return len(input_ids) > n and input_ids[:n] == self.input_ids
+
+    def copy(self):
+        """A private copy of the cache; generate() appends to the cache it is given."""
+        return copy.deepcopy(self.past_key_values)
+
+
+_prefix_caches: Dict[Tuple[str, str], PrefixCache] = {}
+# 每种生成任务（系统提示）当前使用的前缀缓存
+current: Dict[str, PrefixCache] = {}
+
+
+def _prefix_text(chat_text: str) -> str:
+    prefix = chat_text[:chat_text.index(_USER_SENTINEL)]
+    # 在最后一个特殊 token 处截断，保证前缀的分词结果与完整提示一致
+    turn_start = prefix.rfind("<|im_start|>")
+    return prefix[:turn_start] if turn_start > 0 else prefix
+
+
+@torch.inference_mode()
+def build_prefix_cache(model, tokenizer, model_path: str, task: str = "story") -> PrefixCache:
+    """Prefill the system prefix of ``task`` once and keep its KV cache for later requests."""
+    from core.qwen3 import LLMQwen
+
+    prefix_text = _prefix_text(LLMQwen.build_chat_text(tokenizer, _USER_SENTINEL, task))
+    key = (hashlib.sha256(prefix_text.encode("utf-8")).hexdigest(), model_path)
+
+    cache = _prefix_caches.get(key)
+    if cache is None:
+        input_ids = tokenizer(prefix_text).input_ids
+        outputs = model(
+            input_ids=torch.tensor([input_ids], device=model.device),
+            use_cache=True,
+        )
+        cache = PrefixCache(key, input_ids, outputs.past_key_values)
+        _prefix_caches[key] = cache
+        logger.info(f"Cached {task} system prompt prefix ({len(input_ids)} tokens)")
+
+    current[task] = cache
+    return cache
+
+
+def clear_prefix_caches() -> None:
+    _prefix_caches.clear()
+    current.clear()
+
+
+def get_prefix_cache(task: str = "story") -> Optional[PrefixCache]:
+    """获取系统提示前缀缓存的函数"""
+    return current.get(task)
@@ -46,4 +46,118 @@ json_structure = """
                 ]
             }
         }
-"""
\ No newline at end of file
+"""
+
+LAZY_STORY_PROMPT = """
+            You are a creative story writer that create engaging choose-your-own-adventure stories.
+            Write only the opening of a branching story in the JSON format I'll specify.
+            The branches behind each option will be written later, when a player picks them.
+
+            The opening should have:
+            1. A compelling title
+            2. A starting situation (root node) with 3-4 options
+            3. Options that each lead somewhere clearly different
+
+            Output your story in this exact JSON structure:
+            {format_instruction}
+
+            Don't write what happens after an option, only the option text.
+            Don't add any text outside of the JSON structure.
+"""
+
+
+lazy_json_structure = """
+        {
+            "title": "Story Title",
+            "rootNode": {
+                "content": "The starting situation of the story",
+                "isEnding": false,
+                "isWinningEnding": false,
+                "options": [
+                    {"text": "Option 1 text"},
+                    // More options for root node
+                ]
+            }
+        }
+"""
+
+
+NODE_PROMPT = """
+            You are a creative story writer continuing a choose-your-own-adventure story.
+            You will get the story so far and the option the player just chose.
+            Write the single node that follows from that choice, in the JSON format I'll specify.
+
+            The node should:
+            1. Continue naturally from the story so far and the chosen option
+            2. Either offer 3-4 new options, or be an ending (winning or losing)
+            3. Be an ending when the user message says no more choices are allowed
+
+            Output the node in this exact JSON structure:
+            {format_instruction}
+
+            Don't write what happens after the new options, only the option text.
+            Don't add any text outside of the JSON structure.
+"""
+
+
+node_json_structure = """
+        {
+            "content": "What happens when the player chooses this option",
+            "isEnding": false,
+            "isWinningEnding": false,
+            "options": [
+                {"text": "Option 1 text"},
+                // More options, or [] for an ending
+            ]
+        }
+"""
+
+
+BRANCH_PROMPT = """
+            You are a creative story writer repairing a choose-your-own-adventure story.
+            You will get the story so far and the option the player just chose.
+            Write the branch that follows from that choice: its first node and everything behind its options,
+            in the JSON format I'll specify.
+
+            The branch should:
+            1. Continue naturally from the story so far and the chosen option
+            2. Give each node that is not an ending 3-4 options, each leading to its own next node
+            3. Lead to endings (winning or losing) within the depth given in the user message
+            4. Be a single ending node when the user message says no more choices are allowed
+
+            Output the branch in this exact JSON structure:
+            {format_instruction}
+
+            Don't simplify or omit any part of the branch.
+            Don't add any text outside of the JSON structure.
+"""
+
+
+branch_json_structure = """
+        {
+            "content": "What happens when the player chooses this option",
+            "isEnding": false,
+            "isWinningEnding": false,
+            "options": [
+                {
+                    "text": "Option 1 text",
+                    "nextNode": {
+                        "content": "What happens when the player chooses this option",
+                        "isEnding": true,
+                        "isWinningEnding": false,
+                        "options": []
+                    }
+                },
+                // More options, or [] for an ending
+            ]
+        }
+"""
+
+
+# 生成任务 -> 系统提示
+TASK_PROMPTS = {
+    "story": STORY_PROMPT.format(format_instruction=json_structure),
+    "lazy_story": LAZY_STORY_PROMPT.format(format_instruction=lazy_json_structure),
+    "node": NODE_PROMPT.format(format_instruction=node_json_structure),
+    "branch": BRANCH_PROMPT.format(format_instruction=branch_json_structure),
+}
@@ -1,28 +1,45 @@
-from core.prompts import STORY_PROMPT, json_structure
-from schemas.qwen3 import GenerateResponse
+from threading import Event, Thread
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from transformers import LogitsProcessorList, StoppingCriteriaList, TextIteratorStreamer
+
+from core.adapters import use_adapter
+from core.constrained import JsonConstraint, JsonSchemaLogitsProcessor
+from core.metrics import OUTPUT_TOKENS, TOKENIZE_DURATION, TokenTimer
+from core.prompts import TASK_PROMPTS
+from core.stopping import CancelStoppingCriteria, JsonStoryTracker, JsonStoryStoppingCriteria
+from core.prefix_cache import get_prefix_cache
+from core import speculative
+from schemas.qwen3 import GenerateResponse, SpeculativeStats
 from load_llm import get_model, get_tokenizer
+from config import settings
 
 # from dotenv import load_dotenv
 # load_dotenv()
 
+# </think> token id of the Qwen3 tokenizer
+THINK_END_TOKEN_ID = 151668
+
 
 class LLMQwen:
 
     @classmethod
     def _get_llm(cls):
         return get_model(), get_tokenizer()
-    
+
     @classmethod
-    def generate_response(cls, prompt: str) -> GenerateResponse:
-        model, tokenizer = cls._get_llm()
+    def build_messages(cls, prompt: str, task: str = "story") -> List[Dict[str, str]]:
         if prompt:
             messages = [
-                {"role": "system", "content": STORY_PROMPT.format(format_instruction=json_structure)},
+                {"role": "system", "content": TASK_PROMPTS[task]},
                 {"role": "user", "content": prompt},
             ]
+        return messages
 
-        text = tokenizer.apply_chat_template(
-            messages,
+    @classmethod
+    def build_chat_text(cls, tokenizer, prompt: str, task: str = "story") -> str:
+        return tokenizer.apply_chat_template(
+            cls.build_messages(prompt, task),
             add_generation_prompt=True,
             tokenize=False,
             enable_thinking=False,
@@ -32,21 +49,224 @@ class LLMQwen:
             MinP=0,
         )
 
-        model_inputs = tokenizer(text, return_tensors="pt").to(model.device)
+    @classmethod
+    def build_tracker(cls, max_nodes: Optional[int] = None, max_depth: Optional[int] = None) -> Optional[JsonStoryTracker]:
+        """Create the JSON stop tracker for one request, falling back to the configured budgets."""
+        max_nodes = max_nodes if max_nodes is not None else settings.STORY_MAX_NODES
+        max_depth = max_depth if max_depth is not None else settings.STORY_MAX_DEPTH
+        if not settings.STOP_ON_JSON_COMPLETE and max_nodes is None and max_depth is None:
+            return None
+        return JsonStoryTracker(max_nodes=max_nodes, max_depth=max_depth)
 
-        outputs = model.generate(
-            **model_inputs,
-            max_new_tokens=32768)
-        
-        output_ids = outputs[0][len(model_inputs.input_ids[0]):].tolist()
+    @classmethod
+    def eos_token_ids(cls, model, tokenizer) -> List[int]:
+        eos_token_id = model.generation_config.eos_token_id
+        if eos_token_id is None:
+            eos_token_id = tokenizer.eos_token_id
+        return eos_token_id if isinstance(eos_token_id, list) else [eos_token_id]
+
+    @classmethod
+    def build_constraint(
+        cls, model, tokenizer, task: str = "story", constrained: Optional[bool] = None
+    ) -> Optional[JsonConstraint]:
+        """Create the schema constraint for one request, falling back to the configured default."""
+        if constrained is None:
+            constrained = settings.CONSTRAINED_DECODING_DEFAULT
+        if not constrained:
+            return None
+        return JsonConstraint(task, tokenizer, cls.eos_token_ids(model, tokenizer))
 
+    @classmethod
+    def _logits_processor(cls, constraint: Optional[JsonConstraint], start: int) -> Optional[LogitsProcessorList]:
+        if constraint is None:
+            return None
+        return LogitsProcessorList([JsonSchemaLogitsProcessor([constraint], [start])])
+
+    @classmethod
+    def decode_output(
+        cls, tokenizer, output_ids: List[int], tracker: Optional[JsonStoryTracker] = None
+    ) -> GenerateResponse:
         try:
             # rindex finding 151668 (</think>)
-            index = len(output_ids) - output_ids[::-1].index(151668)
+            index = len(output_ids) - output_ids[::-1].index(THINK_END_TOKEN_ID)
         except ValueError:
             index = 0
 
         thinking_content = tokenizer.decode(output_ids[:index], skip_special_tokens=True).strip("\n")
         answer = tokenizer.decode(output_ids[index:], skip_special_tokens=True).strip("\n")
 
-        return GenerateResponse(thinking_content=thinking_content, answer=answer)
+        return cls._response(thinking_content, answer, tracker)
+
+    @classmethod
+    def _response(cls, thinking_content: str, answer: str, tracker: Optional[JsonStoryTracker]) -> GenerateResponse:
+        if tracker is None:
+            return GenerateResponse(thinking_content=thinking_content, answer=answer)
+        return GenerateResponse(
+            thinking_content=thinking_content, answer=tracker.trim_to_budget(answer), stop_reason=tracker.stop_reason
+        )
+
+    @classmethod
+    def _stopping_criteria(
+        cls, tokenizer, tracker: Optional[JsonStoryTracker], cancelled: Optional[Event] = None
+    ) -> Optional[StoppingCriteriaList]:
+        criteria = StoppingCriteriaList()
+        if tracker is not None:
+            criteria.append(JsonStoryStoppingCriteria(tokenizer, [tracker]))
+        if cancelled is not None:
+            criteria.append(CancelStoppingCriteria([cancelled.is_set]))
+        return criteria or None
+
+    @classmethod
+    def prefix_cache_kwargs(cls, input_ids: List[int], task: str = "story") -> Dict[str, Any]:
+        """Reuse the precomputed system prefix so only the user suffix is prefilled."""
+        cache = get_prefix_cache(task)
+        if cache and cache.match(input_ids):
+            return {"past_key_values": cache.copy()}
+        return {}
+
+    @classmethod
+    def decoding_kwargs(
+        cls, input_ids: List[int], task: str, use_draft: bool, adapter: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Either the draft model or the prefix cache: assisted generation does
+        not reproduce the plain output when it starts from a precomputed cache.
+        The prefix cache holds the base model's keys and values, so requests
+        with an adapter prefill the whole prompt.
+        """
+        if use_draft:
+            return speculative.assisted_kwargs()
+        if adapter is not None:
+            return {}
+        return cls.prefix_cache_kwargs(input_ids, task)
+
+    @classmethod
+    def _finish_timing(
+        cls, timer: TokenTimer, mode: str, use_draft: bool, drafted: int
+    ) -> Optional[SpeculativeStats]:
+        timer.observe(mode, draft=use_draft)
+        if not use_draft:
+            if speculative.get_draft_model() is not None:
+                speculative.baseline.update(timer.decode_rate)
+            return None
+        stats = speculative.SpeculationStats()
+        stats.add(timer, drafted)
+        return stats.publish()
+
+    @classmethod
+    def generate_response(
+        cls,
+        prompt: str,
+        max_nodes: Optional[int] = None,
+        max_depth: Optional[int] = None,
+        task: str = "story",
+        constrained: Optional[bool] = None,
+        adapter: Optional[str] = None,
+    ) -> GenerateResponse:
+        model, tokenizer = cls._get_llm()
+        with TOKENIZE_DURATION.labels(task).time():
+            text = cls.build_chat_text(tokenizer, prompt, task)
+            model_inputs = tokenizer(text, return_tensors="pt").to(model.device)
+        tracker = cls.build_tracker(max_nodes, max_depth)
+        constraint = cls.build_constraint(model, tokenizer, task, constrained)
+        use_draft = speculative.use_draft()
+
+        timer = TokenTimer()
+        with use_adapter(adapter), speculative.draft_counter() as counter:
+            outputs = model.generate(
+                **model_inputs,
+                **cls.decoding_kwargs(model_inputs.input_ids[0].tolist(), task, use_draft, adapter),
+                max_new_tokens=settings.MAX_NEW_TOKENS,
+                stopping_criteria=cls._stopping_criteria(tokenizer, tracker),
+                logits_processor=cls._logits_processor(constraint, model_inputs.input_ids.shape[1]),
+                streamer=timer)
+        stats = cls._finish_timing(timer, "single", use_draft, counter.drafted)
+
+        output_ids = outputs[0][len(model_inputs.input_ids[0]):].tolist()
+        OUTPUT_TOKENS.labels(task).observe(len(output_ids))
+
+        response = cls.decode_output(tokenizer, output_ids, tracker)
+        response.speculative = stats
+        return response
+
+    @classmethod
+    def stream_response(
+        cls,
+        prompt: str,
+        max_nodes: Optional[int] = None,
+        max_depth: Optional[int] = None,
+        task: str = "story",
+        on_finish: Optional[Callable[[GenerateResponse], None]] = None,
+        constrained: Optional[bool] = None,
+        adapter: Optional[str] = None,
+        cancelled: Optional[Event] = None,
+    ) -> Iterator[str]:
+        """
+        Yield decoded text pieces while ``model.generate`` runs in a worker
+        thread. ``on_finish`` receives the whole response once generation is
+        over; its answer is trimmed to the node budgets, which the streamed
+        pieces cannot be. Setting ``cancelled`` (or closing the iterator)
+        stops generate at the next token.
+        """
+        model, tokenizer = cls._get_llm()
+        with TOKENIZE_DURATION.labels(task).time():
+            text = cls.build_chat_text(tokenizer, prompt, task)
+            model_inputs = tokenizer(text, return_tensors="pt").to(model.device)
+        tracker = cls.build_tracker(max_nodes, max_depth)
+        constraint = cls.build_constraint(model, tokenizer, task, constrained)
+        use_draft = speculative.use_draft()
+
+        cancelled = cancelled or Event()
+        streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        timer = TokenTimer(inner=streamer)
+        drafted = []
+        errors = []
+
+        def run_generate(**kwargs) -> None:
+            try:
+                # 草稿 token 按线程计数，必须在执行 generate 的线程里开始计数
+                with use_adapter(adapter), speculative.draft_counter() as counter:
+                    try:
+                        model.generate(**kwargs)
+                    finally:
+                        drafted.append(counter.drafted)
+            except Exception as e:
+                # 结束文本流，否则读取端会一直等待；异常在读取端重新抛出
+                errors.append(e)
+                streamer.end()
+
+        thread = Thread(
+            target=run_generate,
+            kwargs=dict(
+                **model_inputs,
+                **cls.decoding_kwargs(model_inputs.input_ids[0].tolist(), task, use_draft, adapter),
+                max_new_tokens=settings.MAX_NEW_TOKENS,
+                stopping_criteria=cls._stopping_criteria(tokenizer, tracker, cancelled),
+                logits_processor=cls._logits_processor(constraint, model_inputs.input_ids.shape[1]),
+                streamer=timer,
+            ),
+            daemon=True,
+        )
+        thread.start()
+        pieces = []
+        try:
+            for piece in streamer:
+                if piece:
+                    pieces.append(piece)
+                    yield piece
+            if errors:
+                raise errors[0]
+        finally:
+            cancelled.set()
+            thread.join()
+            stats = cls._finish_timing(timer, "stream", use_draft, sum(drafted))
+            OUTPUT_TOKENS.labels(task).observe(timer.tokens)
+        if on_finish is not None:
+            response = cls.split_thinking("".join(pieces), tracker)
+            response.speculative = stats
+            on_finish(response)
+
+    @classmethod
+    def split_thinking(cls, text: str, tracker: Optional[JsonStoryTracker] = None) -> GenerateResponse:
+        thinking_content, _, answer = text.rpartition("</think>")
+        return cls._response(thinking_content.strip("\n"), answer.strip("\n"), tracker)
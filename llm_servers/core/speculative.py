@@ -0,0 +1,113 @@
+import logging
+import random
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+from config import settings
+from core.metrics import DRAFT_ACCEPTANCE, SPECULATIVE_SPEEDUP, TokenTimer
+from load_llm import get_draft_model
+from schemas.qwen3 import SpeculativeStats
+
+logger = logging.getLogger(__name__)
+
+# 草稿模型在哪个请求下前向计算；按线程记录，并发请求各自计数
+_local = threading.local()
+
+
+class _DraftCounter:
+    def __init__(self) -> None:
+        self.drafted = 0
+
+
+def count_draft_tokens(module, args, output) -> None:
+    """Forward hook on the draft model: every forward pass proposes one token."""
+    counter = getattr(_local, "counter", None)
+    if counter is not None:
+        counter.drafted += 1
+
+
+@contextmanager
+def draft_counter() -> Iterator[_DraftCounter]:
+    """Count the draft tokens proposed by the ``model.generate`` calls in this thread."""
+    counter = _DraftCounter()
+    _local.counter = counter
+    try:
+        yield counter
+    finally:
+        _local.counter = None
+
+
+class BaselineRate:
+    """Moving average of the plain-decoding speed, the reference for the reported speedup."""
+
+    def __init__(self, alpha: float = 0.2) -> None:
+        self.alpha = alpha
+        self.value: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def update(self, rate: Optional[float]) -> None:
+        if rate is None:
+            return
+        with self._lock:
+            self.value = rate if self.value is None else self.value + self.alpha * (rate - self.value)
+
+
+baseline = BaselineRate()
+
+
+def use_draft() -> bool:
+    """
+    Whether a new request decodes with the draft model. A small share of
+    requests (DRAFT_BASELINE_FRACTION) decodes without it, to keep measuring
+    the baseline on the same hardware and load.
+    """
+    return get_draft_model() is not None and random.random() >= settings.DRAFT_BASELINE_FRACTION
+
+
+def assisted_kwargs() -> Dict[str, Any]:
+    return {"assistant_model": get_draft_model()}
+
+
+class SpeculationStats:
+    """Draft and decode counters of one request, over all of its ``model.generate`` calls."""
+
+    def __init__(self) -> None:
+        self.drafted = 0
+        self.tokens = 0
+        self.steps = 0
+        self.decode_tokens = 0
+        self.decode_seconds = 0.0
+
+    def add(self, timer: TokenTimer, drafted: int) -> None:
+        self.drafted += drafted
+        self.tokens += timer.tokens
+        self.steps += timer.steps
+        self.decode_tokens += timer.decode_tokens
+        self.decode_seconds += timer.decode_seconds
+
+    def publish(self) -> Optional[SpeculativeStats]:
+        """Record the request in the metrics and the log; None if the draft model never ran."""
+        if not self.steps or not self.drafted:
+            return None
+
+        # 每个验证步骤接受若干草稿 token，再由主模型补上一个
+        accepted = self.tokens - self.steps
+        tokens_per_second = self.decode_tokens / self.decode_seconds if self.decode_seconds > 0 else None
+        speedup = None
+        if tokens_per_second is not None and baseline.value:
+            speedup = tokens_per_second / baseline.value
+
+        stats = SpeculativeStats(
+            drafted_tokens=self.drafted,
+            accepted_tokens=accepted,
+            acceptance_rate=min(accepted / self.drafted, 1.0),
+            tokens_per_step=self.tokens / self.steps,
+            tokens_per_second=tokens_per_second,
+            speedup=speedup,
+        )
+        DRAFT_ACCEPTANCE.observe(stats.acceptance_rate)
+        if speedup is not None:
+            SPECULATIVE_SPEEDUP.observe(speedup)
+        logger.info("Speculative decoding", extra=stats.model_dump())
+        return stats
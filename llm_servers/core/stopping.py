@@ -0,0 +1,184 @@
+from typing import Callable, Dict, List, Optional
+
+import torch
+from transformers import StoppingCriteria
+
+# 故事节点对象对应的键（见 json_structure）
+NODE_KEYS = ("rootNode", "nextNode")
+# 超出节点预算而停止；输出截到最后一个完整节点（见 JsonStoryTracker.trim_to_budget）
+BUDGET_STOP_REASONS = ("max_nodes", "max_depth")
+CLOSING = {"N": "}", "{": "}", "[": "]"}
+
+
+class JsonStoryTracker:
+    """
+    Incrementally scans generated text for the story JSON.
+
+    Tracks string/escape state and the brace stack one character at a time, so
+    each new token costs O(len(token)). ``stop_reason`` is set once the
+    top-level object closes or a node budget is exceeded.
+
+    A budget stop leaves the output inside the node that went over budget;
+    ``trim_to_budget`` cuts it back to the last complete node and closes the
+    open brackets so the answer still parses.
+    """
+
+    def __init__(self, max_nodes: Optional[int] = None, max_depth: Optional[int] = None) -> None:
+        self.max_nodes = max_nodes
+        self.max_depth = max_depth
+
+        self.num_tokens = 0
+        self.num_nodes = 0
+        self.stop_reason: Optional[str] = None
+
+        self._stack: List[str] = []
+        # 每个未闭合括号在已输入文本中的位置
+        self._starts: List[int] = []
+        self._offset = 0
+        self._string_start = 0
+        self._key_start = 0
+        self._cut: Optional[int] = None
+        self._started = False
+        self._in_string = False
+        self._escaped = False
+        self._string: List[str] = []
+        self._last_string: Optional[str] = None
+        self._key: Optional[str] = None
+
+    @property
+    def stopped(self) -> bool:
+        return self.stop_reason is not None
+
+    @property
+    def depth(self) -> int:
+        """Nesting depth of the story node currently being generated."""
+        return self._stack.count("N")
+
+    def feed_token(self, text: str) -> bool:
+        """Feed the decoded text of one generated token, return True to stop."""
+        if self.stopped:
+            return True
+        self.num_tokens += 1
+        self.feed(text)
+        return self.stopped
+
+    def feed(self, text: str) -> None:
+        for ch in text:
+            if self.stopped:
+                return
+            offset = self._offset
+            self._offset += 1
+
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == "\\":
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+                    self._last_string = "".join(self._string)
+                elif len(self._string) < 16:
+                    # only short strings can be keys we care about
+                    self._string.append(ch)
+                continue
+
+            if not self._started and ch != "{":
+                continue
+
+            if ch == '"':
+                self._in_string = True
+                self._string = []
+                self._string_start = offset
+            elif ch == ":":
+                self._key = self._last_string
+                self._key_start = self._string_start
+            elif ch == "{":
+                if self._started and self._key in NODE_KEYS:
+                    self._stack.append("N")
+                    self._starts.append(offset)
+                    self.num_nodes += 1
+                    self._check_budgets()
+                else:
+                    self._stack.append("{")
+                    self._starts.append(offset)
+                self._started = True
+                self._key = None
+            elif ch == "[":
+                self._stack.append("[")
+                self._starts.append(offset)
+                self._key = None
+            elif ch in "}]":
+                if self._stack:
+                    self._stack.pop()
+                    self._starts.pop()
+                if not self._stack:
+                    self.stop_reason = "json_complete"
+            elif ch == ",":
+                self._key = None
+
+    def _check_budgets(self) -> None:
+        if self.max_nodes is not None and self.num_nodes > self.max_nodes:
+            self.stop_reason = "max_nodes"
+        elif self.max_depth is not None and self.depth > self.max_depth:
+            self.stop_reason = "max_depth"
+        else:
+            return
+        # 去掉包含超预算节点的整个数组元素（选项缺少 nextNode 不合法）；
+        # 没有外层数组时只去掉这个节点的键
+        arrays = [i for i, kind in enumerate(self._stack) if kind == "["]
+        if arrays and arrays[-1] + 1 < len(self._stack):
+            self._cut = self._starts[arrays[-1] + 1]
+            del self._stack[arrays[-1] + 1:]
+        else:
+            self._cut = self._key_start
+            self._stack.pop()
+
+    def trim_to_budget(self, text: str) -> str:
+        """
+        Cut ``text`` back to the last complete node and close the open
+        brackets if it goes over this tracker's budgets; otherwise return it
+        unchanged. Rescans ``text`` with a fresh tracker, since the fully
+        decoded answer need not match the per-token text fed during generation.
+        """
+        tracker = JsonStoryTracker(max_nodes=self.max_nodes, max_depth=self.max_depth)
+        tracker.feed(text)
+        if tracker.stop_reason not in BUDGET_STOP_REASONS:
+            return text
+        kept = text[:tracker._cut].rstrip()
+        if kept.endswith(","):
+            kept = kept[:-1]
+        return kept + "".join(CLOSING[kind] for kind in reversed(tracker._stack))
+
+
+class JsonStoryStoppingCriteria(StoppingCriteria):
+    """Per-row stopping criteria backed by one ``JsonStoryTracker`` per batch row."""
+
+    def __init__(self, tokenizer, trackers: List[Optional[JsonStoryTracker]]) -> None:
+        self.tokenizer = tokenizer
+        self.trackers = trackers
+        self._token_text: Dict[int, str] = {}
+
+    def _decode(self, token_id: int) -> str:
+        text = self._token_text.get(token_id)
+        if text is None:
+            text = self.tokenizer.decode([token_id], skip_special_tokens=True)
+            self._token_text[token_id] = text
+        return text
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        last_tokens = input_ids[:, -1].tolist()
+        is_done = [
+            tracker.feed_token(self._decode(token_id)) if tracker else False
+            for tracker, token_id in zip(self.trackers, last_tokens)
+        ]
+        return torch.tensor(is_done, dtype=torch.bool, device=input_ids.device)
+
+
+class CancelStoppingCriteria(StoppingCriteria):
+    """Stops the rows whose request went away, e.g. a disconnected stream client."""
+
+    def __init__(self, cancelled: List[Callable[[], bool]]) -> None:
+        self.cancelled = cancelled
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        return torch.tensor([check() for check in self.cancelled], dtype=torch.bool, device=input_ids.device)
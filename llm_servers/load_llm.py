@@ -1,71 +1,250 @@
 # lifespan_manager.py
-from contextlib import asynccontextmanager
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Dict, Iterator, Optional
 from fastapi import FastAPI
-from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
+from transformers import AutoTokenizer, AutoModelForCausalLM
 import torch
 import logging
 
-# 配置日志
-logging.basicConfig(level=logging.INFO)
+from core.backends import InferenceBackend, build_backend
+from core.metrics import MODEL_READY, STARTUP_PHASE_DURATION
+
 logger = logging.getLogger(__name__)
 
 # 全局变量存储模型和tokenizer
 model = None
 tokenizer = None
+draft_model = None
+backend: Optional[InferenceBackend] = None
+
+# 启动状态：loading → ready，加载出错为 failed，关闭时为 stopping
+status = "loading"
+startup_error: Optional[str] = None
+startup_phases: Dict[str, float] = {}
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """
-    管理应用生命周期的函数，负责模型的加载和释放
+    管理应用生命周期的函数，负责模型的加载和释放。
+    模型在后台加载，端口立即可用：加载完成前 /readyz 和生成接口返回 503
     """
-    # 启动时加载模型
-    global model, tokenizer
-    
-    try:
-        logger.info("Loading model...")
-        # 假设settings是从其他模块导入的
-        from config import settings
-        llm_path = settings.LLM_PATH
-        device = "cuda:0" if torch.cuda.is_available() else "cpu"
-        
-        # 加载Qwen3模型
-        tokenizer = AutoTokenizer.from_pretrained(llm_path)
-        quantization_config = BitsAndBytesConfig(
-            load_in_4bit=True,
-            bnb_4bit_use_double_quant=True,
-            bnb_4bit_quant_type="nf4",
-            bnb_4bit_compute_dtype=torch.float16
-        )
-        model = AutoModelForCausalLM.from_pretrained(
-            llm_path,
-            quantization_config=quantization_config,
-            device_map="auto",
-            low_cpu_mem_usage=True,
-            trust_remote_code=True,
-            dtype=torch.float16
-        ).to(device)
-        model_name = llm_path.split("/")[-1]
-        logger.info(f"Loaded model {model_name} on {device}")
-
-        # TODO：TTS模型加载
-        
-    except Exception as e:
-        logger.error(f"Failed to load model: {str(e)}")
-        raise
-    
+    global model, tokenizer, draft_model, status
+
+    loader = asyncio.create_task(load_models())
+
     yield  # 应用运行期间
-    
+
     # 关闭时释放资源
+    status = "stopping"
+    MODEL_READY.set(0)
+    if not loader.done():
+        # 线程里的加载无法中断，进程退出时一并结束
+        loader.cancel()
     try:
+        from core.batching import stop_scheduler
+        await stop_scheduler()
+
+        from core.prefix_cache import clear_prefix_caches
+        clear_prefix_caches()
+
+        from core.adapters import stop_registry
+        stop_registry()
+
         logger.info("Unloading model...")
-        del model
-        del tokenizer
+        model = None
+        tokenizer = None
+        draft_model = None
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
         logger.info("Model unloaded successfully")
     except Exception as e:
         logger.error(f"Error during model unloading: {str(e)}")
 
+async def load_models() -> None:
+    """Load, warm up and start serving; runs as a background task of the lifespan."""
+    global status, startup_error
+    started = time.perf_counter()
+    try:
+        logger.info("Loading model...")
+        await asyncio.to_thread(_load_models)
+
+        with startup_phase("scheduler"):
+            from core.batching import start_scheduler
+            await start_scheduler()
+    except Exception as e:
+        status = "failed"
+        startup_error = str(e)
+        logger.error(f"Failed to load model: {str(e)}")
+        return
+
+    status = "ready"
+    MODEL_READY.set(1)
+    logger.info(
+        f"Model ready after {time.perf_counter() - started:.1f} s",
+        extra={"phases": startup_phases},
+    )
+
+def _load_models() -> None:
+    global model, tokenizer, draft_model, backend
+    from config import settings
+    llm_path = settings.LLM_PATH
+    backend = build_backend(
+        settings.INFERENCE_BACKEND,
+        cpu_quantization=settings.CPU_QUANTIZATION,
+        cpu_dtype=settings.CPU_DTYPE,
+        cpu_num_threads=settings.CPU_NUM_THREADS,
+    )
+
+    # 加载Qwen3模型
+    with startup_phase("tokenizer"):
+        tokenizer = AutoTokenizer.from_pretrained(llm_path)
+    model = load_main_model(llm_path, backend)
+    model_name = llm_path.split("/")[-1]
+    logger.info(f"Loaded model {model_name} on {model.device} with the {backend.describe()} backend")
+
+    from core.metrics import watch_model_memory
+    watch_model_memory(model)
+
+    if settings.DRAFT_MODEL_PATH:
+        with startup_phase("draft"):
+            draft_model = load_draft_model(settings.DRAFT_MODEL_PATH, model, tokenizer)
+
+    if settings.CONSTRAINED_DECODING_PRECOMPILE:
+        with startup_phase("constraints"):
+            from core.constrained import precompile
+            from core.qwen3 import LLMQwen
+            precompile(
+                tokenizer, LLMQwen.eos_token_ids(model, tokenizer), model.config.vocab_size, model.device
+            )
+
+    if settings.PREFIX_CACHE_ENABLED:
+        with startup_phase("prefix_cache"):
+            from core.prefix_cache import build_prefix_cache
+            from core.prompts import TASK_PROMPTS
+            for task in TASK_PROMPTS:
+                build_prefix_cache(model, tokenizer, llm_path, task)
+
+    if settings.WARMUP_NEW_TOKENS > 0:
+        with startup_phase("warmup"):
+            warm_up(model, tokenizer, settings.WARMUP_NEW_TOKENS)
+
+    with startup_phase("adapters"):
+        from core.adapters import start_registry
+        start_registry(settings.ADAPTERS, settings.ADAPTER_MAX_LOADED)
+
+    # TODO：TTS模型加载
+
+@contextmanager
+def startup_phase(name: str) -> Iterator[None]:
+    """Time one startup phase; the durations are logged, exported and shown by /readyz."""
+    started = time.perf_counter()
+    yield
+    seconds = time.perf_counter() - started
+    startup_phases[name] = round(seconds, 3)
+    STARTUP_PHASE_DURATION.labels(name).set(seconds)
+    logger.info(f"Startup phase {name} took {seconds:.2f} s", extra={"phase": name, "seconds": round(seconds, 3)})
+
+def quantized_cache_path(llm_path: str, inference_backend: InferenceBackend) -> Optional[str]:
+    """
+    Directory of the exported quantized model, keyed by the checkpoint and
+    the backend's quantization settings so that a changed checkpoint is
+    exported again. None when caching is off or the backend cannot export.
+    """
+    from config import settings
+    if not settings.QUANTIZED_CACHE_DIR or inference_backend.cache_tag is None:
+        return None
+    source = os.path.abspath(llm_path) if os.path.isdir(llm_path) else llm_path
+    config_file = os.path.join(source, "config.json")
+    modified = os.path.getmtime(config_file) if os.path.exists(config_file) else None
+    key = json.dumps([source, modified, inference_backend.cache_key()], sort_keys=True, default=str)
+    digest = hashlib.sha256(key.encode("utf-8")).hexdigest()[:12]
+    name = f"{os.path.basename(source.rstrip('/'))}-{inference_backend.cache_tag}-{digest}"
+    return os.path.join(settings.QUANTIZED_CACHE_DIR, name)
+
+def load_main_model(llm_path: str, inference_backend: InferenceBackend):
+    """
+    Load the main model through the inference backend. With an exportable
+    backend the first start quantizes the checkpoint and exports the result;
+    later starts memory-map the exported safetensors, which skips both
+    reading the fp16 weights and quantizing them.
+    """
+    cache_path = quantized_cache_path(llm_path, inference_backend)
+    if cache_path and os.path.isdir(cache_path):
+        with startup_phase("load_cached"):
+            return inference_backend.load_exported(cache_path)
+
+    main_model = inference_backend.load(llm_path, phase=startup_phase)
+    if cache_path:
+        with startup_phase("export"):
+            export_quantized_model(main_model, cache_path)
+    return main_model
+
+def export_quantized_model(main_model, cache_path: str) -> None:
+    """
+    Save the quantized model to ``cache_path``. It is written to a temporary
+    directory and renamed, so a replica starting at the same time never sees
+    a half-written cache; a failed export only costs the next start a
+    re-quantization.
+    """
+    tmp_path = f"{cache_path}.tmp-{os.getpid()}"
+    try:
+        main_model.save_pretrained(tmp_path, safe_serialization=True)
+        os.rename(tmp_path, cache_path)
+        logger.info(f"Exported quantized model to {cache_path}")
+    except Exception as e:
+        logger.warning(f"Could not export quantized model to {cache_path}: {str(e)}")
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+@torch.inference_mode()
+def warm_up(main_model, main_tokenizer, new_tokens: int) -> None:
+    """
+    One short generate on every decoding path requests will take, so the
+    first real request does not pay for kernel selection and allocator
+    growth.
+    """
+    from core import speculative
+    from core.qwen3 import LLMQwen
+
+    text = LLMQwen.build_chat_text(main_tokenizer, "Generate a story with the theme: warm-up", "story")
+    inputs = main_tokenizer(text, return_tensors="pt").to(main_model.device)
+    paths = [LLMQwen.prefix_cache_kwargs(inputs.input_ids[0].tolist(), "story")]
+    if draft_model is not None:
+        paths.append(speculative.assisted_kwargs())
+    for kwargs in paths:
+        main_model.generate(**inputs, **kwargs, max_new_tokens=new_tokens)
+
+def load_draft_model(draft_path: str, main_model, main_tokenizer):
+    """
+    Load the small model proposing tokens for speculative decoding. It runs
+    unquantized on the main model's device: 4-bit kernels would make the
+    many small draft forwards slower, not faster.
+    """
+    from config import settings
+    from core.speculative import count_draft_tokens
+
+    draft_tokenizer = AutoTokenizer.from_pretrained(draft_path)
+    if draft_tokenizer.get_vocab() != main_tokenizer.get_vocab():
+        raise ValueError(f"Draft model {draft_path} does not share the main model's tokenizer")
+
+    draft = AutoModelForCausalLM.from_pretrained(
+        draft_path,
+        device_map={"": main_model.device},
+        low_cpu_mem_usage=True,
+        dtype=torch.float16 if main_model.device.type == "cuda" else torch.float32,
+    ).eval()
+    draft.generation_config.num_assistant_tokens = settings.DRAFT_NUM_TOKENS
+    draft.generation_config.num_assistant_tokens_schedule = settings.DRAFT_SCHEDULE
+    draft.register_forward_hook(count_draft_tokens)
+    logger.info(f"Loaded draft model {draft_path.split('/')[-1]} for speculative decoding")
+    return draft
+
 def get_model():
     """获取模型实例的函数"""
     return model
@@ -73,3 +252,15 @@ def get_model():
 def get_tokenizer():
     """获取tokenizer实例的函数"""
     return tokenizer
+
+def get_draft_model():
+    """获取草稿模型实例的函数，未配置时为 None"""
+    return draft_model
+
+def get_backend():
+    """获取推理后端实例的函数"""
+    return backend
+
+def is_ready() -> bool:
+    """模型加载并预热完成、可以接收请求时为 True"""
+    return status == "ready"
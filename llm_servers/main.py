@@ -2,9 +2,12 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 from config import settings
-from routers import qwen3
+from core.log_context import JobIdMiddleware, configure_logging
+from routers import qwen3, adapters, metrics, health
 from load_llm import lifespan
 
+configure_logging(settings.LOG_LEVEL, settings.LOG_FORMAT)
+
 app = FastAPI(
     lifespan=lifespan,
     title="Choose Your Own Adventure Game API",
@@ -21,9 +24,15 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(JobIdMiddleware)
 
 app.include_router(qwen3.router, prefix=settings.API_PREFIX)
+if settings.ADMIN_TOKEN:
+    app.include_router(adapters.router, prefix=settings.API_PREFIX)
+app.include_router(metrics.router)
+app.include_router(health.router)
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("main:app", host="0.0.0.0", port=8001, reload=True)
\ No newline at end of file
+    # 自动重载会在每次改动后重新加载模型，只在调试时开启
+    uvicorn.run("main:app", host="0.0.0.0", port=8001, reload=settings.DEBUG)
\ No newline at end of file
@@ -0,0 +1,54 @@
+import logging
+import secrets
+from typing import List, Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException
+from fastapi.concurrency import run_in_threadpool
+
+from config import settings
+from core.adapters import get_registry
+from routers.qwen3 import require_ready
+from schemas.qwen3 import AdapterInfo, AdapterLoadRequest
+
+logger = logging.getLogger(__name__)
+
+
+def require_admin(x_admin_token: Optional[str] = Header(None)) -> None:
+    # main 只在配置了 ADMIN_TOKEN 时挂载本路由；这里仍然拒绝未配置的情况
+    if not settings.ADMIN_TOKEN or not secrets.compare_digest(
+        (x_admin_token or "").encode(), settings.ADMIN_TOKEN.encode()
+    ):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+router = APIRouter(
+    prefix="/adapters",
+    tags=["adapters"],
+    dependencies=[Depends(require_ready), Depends(require_admin)],
+)
+
+
+@router.get("", response_model=List[AdapterInfo])
+def list_adapters():
+    return get_registry().list()
+
+
+@router.put("/{name}", response_model=AdapterInfo)
+async def load_adapter(name: str, resquest: AdapterLoadRequest):
+    # 切换适配器要等正在使用模型的请求结束，在线程池里等待
+    try:
+        await run_in_threadpool(get_registry().register, name, resquest.path, resquest.preload)
+    except (ValueError, OSError) as e:
+        logger.error(f"Failed to load adapter {name}: {str(e)}")
+        raise HTTPException(status_code=400, detail=f"Failed to load adapter {name}: {str(e)}")
+    logger.info("Adapter registered", extra={"adapter": name, "path": resquest.path, "preload": resquest.preload})
+    return next(info for info in get_registry().list() if info["name"] == name)
+
+
+@router.delete("/{name}", status_code=204)
+async def unload_adapter(name: str):
+    try:
+        await run_in_threadpool(get_registry().unload, name)
+    except ValueError:
+        raise HTTPException(status_code=404, detail=f"Adapter {name} not found")
+    logger.info("Adapter unloaded", extra={"adapter": name})
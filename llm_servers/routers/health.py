@@ -0,0 +1,21 @@
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+
+import load_llm
+
+router = APIRouter(tags=["health"])
+
+
+@router.get("/healthz", include_in_schema=False)
+def healthz() -> JSONResponse:
+    """Liveness: the process is serving; fails only when loading the model failed."""
+    if load_llm.status == "failed":
+        return JSONResponse({"status": "failed", "error": load_llm.startup_error}, status_code=503)
+    return JSONResponse({"status": load_llm.status})
+
+
+@router.get("/readyz", include_in_schema=False)
+def readyz() -> JSONResponse:
+    """Readiness: the model is loaded and warmed up; lists the startup phase timings."""
+    body = {"status": load_llm.status, "phases": load_llm.startup_phases}
+    return JSONResponse(body, status_code=200 if load_llm.is_ready() else 503)
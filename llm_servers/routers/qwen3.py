@@ -1,14 +1,40 @@
+import asyncio
+import json
+import logging
+import threading
 import uuid
+from contextlib import aclosing
 from typing import Optional, Any
 from datetime import datetime
 from fastapi import APIRouter, Depends, HTTPException, Cookie, Response, BackgroundTasks
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import iterate_in_threadpool
 from schemas.qwen3 import GenerateRequest
 from core.qwen3 import LLMQwen
+from core.adapters import get_registry
+from core.batching import get_scheduler
+from core.metrics import REQUEST_DURATION, REQUESTS_IN_FLIGHT
 from schemas.qwen3 import GenerateResponse
+from load_llm import is_ready
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# 不经过批处理调度器的流式请求各占一个生成线程，限制同时进行的个数
+stream_slots = asyncio.Semaphore(settings.STREAM_MAX_CONCURRENCY)
+
+
+def require_ready() -> None:
+    # 模型加载和预热完成前拒绝请求，调用方（后端 LLM 客户端）对 503 会退避重试
+    if not is_ready():
+        raise HTTPException(status_code=503, detail="Model is not ready", headers={"Retry-After": "5"})
+
 
 router = APIRouter(
     prefix="/qwen3",
-    tags=["qwen3"]
+    tags=["qwen3"],
+    dependencies=[Depends(require_ready)],
 )
 
 def get_session_id(session_id: Optional[str] = Cookie(None)):
@@ -17,6 +43,23 @@ def get_session_id(session_id: Optional[str] = Cookie(None)):
     return session_id
 
 
+def format_sse(data: str, event: Optional[str] = None) -> str:
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {data}\n\n"
+
+
+def check_adapter(resquest: GenerateRequest) -> None:
+    if resquest.adapter is not None and not get_registry().is_registered(resquest.adapter):
+        raise HTTPException(status_code=404, detail=f"Adapter {resquest.adapter} not found")
+
+
+def user_prompt(resquest: GenerateRequest) -> str:
+    # story 任务的提示来自 LangChain（"Human: ...: 主题"），只保留主题；其他任务原样使用
+    if resquest.task == "story":
+        return resquest.prompt.split(':')[-1]
+    return resquest.prompt
+
+
 @router.post("/generate", response_model=GenerateResponse)
 async def generate_text(
     resquest:GenerateRequest,
@@ -24,12 +67,101 @@ async def generate_text(
     session_id: str = Depends(get_session_id),
 ):
     response.set_cookie(key="session_id", value=session_id, httponly=True)
-    print(f"Request:{resquest}")
-    prompt = resquest.prompt.split(':')[-1]
-    print(f"Prompt:{prompt}")
+    check_adapter(resquest)
+    prompt = user_prompt(resquest)
+    logger.info(
+        "Generate request",
+        extra={
+            "task": resquest.task,
+            "prompt_chars": len(prompt),
+            "constrained": resquest.constrained,
+            "adapter": resquest.adapter,
+        },
+    )
+    logger.debug(f"Prompt: {prompt}")
 
+    with REQUESTS_IN_FLIGHT.track_inprogress(), REQUEST_DURATION.labels(resquest.task, "generate").time():
+        scheduler = get_scheduler()
+        if scheduler:
+            result = await scheduler.submit(
+                prompt, resquest.max_nodes, resquest.max_depth, resquest.task, resquest.constrained, resquest.adapter
+            )
+        else:
+            result = await run_in_threadpool(
+                LLMQwen.generate_response,
+                prompt, resquest.max_nodes, resquest.max_depth, resquest.task, resquest.constrained, resquest.adapter,
+            )
 
-    result = LLMQwen.generate_response(prompt)
+    return result
 
 
-    return result
+@router.post("/generate/stream")
+async def generate_text_stream(
+    resquest: GenerateRequest,
+    session_id: str = Depends(get_session_id),
+):
+    check_adapter(resquest)
+    prompt = user_prompt(resquest)
+    logger.info(
+        "Stream request",
+        extra={
+            "task": resquest.task,
+            "prompt_chars": len(prompt),
+            "constrained": resquest.constrained,
+            "adapter": resquest.adapter,
+        },
+    )
+    logger.debug(f"Stream prompt: {prompt}")
+
+    async def stream_pieces(on_finish):
+        scheduler = get_scheduler()
+        if scheduler:
+            # 客户端断开时关闭 stream 会取消请求，批次在下一个 token 处去掉这一行
+            async with aclosing(scheduler.stream(
+                prompt,
+                resquest.max_nodes,
+                resquest.max_depth,
+                resquest.task,
+                on_finish=on_finish,
+                constrained=resquest.constrained,
+                adapter=resquest.adapter,
+            )) as pieces:
+                async for piece in pieces:
+                    yield piece
+            return
+
+        cancelled = threading.Event()
+        async with stream_slots:
+            try:
+                pieces_iter = LLMQwen.stream_response(
+                    prompt,
+                    resquest.max_nodes,
+                    resquest.max_depth,
+                    resquest.task,
+                    on_finish=on_finish,
+                    constrained=resquest.constrained,
+                    adapter=resquest.adapter,
+                    cancelled=cancelled,
+                )
+                async for piece in iterate_in_threadpool(pieces_iter):
+                    yield piece
+            finally:
+                cancelled.set()
+
+    async def event_stream():
+        finished = []
+        with REQUESTS_IN_FLIGHT.track_inprogress(), REQUEST_DURATION.labels(resquest.task, "stream").time():
+            try:
+                async with aclosing(stream_pieces(finished.append)) as pieces:
+                    async for piece in pieces:
+                        yield format_sse(json.dumps({"text": piece}, ensure_ascii=False))
+            except Exception as e:
+                logger.error(f"Stream generation failed: {str(e)}")
+                yield format_sse(json.dumps({"detail": str(e)}, ensure_ascii=False), event="error")
+                return
+        yield format_sse(finished[0].model_dump_json(), event="done")
+
+    response = StreamingResponse(event_stream(), media_type="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.set_cookie(key="session_id", value=session_id, httponly=True)
+    return response
@@ -1,11 +1,49 @@
-from pydantic import BaseModel
+from typing import Literal, Optional
+from pydantic import BaseModel, Field
+
+
+class SpeculativeStats(BaseModel):
+    drafted_tokens: int
+    accepted_tokens: int
+    acceptance_rate: float
+    # 每次主模型验证平均产出的 token 数（接受的草稿 token 加一）
+    tokens_per_step: float
+    tokens_per_second: Optional[float] = None
+    # 相对不使用草稿模型的解码速度；基线尚未测得时为空
+    speedup: Optional[float] = None
 
 
 class GenerateResponse(BaseModel):
     thinking_content: str
     answer: str
+    stop_reason: Optional[str] = None
+    speculative: Optional[SpeculativeStats] = None
 
 class GenerateRequest(BaseModel):
     prompt: str
+    # 节点预算；超出时输出截到最后一个完整节点，根节点必须保留
+    max_nodes: Optional[int] = Field(default=None, ge=1)
+    max_depth: Optional[int] = Field(default=None, ge=1)
+    # story：完整故事树；lazy_story：只有根节点和选项；node：按路径续写单个节点；
+    # branch：按路径重写完整故事中缺失的一整个分支
+    task: Literal["story", "lazy_story", "node", "branch"] = "story"
+    # 按任务的 JSON schema 约束解码；为空时使用服务端默认值
+    constrained: Optional[bool] = None
+    # LoRA 适配器名称（故事风格）；为空时使用基础模型
+    adapter: Optional[str] = None
+
+
+class AdapterLoadRequest(BaseModel):
+    path: str
+    # 立即加载；否则只注册，首次使用时加载
+    preload: bool = True
+
+
+class AdapterInfo(BaseModel):
+    name: str
+    path: str
+    loaded: bool
+    active: bool
+    last_used: Optional[float] = None
 
 
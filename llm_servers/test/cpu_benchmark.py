@@ -0,0 +1,116 @@
+"""
+Compare the CPU backend with the current path on a GPU-less node.
+
+    python test/cpu_benchmark.py --model /models/Qwen3-1.7B --threads 16
+
+Without CUDA the current loader ends up running the fp16 checkpoint as it
+is ("current"). The script loads that and every CPU backend variant,
+decodes the same prompts greedily with each and reports load time, weight
+memory, tokens/sec and the speedup over the current path. Quantization and
+lower precision change the logits slightly, so outputs are compared with
+the fp32 variant and a divergence is reported with its position.
+"""
+import argparse
+import os
+import sys
+import time
+from typing import Dict, List
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from core.backends import CpuBackend, weight_bytes  # noqa: E402
+
+PROMPTS = [
+    "Generate a story with the theme: pirates",
+    "Generate a story with the theme: haunted lighthouse",
+    "Generate a story with the theme: cyberpunk mystery",
+    "Generate a story with the theme: lost in the desert",
+]
+
+VARIANTS = ("current", "fp32", "bf16", "int8")
+
+
+def load_variant(name: str, path: str):
+    if name == "current":
+        return AutoModelForCausalLM.from_pretrained(path, dtype=torch.float16).eval()
+    if name == "int8":
+        return CpuBackend("int8").load(path)
+    return CpuBackend("none", {"fp32": "float32", "bf16": "bfloat16"}[name]).load(path)
+
+
+@torch.inference_mode()
+def run(model, tokenizer, prompts: List[str], max_new_tokens: int):
+    outputs, tokens, seconds = [], 0, 0.0
+    for prompt in prompts:
+        text = tokenizer.apply_chat_template(
+            [{"role": "user", "content": prompt}], add_generation_prompt=True, tokenize=False, enable_thinking=False
+        )
+        inputs = tokenizer(text, return_tensors="pt")
+        started = time.perf_counter()
+        output = model.generate(**inputs, max_new_tokens=max_new_tokens, do_sample=False)
+        seconds += time.perf_counter() - started
+        new_tokens = output[0, inputs.input_ids.shape[1]:].tolist()
+        outputs.append(new_tokens)
+        tokens += len(new_tokens)
+    return outputs, tokens, seconds
+
+
+def first_divergences(reference: List[List[int]], outputs: List[List[int]]) -> List[int]:
+    return [
+        next((i for i, (a, b) in enumerate(zip(p, q)) if a != b), min(len(p), len(q)))
+        for p, q in zip(reference, outputs) if p != q
+    ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the CPU inference backend against the current path")
+    parser.add_argument("--model", required=True)
+    parser.add_argument("--max-new-tokens", type=int, default=128)
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads (default: physical cores)")
+    parser.add_argument("--variants", default=",".join(VARIANTS), help=f"comma-separated subset of {VARIANTS}")
+    args = parser.parse_args()
+
+    variants = args.variants.split(",")
+    unknown = set(variants) - set(VARIANTS)
+    if unknown:
+        parser.error(f"unknown variants: {', '.join(sorted(unknown))}")
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    results: Dict[str, dict] = {}
+    for name in variants:
+        started = time.perf_counter()
+        model = load_variant(name, args.model)
+        load_seconds = time.perf_counter() - started
+        # 预热，避免首次调用的内存分配计入结果
+        run(model, tokenizer, PROMPTS[:1], 8)
+        outputs, tokens, seconds = run(model, tokenizer, PROMPTS, args.max_new_tokens)
+        results[name] = {
+            "load": load_seconds,
+            "memory": weight_bytes(model),
+            "rate": tokens / seconds,
+            "tokens": tokens,
+            "seconds": seconds,
+            "outputs": outputs,
+        }
+        del model
+
+    reference = results.get("fp32", results.get("current"))
+    baseline = results.get("current")
+    print(f"prompts: {len(PROMPTS)}  (greedy, max {args.max_new_tokens} new tokens, {torch.get_num_threads()} threads)")
+    print(f"{'variant':<9} {'load s':>8} {'weights MB':>11} {'tokens/s':>9} {'speedup':>8}  outputs")
+    for name, result in results.items():
+        speedup = f"{result['rate'] / baseline['rate']:.2f}x" if baseline else "-"
+        divergences = first_divergences(reference["outputs"], result["outputs"])
+        agreement = f"{len(divergences)} differ at tokens {divergences}" if divergences else "identical"
+        print(
+            f"{name:<9} {result['load']:>8.1f} {result['memory'] / 2**20:>11.0f} "
+            f"{result['rate']:>9.2f} {speedup:>8}  {agreement}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Compare plain and speculative decoding on the same hardware.
+
+    python test/speculative_benchmark.py --model /models/Qwen3-8B --draft /models/Qwen3-0.6B
+
+Every prompt is decoded greedily with and without the draft model and the
+script reports tokens/sec, acceptance rate and speedup. Speculative
+decoding only changes how fast the main model's tokens are produced, so
+the outputs should match; in fp16 the verification pass (several tokens
+per forward) can round differently, so a late divergence is reported with
+its position rather than treated as an error.
+"""
+import argparse
+import time
+from typing import List
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+
+PROMPTS = [
+    "Generate a story with the theme: pirates",
+    "Generate a story with the theme: haunted lighthouse",
+    "Generate a story with the theme: cyberpunk mystery",
+    "Generate a story with the theme: lost in the desert",
+]
+
+
+class _Counter:
+    """Counts verification steps and produced tokens; generate() sends the prompt first."""
+
+    def __init__(self) -> None:
+        self.steps = 0
+        self.tokens = 0
+        self._prompt_seen = False
+
+    def put(self, value) -> None:
+        if self._prompt_seen:
+            self.steps += 1
+            self.tokens += value.shape[-1] if value.dim() == 2 else 1
+        self._prompt_seen = True
+
+    def end(self) -> None:
+        pass
+
+
+def load_main(path: str, quantize: bool):
+    kwargs = {"device_map": "auto", "dtype": torch.float16}
+    if quantize:
+        kwargs["quantization_config"] = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_use_double_quant=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=torch.float16,
+        )
+    return AutoModelForCausalLM.from_pretrained(path, **kwargs).eval()
+
+
+@torch.inference_mode()
+def run(model, tokenizer, prompts: List[str], max_new_tokens: int, draft=None):
+    outputs, tokens, seconds, steps = [], 0, 0.0, 0
+    for prompt in prompts:
+        text = tokenizer.apply_chat_template(
+            [{"role": "user", "content": prompt}], add_generation_prompt=True, tokenize=False, enable_thinking=False
+        )
+        inputs = tokenizer(text, return_tensors="pt").to(model.device)
+        counter = _Counter()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        started = time.perf_counter()
+        output = model.generate(
+            **inputs,
+            max_new_tokens=max_new_tokens,
+            do_sample=False,
+            streamer=counter,
+            **({"assistant_model": draft} if draft is not None else {}),
+        )
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        seconds += time.perf_counter() - started
+        outputs.append(output[0, inputs.input_ids.shape[1]:].tolist())
+        tokens += counter.tokens
+        steps += counter.steps
+    return outputs, tokens, seconds, steps
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark speculative decoding against plain decoding")
+    parser.add_argument("--model", required=True)
+    parser.add_argument("--draft", required=True)
+    parser.add_argument("--max-new-tokens", type=int, default=512)
+    parser.add_argument("--num-assistant-tokens", type=int, default=5)
+    parser.add_argument("--schedule", default="heuristic", choices=("heuristic", "constant"))
+    parser.add_argument("--no-quantize", action="store_true", help="load the main model in fp16 instead of 4-bit")
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    model = load_main(args.model, quantize=not args.no_quantize)
+    draft = AutoModelForCausalLM.from_pretrained(
+        args.draft, device_map={"": model.device}, dtype=torch.float16
+    ).eval()
+    draft.generation_config.num_assistant_tokens = args.num_assistant_tokens
+    draft.generation_config.num_assistant_tokens_schedule = args.schedule
+    drafted = [0]
+    draft.register_forward_hook(lambda module, inputs, output: drafted.__setitem__(0, drafted[0] + 1))
+
+    # 预热，避免首次调用的 CUDA 初始化计入结果
+    run(model, tokenizer, PROMPTS[:1], 16)
+    run(model, tokenizer, PROMPTS[:1], 16, draft=draft)
+    drafted[0] = 0
+
+    plain, plain_tokens, plain_seconds, _ = run(model, tokenizer, PROMPTS, args.max_new_tokens)
+    spec, spec_tokens, spec_seconds, spec_steps = run(model, tokenizer, PROMPTS, args.max_new_tokens, draft=draft)
+
+    divergences = [
+        next((i for i, (a, b) in enumerate(zip(p, q)) if a != b), min(len(p), len(q)))
+        for p, q in zip(plain, spec) if p != q
+    ]
+    plain_rate = plain_tokens / plain_seconds
+    spec_rate = spec_tokens / spec_seconds
+    accepted = spec_tokens - spec_steps
+    print(f"prompts:          {len(PROMPTS)}  (greedy, max {args.max_new_tokens} new tokens)")
+    print(f"plain:            {plain_tokens} tokens in {plain_seconds:.1f} s  ({plain_rate:.1f} tokens/s)")
+    print(f"speculative:      {spec_tokens} tokens in {spec_seconds:.1f} s  ({spec_rate:.1f} tokens/s)")
+    print(f"acceptance rate:  {accepted / drafted[0]:.1%}  ({accepted}/{drafted[0]} draft tokens)")
+    print(f"tokens per step:  {spec_tokens / spec_steps:.2f}")
+    print(f"speedup:          {spec_rate / plain_rate:.2f}x")
+    if divergences:
+        print(f"outputs:          {len(divergences)} differ, first divergence at tokens {divergences}")
+    else:
+        print("outputs:          identical")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+import os
+
+# config 在导入时读取配置；单元测试不加载模型
+os.environ.setdefault("LLM_PATH", "unused")
+os.environ.setdefault("TTS_PATH", "unused")
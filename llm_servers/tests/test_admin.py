@@ -0,0 +1,24 @@
+import pytest
+from fastapi import HTTPException
+
+from config import settings
+from routers.adapters import require_admin
+
+
+def test_admin_api_closed_without_token(monkeypatch):
+    monkeypatch.setattr(settings, "ADMIN_TOKEN", None)
+    with pytest.raises(HTTPException) as excinfo:
+        require_admin("anything")
+    assert excinfo.value.status_code == 403
+
+
+@pytest.mark.parametrize("header", [None, "", "wrong", "secret "])
+def test_wrong_admin_token_rejected(monkeypatch, header):
+    monkeypatch.setattr(settings, "ADMIN_TOKEN", "secret")
+    with pytest.raises(HTTPException):
+        require_admin(header)
+
+
+def test_admin_token_accepted(monkeypatch):
+    monkeypatch.setattr(settings, "ADMIN_TOKEN", "secret")
+    require_admin("secret")
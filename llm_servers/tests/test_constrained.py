@@ -0,0 +1,236 @@
+import importlib.util
+import json
+from pathlib import Path
+
+import pytest
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import PreTrainedTokenizerFast
+
+from core.constrained import GRAMMARS, MAX_WHITESPACE, TASK_SCHEMAS, JsonConstraint, TokenVocabulary
+
+BACKEND_MODELS = Path(__file__).resolve().parents[2] / "backend" / "core" / "models.py"
+
+
+def node(content, *children, stub=False):
+    options = [{"text": text} if stub else {"text": text, "nextNode": child} for text, child in children]
+    return {
+        "content": content,
+        "isEnding": not children,
+        "isWinningEnding": not children and content.endswith("!"),
+        "options": options or None,
+    }
+
+
+BRANCH = node("The cave \"opens\"\n", ("Go in", node("Gold!")), ("Leave", node("Home é 中")))
+DOCUMENTS = {
+    "story": {"title": "The Cave", "rootNode": BRANCH},
+    "lazy_story": {"title": "The Cave", "rootNode": node("Dark", ("Go in", None), ("Leave", None), stub=True)},
+    "node": node("Dark", ("Go in", None), stub=True),
+    "branch": BRANCH,
+}
+
+
+def encode(document, indent=None):
+    return json.dumps(document, indent=indent, ensure_ascii=False)
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    """A byte-level BPE like Qwen's, trained on the test documents so tokens span JSON punctuation."""
+    backend = Tokenizer(models.BPE())
+    backend.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    backend.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=400,
+        special_tokens=["<eos>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+        show_progress=False,
+    )
+    backend.train_from_iterator(
+        [encode(document, indent) for document in DOCUMENTS.values() for indent in (None, 2)], trainer
+    )
+    return PreTrainedTokenizerFast(tokenizer_object=backend, eos_token="<eos>")
+
+
+@pytest.fixture(scope="module")
+def vocabulary(tokenizer):
+    return TokenVocabulary(tokenizer)
+
+
+def walk(grammar, data: bytes, state=None):
+    state = grammar.initial if state is None else state
+    for byte in data:
+        state = grammar.advance(state, byte)
+        if state is None:
+            return None
+    return state
+
+
+@pytest.mark.parametrize("indent", [None, 2])
+@pytest.mark.parametrize("task", list(DOCUMENTS))
+def test_valid_documents_accepted(task, indent):
+    grammar = GRAMMARS[task]
+    state = walk(grammar, encode(DOCUMENTS[task], indent).encode())
+    assert state is not None and grammar.is_complete(state)
+
+
+@pytest.mark.parametrize("text", [
+    # 键的顺序固定
+    '{"rootNode": {}, "title": "t"}',
+    # 缺少键
+    '{"title": "t"}',
+    '{"title": "t", "rootNode": {"content": "c", "isEnding": true, "isWinningEnding": false}}',
+    '{"title": "t",}',
+    '{"title": 1',
+    '{"title": "t", "rootNode": {"content": "c", "isEnding": True',
+    '{"title": "a\x01b"',
+    '{"title": "\\x"',
+    '{"title": "\\u12g4"',
+    '{"title": "t", "rootNode": {"content": "c", "isEnding": true, "isWinningEnding": false, "options": [,',
+    '[]',
+])
+def test_invalid_documents_rejected(text):
+    assert walk(GRAMMARS["story"], text.encode()) is None
+
+
+def test_nothing_after_the_document():
+    grammar = GRAMMARS["story"]
+    complete = walk(grammar, encode(DOCUMENTS["story"]).encode())
+    assert grammar.advance(complete, ord(" ")) is None
+    assert grammar.advance(complete, ord("{")) is None
+
+
+def test_whitespace_run_is_bounded():
+    grammar = GRAMMARS["story"]
+    assert walk(grammar, b"{" + b" " * MAX_WHITESPACE) is not None
+    assert walk(grammar, b"{" + b" " * (MAX_WHITESPACE + 1)) is None
+
+
+def allowed_ids(vocabulary, grammar, state, tokenizer):
+    kind, mask = vocabulary.mask(grammar, state, (tokenizer.eos_token_id,), len(tokenizer), "cpu")
+    if kind == "blocked":
+        return set(torch.nonzero(~mask).flatten().tolist())
+    return set(mask.tolist())
+
+
+def document_states(grammar, vocabulary, tokenizer, text):
+    """The grammar states between the tokens of ``text``."""
+    states = [grammar.initial]
+    for token_id in tokenizer(text).input_ids:
+        states.append(walk(grammar, vocabulary.bytes[token_id], states[-1]))
+    return states
+
+
+@pytest.mark.parametrize("task", list(DOCUMENTS))
+def test_mask_allows_exactly_the_valid_continuations(tokenizer, vocabulary, task):
+    grammar = GRAMMARS[task]
+    states = document_states(grammar, vocabulary, tokenizer, encode(DOCUMENTS[task], 2))
+    assert grammar.is_complete(states[-1])
+    for state in dict.fromkeys(states[:-1]):
+        expected = {
+            token_id for token_id, data in vocabulary.bytes.items()
+            if data and walk(grammar, data, state) is not None
+        }
+        assert allowed_ids(vocabulary, grammar, state, tokenizer) == expected
+        assert tokenizer.eos_token_id not in expected
+
+
+def test_eos_only_after_the_closing_brace(tokenizer, vocabulary):
+    grammar = GRAMMARS["story"]
+    text = encode(DOCUMENTS["story"]).encode()
+    before_close = walk(grammar, text[:-1])
+    allowed = allowed_ids(vocabulary, grammar, before_close, tokenizer)
+    assert tokenizer.eos_token_id not in allowed
+    assert tokenizer.convert_tokens_to_ids("}") in allowed
+
+    complete = walk(grammar, text)
+    assert allowed_ids(vocabulary, grammar, complete, tokenizer) == {tokenizer.eos_token_id}
+
+
+def test_masks_are_cached_per_state(tokenizer):
+    vocabulary = TokenVocabulary(tokenizer, cache_size=2)
+    grammar = GRAMMARS["story"]
+    states = [grammar.initial, walk(grammar, b"{"), walk(grammar, b'{"title": "')]
+    args = ((tokenizer.eos_token_id,), len(tokenizer), "cpu")
+
+    first = vocabulary.mask(grammar, states[0], *args)
+    assert vocabulary.mask(grammar, states[0], *args) is first
+
+    vocabulary.mask(grammar, states[1], *args)
+    vocabulary.mask(grammar, states[2], *args)
+    # 超出 cache_size 时淘汰最久未用的
+    rebuilt = vocabulary.mask(grammar, states[0], *args)
+    assert rebuilt is not first
+    assert torch.equal(rebuilt[1], first[1])
+
+
+def synced(tokenizer, prompt, generated):
+    constraint = JsonConstraint("story", tokenizer, [tokenizer.eos_token_id])
+    constraint.sync(torch.tensor(prompt + generated), len(prompt))
+    return constraint
+
+
+def test_rewind_after_rejected_draft_tokens(tokenizer):
+    prompt = tokenizer("prompt").input_ids
+    accepted = tokenizer(encode(DOCUMENTS["story"])).input_ids
+    drafted = tokenizer(encode({"title": "The Cave", "rootNode": node("Light")})).input_ids
+    common = next(i for i, (a, b) in enumerate(zip(accepted, drafted)) if a != b)
+
+    # 辅助解码按草稿 token 逐个验证：行每次长一个 token
+    constraint = synced(tokenizer, prompt, drafted[:common])
+    for length in range(common + 1, common + 6):
+        constraint.sync(torch.tensor(prompt + drafted[:length]), len(prompt))
+    # 从 common 起的草稿被拒绝，下一轮的行以主模型的 token 结尾
+    for length in range(common + 1, common + 6):
+        constraint.sync(torch.tensor(prompt + accepted[:length]), len(prompt))
+
+    expected = synced(tokenizer, prompt, accepted[:common + 5])
+    assert not constraint.failed
+    assert constraint.tokens == expected.tokens
+    assert constraint.states == expected.states
+
+
+def test_invalid_token_gives_up_the_constraint(tokenizer):
+    prompt = tokenizer("prompt").input_ids
+    constraint = synced(tokenizer, prompt, tokenizer('{"title": 1').input_ids)
+    assert constraint.failed
+
+
+def schema_shape(schema, defs, seen=()):
+    """Structure of a JSON schema without names and descriptions; a recursive $ref becomes its distance up the path."""
+    if "$ref" in schema:
+        name = schema["$ref"].rsplit("/", 1)[-1]
+        if name in seen:
+            return ("recursive", len(seen) - seen.index(name))
+        return schema_shape(defs[name], defs, seen + (name,))
+    if "anyOf" in schema:
+        variants = [variant for variant in schema["anyOf"] if variant.get("type") != "null"]
+        return ("nullable", schema_shape(variants[0], defs, seen))
+    if schema["type"] == "array":
+        return ("array", schema_shape(schema["items"], defs, seen))
+    if schema["type"] == "object":
+        return ("object", tuple((key, schema_shape(value, defs, seen)) for key, value in schema["properties"].items()))
+    return (schema["type"],)
+
+
+@pytest.mark.parametrize("task, model_name", [
+    ("story", "StoryLLMResponse"),
+    ("lazy_story", "LazyStoryLLMResponse"),
+    ("node", "StoryNodeStubLLM"),
+    ("branch", "StoryNodeLLM"),
+])
+def test_task_schemas_match_backend_models(task, model_name):
+    spec = importlib.util.spec_from_file_location("backend_story_models", BACKEND_MODELS)
+    backend_models = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(backend_models)
+
+    schema = getattr(backend_models, model_name).model_json_schema()
+    defs = {**schema.get("$defs", {}), model_name: schema}
+    if "StoryOptionLLM" in defs:
+        # 后端 nextNode 是普通 dict，按 StoryNodeLLM 逐层校验
+        defs["StoryOptionLLM"]["properties"]["nextNode"] = {"$ref": "#/$defs/StoryNodeLLM"}
+        defs.setdefault("StoryNodeLLM", schema)
+
+    expected = TASK_SCHEMAS[task]
+    assert schema_shape(expected, expected.get("$defs", {})) == schema_shape({"$ref": model_name}, defs)
@@ -0,0 +1,73 @@
+import json
+
+import pytest
+
+from core.stopping import JsonStoryTracker
+
+
+def node(content, *children):
+    return {
+        "content": content,
+        "isEnding": not children,
+        "isWinningEnding": False,
+        "options": [{"text": f"to {child['content']}", "nextNode": child} for child in children],
+    }
+
+
+# 根节点 a，子节点 b（含 d）和 c
+STORY = {"title": "t", "rootNode": node("a", node("b", node("d")), node("c"))}
+TEXT = json.dumps(STORY, indent=2)
+
+
+def feed(tracker, text, step=3):
+    for start in range(0, len(text), step):
+        if tracker.feed_token(text[start:start + step]):
+            break
+
+
+def contents(tree):
+    found = [tree["content"]]
+    for option in tree.get("options") or []:
+        found += contents(option["nextNode"])
+    return found
+
+
+def test_complete_json_stops_without_trimming():
+    tracker = JsonStoryTracker(max_nodes=10)
+    feed(tracker, "<think>\n\n</think>\n\n" + TEXT + "\n")
+    assert tracker.stop_reason == "json_complete"
+    assert tracker.trim_to_budget(TEXT) == TEXT
+
+
+@pytest.mark.parametrize("max_nodes, kept", [(1, ["a"]), (2, ["a", "b"]), (3, ["a", "b", "d"])])
+def test_max_nodes_keeps_complete_nodes(max_nodes, kept):
+    tracker = JsonStoryTracker(max_nodes=max_nodes)
+    feed(tracker, TEXT)
+    assert tracker.stop_reason == "max_nodes"
+
+    trimmed = json.loads(tracker.trim_to_budget(TEXT))
+    assert contents(trimmed["rootNode"]) == kept
+    assert trimmed["title"] == "t"
+
+
+def test_max_depth_drops_deep_options():
+    tracker = JsonStoryTracker(max_depth=2)
+    feed(tracker, TEXT)
+    assert tracker.stop_reason == "max_depth"
+
+    trimmed = json.loads(tracker.trim_to_budget(TEXT))
+    assert contents(trimmed["rootNode"]) == ["a", "b"]
+    assert trimmed["rootNode"]["options"][0]["nextNode"]["options"] == []
+
+
+def test_trim_works_on_text_cut_at_the_stop():
+    # 生成在超预算节点的 "{" 处停止，之后没有更多文本
+    tracker = JsonStoryTracker(max_nodes=2)
+    cut = TEXT.index('"content": "d"')
+    trimmed = json.loads(tracker.trim_to_budget(TEXT[:cut]))
+    assert contents(trimmed["rootNode"]) == ["a", "b"]
+
+
+def test_root_over_budget_drops_the_node_key():
+    tracker = JsonStoryTracker(max_depth=0)
+    assert json.loads(tracker.trim_to_budget(TEXT)) == {"title": "t"}